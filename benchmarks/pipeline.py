@@ -0,0 +1,269 @@
+"""
+Benchmark the derivative pipeline on synthetic TIFFs.
+
+A TIFF is generated for each colour mode and size, and each public stage is timed on it: convert_to_jpg,
+generate_pixel_checksum, generate_jp2_from_tiff (kdu_compress), validate_jp2, check_visually_identical and the full
+generate_derivatives_from_tiff. The full run's per-stage metrics (see :mod:`image_processing.metrics`) are recorded
+too. Results are appended to a JSON lines file with details of the run (versions, CPUs, git commit), so runs on
+different versions or machines can be compared.
+
+Usage::
+
+    python benchmarks/pipeline.py [--modes RGB L] [--megapixels 1 10 100] [--repeat 3] [--results results.jsonl]
+    python benchmarks/pipeline.py --compare old_results.jsonl new_results.jsonl
+
+On machines without Kakadu or exiftool, ``--stubs`` uses the stand-ins in benchmarks/stubs. Their times are for
+Pillow's OpenJPEG codec and a no-op exiftool, so only compare them with other runs using the stubs.
+
+Large sizes need plenty of memory and disk: a 500 megapixel RGB TIFF is 1.5GB uncompressed, and several copies of the
+decoded image may be in memory at once. Pillow's decompression bomb check is turned off so they can be opened.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import uuid
+
+import PIL
+from PIL import Image, ImageCms
+
+from image_processing import validation
+from image_processing.derivative_files_generator import DerivativeFilesGenerator, DEFAULT_JPG_THUMBNAIL_RESIZE_VALUE
+
+STUBS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+DEFAULT_MODES = ['RGB', 'RGBA', 'I;16', 'L', '1']
+DEFAULT_MEGAPIXELS = [1, 10, 50]
+
+STAGES = ['convert_to_jpg', 'generate_pixel_checksum', 'generate_jp2_from_tiff', 'validate_jp2',
+          'check_visually_identical', 'generate_derivatives_from_tiff']
+
+
+def image_size(megapixels):
+    """
+    (width, height) of a 4:3 image with about this many megapixels
+    """
+    width = int(round(math.sqrt(megapixels * 1000000 * 4 / 3)))
+    return width, int(round(width * 3 / 4))
+
+
+def synthetic_image(mode, size):
+    """
+    An image with smooth gradients, fine detail and noise, so it compresses like a photograph rather than a flat
+    colour. The detail is a tiled fractal, so large images can be generated quickly
+    """
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 32)
+    tile = Image.effect_mandelbrot((512, 512), (-2.0, -1.2, 0.8, 1.2), 256)
+    detail = Image.new('L', size)
+    for x in range(0, size[0], tile.size[0]):
+        for y in range(0, size[1], tile.size[1]):
+            detail.paste(tile, (x, y))
+
+    if mode == 'RGB':
+        return Image.merge('RGB', [gradient, detail, noise])
+    if mode in ['RGBA', 'RGBX']:
+        # real RGBA sources are usually opaque
+        return Image.merge(mode, [gradient, detail, noise, Image.new('L', size, 255)])
+    if mode == 'L':
+        return Image.blend(gradient, detail, 0.5)
+    if mode == '1':
+        return Image.blend(gradient, detail, 0.5).convert('1')
+    if mode == 'I;16':
+        # little endian 16 bit values, with the detail in the high byte and noise in the low byte
+        return Image.frombytes('I;16', size, Image.merge('LA', [noise, detail]).tobytes())
+    raise ValueError('Unsupported mode {0}'.format(mode))
+
+
+def write_synthetic_tiff(filepath, mode, megapixels):
+    """
+    Save a synthetic TIFF, with an sRGB ICC profile if it is colour
+    """
+    image = synthetic_image(mode, image_size(megapixels))
+    save_options = {}
+    if mode in ['RGB', 'RGBA', 'RGBX']:
+        save_options['icc_profile'] = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    image.save(filepath, 'TIFF', **save_options)
+
+
+def time_stage(function, repeat, work_folder):
+    """
+    Call function(output_folder) repeat times, each with a new empty output folder
+
+    :return: tuple of the times in seconds, and the last return value
+    """
+    times = []
+    result = None
+    for repetition in range(repeat):
+        output_folder = os.path.join(work_folder, 'run{0}'.format(repetition))
+        os.makedirs(output_folder)
+        try:
+            start_time = time.perf_counter()
+            result = function(output_folder)
+            times.append(time.perf_counter() - start_time)
+        finally:
+            shutil.rmtree(output_folder)
+    return times, result
+
+
+def benchmark_image(tiff_filepath, generator, repeat, work_folder):
+    """
+    Time each stage on one TIFF
+
+    :return: list of (stage, times, stage metrics) tuples. Stage metrics are only recorded for the full run
+    """
+    converter = generator.converter
+    jp2_filepath = os.path.join(work_folder, 'reference.jp2')
+    expanded_filepath = os.path.join(work_folder, 'reference_expanded.tif')
+    generator.generate_jp2_from_tiff(tiff_filepath, jp2_filepath)
+    generator.kakadu.kdu_expand(jp2_filepath, expanded_filepath, kakadu_options=['-fussy'])
+
+    stages = [
+        ('convert_to_jpg', lambda output_folder: converter.convert_to_jpg(
+            tiff_filepath, os.path.join(output_folder, 'full.jpg'), resize=DEFAULT_JPG_THUMBNAIL_RESIZE_VALUE)),
+        ('generate_pixel_checksum', lambda output_folder: validation.generate_pixel_checksum(tiff_filepath)),
+        ('generate_jp2_from_tiff', lambda output_folder: generator.generate_jp2_from_tiff(
+            tiff_filepath, os.path.join(output_folder, 'full_lossless.jp2'))),
+        ('validate_jp2', lambda output_folder: validation.validate_jp2(jp2_filepath)),
+        ('check_visually_identical', lambda output_folder: validation.check_visually_identical(
+            tiff_filepath, expanded_filepath)),
+        ('generate_derivatives_from_tiff', lambda output_folder: generator.generate_derivatives_from_tiff(
+            tiff_filepath, output_folder, return_metrics=True)[1])
+    ]
+    results = []
+    for stage, function in stages:
+        times, result = time_stage(function, repeat, work_folder)
+        stage_metrics = None
+        if stage == 'generate_derivatives_from_tiff':
+            stage_metrics = [metrics.as_dict() for metrics in result]
+        results.append((stage, times, stage_metrics))
+    return results
+
+
+def run_details(generator, stubs):
+    """
+    Details of the software and machine, to tell runs apart
+    """
+    try:
+        git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                             cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {
+        'run_id': uuid.uuid4().hex,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': git_commit,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'kakadu': generator.kakadu.version(),
+        'exiftool': generator.converter.exiftool_version(),
+        'stubs': stubs
+    }
+
+
+def run(modes, megapixels_values, repeat, generator, results_filepath, details, work_folder=None):
+    print('{0:<6} {1:>6} {2:<32} {3:>9} {4:>9}'.format('mode', 'MP', 'stage', 'best (s)', 'median (s)'))
+    for megapixels in megapixels_values:
+        for mode in modes:
+            image_folder = tempfile.mkdtemp(prefix='image-processing-benchmark_', dir=work_folder)
+            try:
+                tiff_filepath = os.path.join(image_folder, 'source.tif')
+                write_synthetic_tiff(tiff_filepath, mode, megapixels)
+                width, height = image_size(megapixels)
+                for stage, times, stage_metrics in benchmark_image(tiff_filepath, generator, repeat, image_folder):
+                    print('{0:<6} {1:>6} {2:<32} {3:>9.3f} {4:>9.3f}'
+                          .format(mode, megapixels, stage, min(times), statistics.median(times)))
+                    result = dict(details, mode=mode, megapixels=megapixels, width=width, height=height,
+                                  stage=stage, times=times, best=min(times), median=statistics.median(times),
+                                  stage_metrics=stage_metrics)
+                    if results_filepath:
+                        with open(results_filepath, 'a') as results_file:
+                            results_file.write(json.dumps(result, sort_keys=True) + '\n')
+            finally:
+                shutil.rmtree(image_folder)
+
+
+def load_latest_run(results_filepath):
+    """
+    The results of the last run recorded in a results file
+
+    :return: dict of (mode, megapixels, stage) to result
+    """
+    with open(results_filepath) as results_file:
+        results = [json.loads(line) for line in results_file if line.strip()]
+    if not results:
+        return {}
+    latest_run_id = results[-1]['run_id']
+    return {(result['mode'], result['megapixels'], result['stage']): result
+            for result in results if result['run_id'] == latest_run_id}
+
+
+def compare(old_results_filepath, new_results_filepath):
+    """
+    Print the best times of the latest run in each file side by side, and the new time as a ratio of the old
+    """
+    old_results = load_latest_run(old_results_filepath)
+    new_results = load_latest_run(new_results_filepath)
+    print('{0:<6} {1:>6} {2:<32} {3:>9} {4:>9} {5:>7}'.format('mode', 'MP', 'stage', 'old (s)', 'new (s)', 'ratio'))
+    for key in sorted(set(old_results) & set(new_results), key=lambda k: (k[1], k[0], STAGES.index(k[2]))):
+        old_time = old_results[key]['best']
+        new_time = new_results[key]['best']
+        print('{0:<6} {1:>6} {2:<32} {3:>9.3f} {4:>9.3f} {5:>7.2f}'
+              .format(key[0], key[1], key[2], old_time, new_time, new_time / old_time if old_time else float('nan')))
+    old_stubs = {result.get('stubs') for result in old_results.values()}
+    new_stubs = {result.get('stubs') for result in new_results.values()}
+    if old_stubs != new_stubs:
+        print('Warning: only one of the runs used the stub executables, so the times are not comparable')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the derivative pipeline on synthetic TIFFs')
+    parser.add_argument('--modes', nargs='+', default=DEFAULT_MODES, choices=validation.ACCEPTED_COLOUR_MODES,
+                        help='Colour modes of the synthetic TIFFs')
+    parser.add_argument('--megapixels', nargs='+', type=float, default=DEFAULT_MEGAPIXELS,
+                        help='Sizes of the synthetic TIFFs in megapixels, e.g. 1 10 100 500')
+    parser.add_argument('--repeat', type=int, default=3, help='Time each stage this many times')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='JSON lines file to append the results to')
+    parser.add_argument('--work_folder', default=None, help='Folder for the synthetic TIFFs and outputs. '
+                                                             'Defaults to the system temporary folder')
+    parser.add_argument('-k', '--kakadu_path', default='/opt/kakadu', help='Base path to kakadu executables')
+    parser.add_argument('--exiftool_path', default='exiftool', help='Path to the exiftool executable')
+    parser.add_argument('--stubs', action='store_true',
+                        help='Use the stand-in kakadu and exiftool executables in benchmarks/stubs')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD_RESULTS', 'NEW_RESULTS'),
+                        help='Compare the latest runs in two results files instead of running the benchmark')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # the per-image warnings, e.g. about missing ICC profiles, are expected for synthetic images
+    logging.basicConfig(level=logging.ERROR)
+    Image.MAX_IMAGE_PIXELS = None
+    kakadu_path = STUBS_FOLDER if args.stubs else args.kakadu_path
+    exiftool_path = os.path.join(STUBS_FOLDER, 'exiftool') if args.stubs else args.exiftool_path
+    generator = DerivativeFilesGenerator(kakadu_base_path=kakadu_path, exiftool_path=exiftool_path,
+                                         require_icc_profile_for_colour=False)
+    details = run_details(generator, args.stubs)
+    print('Run {0} at commit {1}, exiftool {2}, stubs {3}'.format(details['run_id'], details['git_commit'],
+                                                                   details['exiftool'], details['stubs']))
+    run(args.modes, args.megapixels, args.repeat, generator, args.results, details, work_folder=args.work_folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the speed and quality of the JPEG thumbnail resize options.
+
+Each combination of resampling filter and reducing gap is timed resizing the same image, and its output compared
+to the reference (a LANCZOS resample of the full image, with no box reduction first) by peak signal-to-noise ratio.
+Higher PSNR is closer to the reference; identical images have infinite PSNR.
+
+Usage::
+
+    python benchmarks/thumbnail_resize.py [image ...] [--resize 0.6 0.25 0.1] [--repeat 3]
+
+Without any images, a synthetic 8000x6000 RGB image is used.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import math
+import time
+
+from PIL import Image, ImageChops, ImageStat
+
+from image_processing.conversion import THUMBNAIL_RESAMPLING_FILTERS
+
+DEFAULT_CONFIGURATIONS = [
+    ('lanczos', None),
+    ('lanczos', 2.0),
+    ('lanczos', 1.0),
+    ('bicubic', 2.0),
+    ('hamming', 1.0),
+    ('bilinear', 1.0),
+]
+"""(resampling filter, reducing gap) pairs to compare. ('lanczos', 2.0) is the current default"""
+
+
+def synthetic_image(size=(8000, 6000)):
+    """
+    An RGB image with smooth gradients, fine detail and noise, so both blurring and aliasing affect the PSNR
+    """
+    gradient = Image.linear_gradient('L').resize(size)
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 256)
+    noise = Image.effect_noise(size, 48)
+    return Image.merge('RGB', [gradient, detail, noise])
+
+
+def psnr(image1, image2):
+    """
+    Peak signal-to-noise ratio between two 8 bit images of the same size and mode, in decibels
+    """
+    difference = ImageChops.difference(image1, image2)
+    mean_squared_error = sum(rms ** 2 for rms in ImageStat.Stat(difference).rms) / len(difference.getbands())
+    if mean_squared_error == 0:
+        return float('inf')
+    return 10 * math.log10(255 ** 2 / mean_squared_error)
+
+
+def time_thumbnail(image, resize, resampling, reducing_gap, repeat):
+    """
+    :return: tuple of the best time in seconds, and the thumbnail
+    """
+    thumbnail_size = tuple(int(i * resize) for i in image.size)
+    best_time = None
+    for _ in range(repeat):
+        thumbnail = image.copy()
+        start_time = time.perf_counter()
+        thumbnail.thumbnail(thumbnail_size, THUMBNAIL_RESAMPLING_FILTERS[resampling], reducing_gap=reducing_gap)
+        elapsed = time.perf_counter() - start_time
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return best_time, thumbnail
+
+
+def run(images, resize_values, configurations, repeat):
+    print('{0:<24} {1:>6} {2:<10} {3:>6} {4:>9} {5:>9}'
+          .format('image', 'resize', 'filter', 'gap', 'time (s)', 'PSNR (dB)'))
+    for name, image in images:
+        image.load()
+        for resize in resize_values:
+            reference = None
+            for resampling, reducing_gap in configurations:
+                elapsed, thumbnail = time_thumbnail(image, resize, resampling, reducing_gap, repeat)
+                if reference is None:
+                    _, reference = time_thumbnail(image, resize, 'lanczos', None, 1)
+                print('{0:<24} {1:>6} {2:<10} {3:>6} {4:>9.3f} {5:>9.2f}'
+                      .format(name[-24:], resize, resampling, str(reducing_gap), elapsed, psnr(reference, thumbnail)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JPEG thumbnail resize options')
+    parser.add_argument('images', nargs='*', help='Images to resize. Defaults to a synthetic image')
+    parser.add_argument('--resize', nargs='+', type=float, default=[0.6, 0.25, 0.1],
+                        help='Resize values to test, like jpg_thumbnail_resize_value')
+    parser.add_argument('--repeat', type=int, default=3, help='Time the best of this many runs')
+    args = parser.parse_args()
+
+    if args.images:
+        images = []
+        for image_filepath in args.images:
+            image = Image.open(image_filepath)
+            if image.mode not in ['RGB', 'L']:
+                image = image.convert('RGB')
+            images.append((image_filepath, image))
+    else:
+        images = [('synthetic', synthetic_image())]
+    run(images, args.resize, DEFAULT_CONFIGURATIONS, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
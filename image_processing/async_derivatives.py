@@ -0,0 +1,450 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent import futures
+
+from PIL import Image
+
+from image_processing import conversion, inspection, validation
+from image_processing.cache import unlink_linked_files
+from image_processing.derivative_files_generator import DerivativeFilesGenerator, DEFAULT_JPG_FILENAME, \
+    DEFAULT_EMBEDDED_METADATA_FILENAME, DEFAULT_TIFF_FILENAME, DEFAULT_LOSSLESS_JP2_FILENAME, \
+    DEFAULT_JPYLYZER_XML_FILENAME, generate_checksum_and_close
+
+
+async def run_subprocess(command_options):
+    """
+    Run a command with :func:`asyncio.create_subprocess_exec`, and wait for it without blocking the event loop.
+    If the waiting task is cancelled, the command is killed.
+    Raises :class:`subprocess.CalledProcessError` if the command fails
+
+    :param command_options: command line arguments, including the executable
+    :return: the bytes the command wrote to stdout and stderr
+    """
+    process = await asyncio.create_subprocess_exec(*command_options, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command_options, output=output)
+    return output
+
+
+class ProcessLimiter(object):
+    """
+    Limits how many subprocesses run at once, across all the coroutines that share it.
+    The semaphore is created in the running event loop when first used, so the limiter can be created outside one
+    """
+
+    def __init__(self, max_processes):
+        """
+        :param max_processes:
+        """
+        self.max_processes = max_processes
+        self._semaphore = None
+        self._loop = None
+
+    @property
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_processes)
+            self._loop = loop
+        return self._semaphore
+
+
+class AsyncKakadu(object):
+    """
+    Asyncio variants of the :class:`~image_processing.kakadu.Kakadu` commands.
+    Uses the wrapped instance's paths, thread settings and metrics. The output of each command is always captured and
+    logged at debug level, so the output of concurrent commands isn't interleaved
+    """
+
+    def __init__(self, kakadu, limiter=None):
+        """
+        :param kakadu: a :class:`~image_processing.kakadu.Kakadu` instance
+        :param limiter: if not None, a :class:`ProcessLimiter` shared with other commands
+        """
+        self.kakadu = kakadu
+        self.limiter = limiter
+
+    async def kdu_compress(self, input_filepaths, output_filepath, kakadu_options):
+        """
+        See :func:`~image_processing.kakadu.Kakadu.kdu_compress`
+        """
+        await self.run_command('kdu_compress', input_filepaths, output_filepath, kakadu_options)
+
+    async def kdu_expand(self, input_filepath, output_filepath, kakadu_options):
+        """
+        See :func:`~image_processing.kakadu.Kakadu.kdu_expand`
+        """
+        await self.run_command('kdu_expand', input_filepath, output_filepath, kakadu_options)
+
+    async def run_command(self, command, input_files, output_file, kakadu_options):
+        command_options, input_option = self.kakadu.get_command(command, input_files, output_file, kakadu_options)
+        if self.limiter is None:
+            await self._run_command(command, input_option, output_file, command_options)
+        else:
+            async with self.limiter.semaphore:
+                await self._run_command(command, input_option, output_file, command_options)
+
+    async def _run_command(self, command, input_option, output_file, command_options):
+        # timed once the limiter allows the command to start
+        start_time = time.perf_counter()
+        try:
+            output = await run_subprocess(command_options)
+        except subprocess.CalledProcessError as e:
+            self.kakadu.raise_command_error(command, input_option, command_options, e)
+        self.kakadu.record_output(command, input_option, output_file, time.perf_counter() - start_time, output)
+
+
+class AsyncConverter(object):
+    """
+    Asyncio variants of the :class:`~image_processing.conversion.Converter` methods used to generate derivatives.
+    Exiftool is run with :func:`run_subprocess`, unless the converter has an exiftool pool, whose long-running
+    processes are used on the thread pool instead. Pixels are decoded, resized and encoded on the thread pool
+    """
+
+    def __init__(self, converter, limiter=None, executor=None):
+        """
+        :param converter: a :class:`~image_processing.conversion.Converter` instance
+        :param limiter: if not None, a :class:`ProcessLimiter` shared with other commands
+        :param executor: :class:`concurrent.futures.Executor` for blocking work. None uses the event loop's default
+        """
+        self.converter = converter
+        self.limiter = limiter
+        self.executor = executor
+
+    async def run_exiftool(self, command_options):
+        """
+        See :func:`~image_processing.conversion.Converter.run_exiftool`
+        """
+        if self.converter.exiftool_pool:
+            await _run_blocking(self.executor, self.converter.run_exiftool, command_options)
+        elif self.limiter is None:
+            await self._run_exiftool(command_options)
+        else:
+            async with self.limiter.semaphore:
+                await self._run_exiftool(command_options)
+
+    async def _run_exiftool(self, command_options):
+        self.converter.logger.debug(' '.join([self.converter.exiftool_path] + command_options))
+        output = await run_subprocess([self.converter.exiftool_path] + command_options)
+        self.converter.logger.debug(output.decode('utf-8', 'replace').strip())
+
+    async def copy_over_embedded_metadata(self, input_image_filepath, output_image_filepath, write_only_xmp=False):
+        """
+        See :func:`~image_processing.conversion.Converter.copy_over_embedded_metadata`
+        """
+        await self.copy_over_embedded_metadata_to_files(input_image_filepath, [output_image_filepath],
+                                                        write_only_xmp=write_only_xmp)
+
+    async def copy_over_embedded_metadata_to_files(self, input_image_filepath, output_image_filepaths,
+                                                   write_only_xmp=False):
+        """
+        See :func:`~image_processing.conversion.Converter.copy_over_embedded_metadata_to_files`
+        """
+        command_options = self.converter.get_copy_metadata_options(input_image_filepath, output_image_filepaths,
+                                                                   write_only_xmp=write_only_xmp)
+        try:
+            await self.run_exiftool(command_options)
+        except subprocess.CalledProcessError as e:
+            self.converter.raise_copy_metadata_error(input_image_filepath, e)
+
+    async def copy_over_xmp_to_jp2(self, input_image_filepath, jp2_filepath):
+        """
+        See :func:`~image_processing.conversion.Converter.copy_over_xmp_to_jp2`
+        """
+        with tempfile.TemporaryDirectory(prefix='image-processing_') as temp_folder:
+            xmp_filepath = os.path.join(temp_folder, 'metadata.xmp')
+            command_options = self.converter.get_xmp_packet_options(input_image_filepath, jp2_filepath, xmp_filepath)
+            try:
+                await self.run_exiftool(command_options)
+            except subprocess.CalledProcessError as e:
+                self.converter.raise_copy_metadata_error(input_image_filepath, e)
+            appended = await _run_blocking(self.executor, self.converter.append_xmp_packet_to_jp2, xmp_filepath,
+                                           jp2_filepath)
+        if not appended:
+            await self.copy_over_embedded_metadata(input_image_filepath, jp2_filepath, write_only_xmp=True)
+
+    async def extract_xmp_to_sidecar_file(self, image_filepath, output_xmp_filepath):
+        """
+        See :func:`~image_processing.conversion.Converter.extract_xmp_to_sidecar_file`
+        """
+        command_options = self.converter.get_extract_xmp_options(image_filepath, output_xmp_filepath)
+        try:
+            await self.run_exiftool(command_options)
+        except subprocess.CalledProcessError as e:
+            self.converter.raise_extract_xmp_error(image_filepath, e)
+
+    async def convert_to_jpg(self, input_filepath, output_filepath, resize=None, quality=None, image_context=None,
+                             resampling=conversion.DEFAULT_THUMBNAIL_RESAMPLING,
+                             reducing_gap=conversion.DEFAULT_THUMBNAIL_REDUCING_GAP):
+        """
+        See :func:`~image_processing.conversion.Converter.convert_to_jpg`
+        """
+        conversion.check_resampling_filter(resampling)
+
+        metadata_segments = await self._get_jpg_metadata_segments_for_file(input_filepath, image_context)
+
+        def save_as_jpg(input_pil, is_shared_image):
+            self.converter.save_pil_image_as_jpg(input_pil, output_filepath, resize, quality,
+                                                 is_shared_image=is_shared_image, resampling=resampling,
+                                                 reducing_gap=reducing_gap, metadata_segments=metadata_segments)
+
+        await _run_blocking(self.executor, _with_image, input_filepath, image_context, save_as_jpg)
+        if metadata_segments is None:
+            await self.copy_over_embedded_metadata(input_filepath, output_filepath)
+
+    async def convert_to_jpgs(self, input_filepath, jpg_outputs, image_context=None,
+                              resampling=conversion.DEFAULT_THUMBNAIL_RESAMPLING,
+                              reducing_gap=conversion.DEFAULT_THUMBNAIL_REDUCING_GAP):
+        """
+        See :func:`~image_processing.conversion.Converter.convert_to_jpgs`
+        """
+        conversion.check_resampling_filter(resampling)
+
+        metadata_segments = await self._get_jpg_metadata_segments_for_file(input_filepath, image_context)
+
+        def save_as_jpgs(input_pil, _):
+            self.converter.save_pil_image_as_jpgs(input_pil, jpg_outputs, resampling, reducing_gap,
+                                                  metadata_segments=metadata_segments)
+
+        await _run_blocking(self.executor, _with_image, input_filepath, image_context, save_as_jpgs)
+        if metadata_segments is None:
+            await self.copy_over_embedded_metadata_to_files(input_filepath, [output[0] for output in jpg_outputs])
+
+    async def get_jpg_metadata_segments(self, metadata_filepath, colour_mode, icc_profile):
+        """
+        See :func:`~image_processing.conversion.Converter.get_jpg_metadata_segments`
+        """
+        metadata_segments = self.converter.get_cached_jpg_metadata_segments(metadata_filepath, colour_mode,
+                                                                            icc_profile)
+        if metadata_segments is None:
+            with tempfile.TemporaryDirectory(prefix='image-processing_') as temp_folder:
+                template_filepath = self.converter.write_jpg_metadata_template(temp_folder, colour_mode, icc_profile)
+                await self.copy_over_embedded_metadata(metadata_filepath, template_filepath)
+                metadata_segments = self.converter.cache_jpg_metadata_segments(metadata_filepath, colour_mode,
+                                                                               icc_profile, template_filepath)
+        return metadata_segments
+
+    async def _get_jpg_metadata_segments_for_file(self, input_filepath, image_context):
+        if not self.converter.embed_jpg_metadata:
+            return None
+        if image_context is None:
+            image_context = await _run_blocking(self.executor, inspection.inspect_image, input_filepath)
+        return await self.get_jpg_metadata_segments(
+            input_filepath, conversion.get_jpg_colour_mode(image_context.mode), image_context.icc_profile)
+
+
+class AsyncDerivativeFilesGenerator(object):
+    """
+    An asyncio version of :func:`~image_processing.derivative_files_generator.DerivativeFilesGenerator.generate_derivatives_from_tiff`,
+    so a service can keep many images in flight without a thread per image.
+
+    Kakadu and exiftool run as asyncio subprocesses, at most max_processes at once. Decoding, JPEG encoding,
+    checksums and jpylyzer validation run on a pool of max_workers threads. Within each image, the XMP sidecar is
+    extracted and kdu_compress runs while the JPEGs and pixel checksum are made, as they only need the source file.
+
+    Generators with a cache, incremental, jpg_from_jp2, stream_lossless_check or a memory budget set run the
+    blocking generate_derivatives_from_tiff on the thread pool instead, as those aren't supported here.
+    Use as a context manager, or call :func:`close` to shut down the thread pool.
+    """
+
+    def __init__(self, max_processes=None, max_workers=None, **generator_options):
+        """
+        :param max_processes: maximum number of kakadu and exiftool processes to run at once.
+            Defaults to the number of CPUs
+        :param max_workers: number of threads for blocking work. Defaults to the number of CPUs
+        :param generator_options: keyword arguments used to create the
+            :class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator` whose settings are used
+        """
+        self.generator = DerivativeFilesGenerator(**generator_options)
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1)
+        self.limiter = ProcessLimiter(max_processes or os.cpu_count() or 1)
+        self.kakadu = AsyncKakadu(self.generator.kakadu, limiter=self.limiter)
+        self.converter = AsyncConverter(self.generator.converter, limiter=self.limiter, executor=self.executor)
+        self.log = logging.getLogger(__name__)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def generate_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff=False,
+                                             save_embedded_metadata=True, create_jpg_as_thumbnail=True,
+                                             check_lossless=True, save_jpylyzer_output=False):
+        """
+        Extracts the embedded metadata, creates a JPEG file and a validated JPEG2000 file.
+        Stores all in the given folder. Takes the same arguments as
+        :func:`~image_processing.derivative_files_generator.DerivativeFilesGenerator.generate_derivatives_from_tiff`
+
+        :return: filepaths of created files
+        """
+        generator = self.generator
+        if generator.cache is not None or generator.incremental or generator.jpg_from_jp2 \
+                or generator.stream_lossless_check or generator.memory_budget is not None:
+            return await _run_blocking(self.executor, functools.partial(
+                generator.generate_derivatives_from_tiff, tiff_filepath, output_folder, include_tiff=include_tiff,
+                save_embedded_metadata=save_embedded_metadata, create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                check_lossless=check_lossless, save_jpylyzer_output=save_jpylyzer_output))
+
+        self.log.debug("Processing {0}".format(tiff_filepath))
+        source_file_name = os.path.basename(tiff_filepath)
+        roles = [DEFAULT_JPG_FILENAME]
+        if save_embedded_metadata:
+            roles.append(DEFAULT_EMBEDDED_METADATA_FILENAME)
+        if include_tiff:
+            roles.append(DEFAULT_TIFF_FILENAME)
+        roles.append(DEFAULT_LOSSLESS_JP2_FILENAME)
+        output_filepaths = {role: os.path.join(output_folder, generator._get_filename(role, source_file_name))
+                            for role in roles + [DEFAULT_JPYLYZER_XML_FILENAME]}
+        output_filepaths.update(generator._get_jpg_derivative_filepaths(output_folder))
+        roles += [spec.filename for spec in generator.jpg_derivative_specs]
+        if not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+        # cached derivatives may have been linked to these paths, and some are written in place
+        unlink_linked_files(output_filepaths[role] for role in roles)
+
+        stages = [self._generate_image_derivatives(tiff_filepath, output_filepaths,
+                                                   create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                                                   check_lossless=check_lossless,
+                                                   save_jpylyzer_output=save_jpylyzer_output)]
+        if save_embedded_metadata:
+            stages.append(self.converter.extract_xmp_to_sidecar_file(
+                tiff_filepath, output_filepaths[DEFAULT_EMBEDDED_METADATA_FILENAME]))
+        if include_tiff:
+            stages.append(_run_blocking(self.executor, shutil.copy, tiff_filepath,
+                                        output_filepaths[DEFAULT_TIFF_FILENAME]))
+        await _gather(stages)
+
+        self.log.debug("Successfully generated derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+        return [output_filepaths[role] for role in roles]
+
+    async def _generate_image_derivatives(self, tiff_filepath, output_filepaths, create_jpg_as_thumbnail,
+                                          check_lossless, save_jpylyzer_output):
+        generator = self.generator
+        image_context = await _run_blocking(self.executor, functools.partial(
+            validation.ImageContext, tiff_filepath, checksum_options=generator.pixel_checksum_options))
+        temp_folder = tempfile.mkdtemp(prefix='image-processing_')
+        try:
+            await _run_blocking(self.executor, functools.partial(
+                validation.check_image_suitable_for_jp2_conversion, tiff_filepath,
+                require_icc_profile_for_colour=generator.require_icc_profile_for_colour,
+                require_icc_profile_for_greyscale=generator.require_icc_profile_for_greyscale,
+                image_context=image_context))
+            if image_context.mode == 'RGBA':
+                # some RGBA tiffs don't convert properly back from jp2 - kakadu warns about unassociated alpha channels
+                check_lossless = True
+
+            if os.path.splitext(tiff_filepath)[1].lower() not in ['.tif', '.tiff']:
+                normalised_tiff_filepath = os.path.join(temp_folder, 'source.tif')
+                await _run_blocking(self.executor, shutil.copy, tiff_filepath, normalised_tiff_filepath)
+            else:
+                normalised_tiff_filepath = tiff_filepath
+
+            # kdu_compress reads the source file, so runs while the decoded pixels are used for the jpgs and checksum
+            source_pixel_checksum, _ = await _gather([
+                self._generate_jpgs_and_checksum(normalised_tiff_filepath, output_filepaths, image_context,
+                                                 create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                                                 check_lossless=check_lossless),
+                self._generate_jp2(normalised_tiff_filepath, output_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME],
+                                   image_context.mode)])
+
+            lossless_filepath = output_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME]
+            jpylyzer_output_filepath = output_filepaths[DEFAULT_JPYLYZER_XML_FILENAME] if save_jpylyzer_output \
+                else None
+            await _run_blocking(self.executor, validation.validate_jp2, lossless_filepath, jpylyzer_output_filepath)
+            if check_lossless:
+                reconverted_tiff_filepath = os.path.join(temp_folder, 'jp2_reconvert.tif')
+                await self.kakadu.kdu_expand(lossless_filepath, reconverted_tiff_filepath, kakadu_options=['-fussy'])
+                await _run_blocking(self.executor, functools.partial(
+                    validation.check_visually_identical, normalised_tiff_filepath, reconverted_tiff_filepath,
+                    source_pixel_checksum=source_pixel_checksum, source_image_context=image_context))
+                self.log.info('Conversion from source file {0} to jp2 file {1} was lossless'
+                              .format(tiff_filepath, lossless_filepath))
+        finally:
+            image_context.close()
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+    async def _generate_jpgs_and_checksum(self, tiff_filepath, output_filepaths, image_context,
+                                          create_jpg_as_thumbnail, check_lossless):
+        """
+        :return: the source pixel checksum, or None if check_lossless isn't set
+        """
+        generator = self.generator
+        jpeg_filepath = output_filepaths[DEFAULT_JPG_FILENAME]
+        await self.converter.convert_to_jpg(
+            tiff_filepath, jpeg_filepath, image_context=image_context,
+            quality=None if create_jpg_as_thumbnail else generator.jpg_high_quality_value,
+            resize=generator.jpg_thumbnail_resize_value if create_jpg_as_thumbnail else None,
+            resampling=generator.jpg_thumbnail_resampling, reducing_gap=generator.jpg_thumbnail_reducing_gap)
+        self.log.debug('jpeg file {0} generated'.format(jpeg_filepath))
+        if generator.jpg_derivative_specs:
+            await self.converter.convert_to_jpgs(
+                tiff_filepath, [(output_filepaths[spec.filename], spec.size, spec.quality)
+                                for spec in generator.jpg_derivative_specs],
+                image_context=image_context, resampling=generator.jpg_thumbnail_resampling,
+                reducing_gap=generator.jpg_thumbnail_reducing_gap)
+
+        # the pixels aren't needed after this, so are freed rather than held while waiting for kakadu
+        if not check_lossless:
+            image_context.close()
+            return None
+        return await _run_blocking(self.executor, generate_checksum_and_close, image_context)
+
+    async def _generate_jp2(self, tiff_filepath, jp2_filepath, colour_mode):
+        await self.kakadu.kdu_compress(tiff_filepath, jp2_filepath,
+                                       kakadu_options=self.generator._get_kakadu_compress_options(colour_mode))
+        self.log.debug('Lossless jp2 file {0} generated'.format(jp2_filepath))
+        # as of v7.10.4, kakadu doesn't copy over a lot of the technical metadata, so we do that separately
+        if self.generator.append_jp2_xmp:
+            await self.converter.copy_over_xmp_to_jp2(tiff_filepath, jp2_filepath)
+        else:
+            await self.converter.copy_over_embedded_metadata(tiff_filepath, jp2_filepath, write_only_xmp=True)
+
+
+async def _run_blocking(executor, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def _gather(coroutines):
+    """
+    Run coroutines concurrently and wait for all of them to finish, so none are left running if one fails.
+    Then raise the first error, if any
+
+    :return: list of their results
+    """
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def _with_image(input_filepath, image_context, function):
+    """
+    Call function with the image context's decoded image if there is one, or else the opened input file
+    """
+    if image_context is not None:
+        function(image_context.image, True)
+    else:
+        with Image.open(input_filepath) as input_pil:
+            function(input_pil, False)
@@ -0,0 +1,347 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import csv
+import itertools
+import logging
+import os
+import time
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+from image_processing import kakadu, metrics
+from image_processing.derivative_files_generator import DerivativeFilesGenerator
+
+DEFAULT_SOURCE_EXTENSIONS = ['.tif', '.tiff']
+
+_worker_generator = None
+
+
+class BatchResult(object):
+    """
+    The outcome of generating derivatives for one source file in a batch
+    """
+
+    def __init__(self, source_filepath, output_folder, generated_files=None, error=None, duration=0.0,
+                 kakadu_metrics=None, stage_metrics=None):
+        """
+        :param source_filepath:
+        :param output_folder:
+        :param generated_files: filepaths of created files, if successful
+        :param error: description of the error, if the source file failed
+        :param duration: wall time taken to process the source file, in seconds
+        :param kakadu_metrics: list of :class:`~image_processing.kakadu.KakaduMetrics` dicts for the kakadu commands
+            run, if kakadu_report_cpu is set
+        :param stage_metrics: list of :class:`~image_processing.metrics.StageMetrics` dicts for the stages run
+        """
+        self.source_filepath = source_filepath
+        self.output_folder = output_folder
+        self.generated_files = generated_files or []
+        self.error = error
+        self.duration = duration
+        self.kakadu_metrics = kakadu_metrics or []
+        self.stage_metrics = stage_metrics or []
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            'source_filepath': self.source_filepath,
+            'output_folder': self.output_folder,
+            'generated_files': self.generated_files,
+            'error': self.error,
+            'duration': self.duration,
+            'kakadu_metrics': self.kakadu_metrics,
+            'stage_metrics': self.stage_metrics
+        }
+
+
+class BatchSummary(object):
+    """
+    Collects :class:`BatchResult` instances as a batch runs, and summarises the successes, failures and timings
+    """
+
+    def __init__(self):
+        self.results = []
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def add(self, result):
+        self.results.append(result)
+        self.end_time = time.perf_counter()
+
+    @property
+    def successes(self):
+        return [result for result in self.results if result.success]
+
+    @property
+    def failures(self):
+        return [result for result in self.results if not result.success]
+
+    @property
+    def wall_time(self):
+        """
+        Elapsed time between starting the batch and the last result arriving
+        """
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def processing_time(self):
+        """
+        Sum of the time spent on each file. Divide by wall_time to get the effective parallelism
+        """
+        return sum(result.duration for result in self.results)
+
+    @property
+    def kakadu_cpu_time(self):
+        """
+        Sum of the processing time kakadu reported for each command, if kakadu_report_cpu is set
+        """
+        return sum(kakadu_metrics['cpu_time'] or 0.0 for result in self.results
+                   for kakadu_metrics in result.kakadu_metrics)
+
+    @property
+    def stage_totals(self):
+        """
+        Totals for each stage over all the results. See :func:`~image_processing.metrics.summarise`
+        """
+        return metrics.summarise([metrics.StageMetrics.from_dict(stage_metrics) for result in self.results
+                                  for stage_metrics in result.stage_metrics])
+
+    def as_dict(self):
+        return {
+            'total': len(self.results),
+            'successes': len(self.successes),
+            'failures': len(self.failures),
+            'wall_time': self.wall_time,
+            'processing_time': self.processing_time,
+            'kakadu_cpu_time': self.kakadu_cpu_time,
+            'stage_totals': self.stage_totals,
+            'results': [result.as_dict() for result in self.results]
+        }
+
+    def __str__(self):
+        lines = ['Processed {0} files in {1:.1f}s ({2:.1f}s of processing): {3} succeeded, {4} failed'
+                 .format(len(self.results), self.wall_time, self.processing_time,
+                         len(self.successes), len(self.failures))]
+        lines += ['  FAILED {0}: {1}'.format(result.source_filepath, result.error) for result in self.failures]
+        return '\n'.join(lines)
+
+
+class BatchDerivativeFilesGenerator(object):
+    """
+    Runs :func:`~image_processing.derivative_files_generator.DerivativeFilesGenerator.generate_derivatives_from_tiff`
+    over many source files in a pool of worker processes
+    """
+
+    def __init__(self, max_workers=None, metrics_sinks=None, **generator_options):
+        """
+        :param max_workers: number of worker processes. Defaults to the number of CPUs
+        :param metrics_sinks: list of :class:`~image_processing.metrics.MetricsSink` to write the stage metrics of
+            each result to. They are written from this process, not the workers
+        :param generator_options: keyword arguments used to create the
+            :class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator` in each worker.
+            kakadu_num_threads defaults to sharing the CPUs between the workers, so they don't each start a thread per
+            CPU (see :func:`~image_processing.kakadu.get_default_num_threads`)
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        generator_options.setdefault('kakadu_num_threads', kakadu.get_default_num_threads(self.max_workers))
+        self.generator_options = generator_options
+        self.metrics_sinks = list(metrics_sinks or [])
+        self.log = logging.getLogger(__name__)
+
+        # fail fast on configuration problems (e.g. missing executables), rather than in every worker
+        DerivativeFilesGenerator(**generator_options)
+
+    def generate_derivatives_from_tiffs(self, jobs, **derivative_options):
+        """
+        Generate derivatives for each source file, yielding a :class:`BatchResult` as each one finishes.
+        Results are yielded in order of completion, not submission.
+        An error in one file is recorded on its result and does not stop the batch. If a worker process dies (e.g. it
+        is killed for running out of memory, or a library crashes), the pool is replaced, and the files that were in
+        flight are run again one at a time to find which one killed it. That file gets a failed result
+
+        :param jobs: iterable of (source filepath, output folder) pairs.
+            See :func:`jobs_from_folder` and :func:`jobs_from_manifest`
+        :param derivative_options: keyword arguments passed to
+            :func:`~image_processing.derivative_files_generator.DerivativeFilesGenerator.generate_derivatives_from_tiff`
+        """
+        jobs = iter(jobs)
+        # only keep a few jobs queued per worker, so very large batches don't build up a huge backlog of futures
+        max_pending = self.max_workers * 2
+        all_submitted = False
+        while not all_submitted:
+            crashed_jobs = []
+            with self._create_executor(self.max_workers) as executor:
+                pending = {}
+                for job in jobs:
+                    try:
+                        pending[executor.submit(_generate_derivatives, job[0], job[1], derivative_options)] = job
+                    except BrokenProcessPool:
+                        # a worker died since the last results were collected. The job goes to the next pool
+                        jobs = itertools.chain([job], jobs)
+                        break
+                    if len(pending) >= max_pending:
+                        done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                        for result in self._collect_results(done, pending, crashed_jobs):
+                            yield result
+                        if crashed_jobs:
+                            break
+                else:
+                    all_submitted = True
+                # once the pool is broken, the futures of its other jobs fail straight away
+                for result in self._collect_results(futures.as_completed(list(pending)), pending, crashed_jobs):
+                    yield result
+
+            for source_filepath, output_folder in crashed_jobs:
+                yield self._get_result(self._run_alone(source_filepath, output_folder, derivative_options))
+
+    def run(self, jobs, result_callback=None, **derivative_options):
+        """
+        Process all the jobs and return a :class:`BatchSummary`
+
+        :param jobs: iterable of (source filepath, output folder) pairs
+        :param result_callback: if not None, a function called with each :class:`BatchResult` as it arrives, e.g. to
+            report progress
+        :param derivative_options: see :func:`generate_derivatives_from_tiffs`
+        """
+        summary = BatchSummary()
+        for result in self.generate_derivatives_from_tiffs(jobs, **derivative_options):
+            summary.add(result)
+            if result_callback is not None:
+                result_callback(result)
+        self.log.info(str(summary))
+        return summary
+
+    def _create_executor(self, max_workers):
+        return futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_initialise_worker,
+                                           initargs=(self.generator_options,))
+
+    def _collect_results(self, done, pending, crashed_jobs):
+        """
+        Take the finished futures out of pending, and yield their results. Jobs whose worker pool broke are added to
+        crashed_jobs instead
+        """
+        for future in done:
+            job = pending.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                crashed_jobs.append(job)
+            else:
+                yield self._get_result(result)
+
+    def _run_alone(self, source_filepath, output_folder, derivative_options):
+        """
+        Run a job whose worker pool broke in a pool of its own, so if it breaks again, it was this job which did it
+        """
+        start_time = time.perf_counter()
+        with self._create_executor(1) as executor:
+            try:
+                return executor.submit(_generate_derivatives, source_filepath, output_folder,
+                                       derivative_options).result()
+            except BrokenProcessPool as e:
+                return BatchResult(source_filepath, output_folder,
+                                   error='{0}: the worker process died: {1}'.format(type(e).__name__, e),
+                                   duration=time.perf_counter() - start_time)
+
+    def _get_result(self, result):
+        if result.stage_metrics:
+            stage_metrics = [metrics.StageMetrics.from_dict(stage_metrics) for stage_metrics in result.stage_metrics]
+            for sink in self.metrics_sinks:
+                sink.write(stage_metrics, source_filepath=result.source_filepath)
+        if result.success:
+            self.log.debug('Generated derivatives for {0} in {1:.2f}s'.format(result.source_filepath, result.duration))
+        else:
+            self.log.error('Failed to generate derivatives for {0}: {1}'.format(result.source_filepath, result.error))
+        return result
+
+
+def jobs_from_folder(source_folder, output_folder, extensions=DEFAULT_SOURCE_EXTENSIONS):
+    """
+    Find all source files under source_folder, and pair each one with its own output folder.
+    The output folder mirrors the source file's path relative to source_folder, without the file extension
+
+    :param source_folder:
+    :param output_folder: base folder for the derivatives
+    :param extensions: file extensions to include (case insensitive)
+    :return: sorted list of (source filepath, output folder) pairs
+    """
+    jobs = []
+    for dirpath, _, filenames in os.walk(source_folder):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in extensions:
+                source_filepath = os.path.join(dirpath, filename)
+                relative_path = os.path.splitext(os.path.relpath(source_filepath, source_folder))[0]
+                jobs.append((source_filepath, os.path.join(output_folder, relative_path)))
+    return sorted(jobs)
+
+
+def jobs_from_manifest(manifest_filepath, output_folder=None):
+    """
+    Read jobs from a manifest file. See :func:`read_manifest` for the format
+
+    :param manifest_filepath:
+    :param output_folder: base folder for sources without their own output folder. Each gets a subfolder named
+        after the source file
+    :return: list of (source filepath, output folder) pairs
+    """
+    jobs = []
+    for source_filepath, job_output_folder in read_manifest(manifest_filepath):
+        if job_output_folder is None:
+            if not output_folder:
+                raise ValueError('No output folder given for {0} in manifest {1}'
+                                 .format(source_filepath, manifest_filepath))
+            job_output_folder = os.path.join(output_folder, os.path.splitext(os.path.basename(source_filepath))[0])
+        jobs.append((source_filepath, job_output_folder))
+    return jobs
+
+
+def read_manifest(manifest_filepath):
+    """
+    Read a manifest file. Each line is a source filepath, optionally followed by a comma and the output folder for
+    that file. Blank lines and lines starting with # are ignored.
+
+    :param manifest_filepath:
+    :return: list of (source filepath, output folder) pairs. The output folder is None if the line doesn't have one
+    """
+    entries = []
+    with open(manifest_filepath, newline='') as manifest_file:
+        for row in csv.reader(manifest_file):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            entries.append((row[0].strip(), row[1].strip() if len(row) > 1 and row[1].strip() else None))
+    return entries
+
+
+def _initialise_worker(generator_options):
+    global _worker_generator
+    _worker_generator = DerivativeFilesGenerator(**generator_options)
+
+
+def _generate_derivatives(source_filepath, output_folder, derivative_options):
+    start_time = time.perf_counter()
+    # recorded here rather than returned by the generator, so the stages of failed files are recorded too
+    with metrics.recording() as recorder:
+        try:
+            generated_files = _worker_generator.generate_derivatives_from_tiff(source_filepath, output_folder,
+                                                                               **derivative_options)
+        except Exception as e:
+            # the exception is recorded as a string, as not all exceptions can be pickled back to the parent process
+            return BatchResult(source_filepath, output_folder, error='{0}: {1}'.format(type(e).__name__, e),
+                               duration=time.perf_counter() - start_time, kakadu_metrics=_pop_kakadu_metrics(),
+                               stage_metrics=_as_dicts(recorder.stages))
+    return BatchResult(source_filepath, output_folder, generated_files=list(generated_files),
+                       duration=time.perf_counter() - start_time, kakadu_metrics=_pop_kakadu_metrics(),
+                       stage_metrics=_as_dicts(recorder.stages))
+
+
+def _pop_kakadu_metrics():
+    return _as_dicts(_worker_generator.kakadu.pop_metrics())
+
+
+def _as_dicts(metrics_list):
+    return [metrics_object.as_dict() for metrics_object in metrics_list]
@@ -0,0 +1,239 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+CACHE_FORMAT_VERSION = 1
+"""Included in every cache key, so entries are invalidated if the way derivatives are generated changes"""
+
+_TEMP_PREFIX = 'tmp-'
+
+
+class DerivativeCache(object):
+    """
+    A local, content-addressed cache of derivative files.
+
+    Entries are keyed on a hash of the source file's contents and the settings used to generate the derivatives
+    (see :func:`get_key`), so a source that hasn't changed since it was last processed with the same settings can
+    reuse the derivatives instead of generating them again.
+    Each entry is a folder of files, named by role (e.g. the default derivative filename). The least recently used
+    entries are removed when the cache grows above its maximum size.
+
+    Safe to share between processes: entries are written to a temporary folder and renamed into place, and an entry
+    being removed while it is read counts as a miss.
+    Hit and miss counts are only for this instance.
+    """
+
+    def __init__(self, cache_folder, max_size_bytes=None, link_files=True):
+        """
+        :param cache_folder: folder to store the entries in. Created if it doesn't exist
+        :param max_size_bytes: if not None, remove least recently used entries once the cache is bigger than this
+        :param link_files: hard link cached files to their destinations instead of copying them, where possible.
+            Linked files share their contents with the cache, so must not be modified in place: remove them first
+            (see :func:`unlink_linked_files`), as the generators do before writing their derivatives
+        """
+        self.cache_folder = cache_folder
+        self.max_size_bytes = max_size_bytes
+        self.link_files = link_files
+        self.log = logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+
+    @property
+    def stats(self):
+        """
+        Hit, miss, store and eviction counts, and the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def get_key(self, source_filepath, settings):
+        """
+        Create a cache key from the contents of the source file and the settings that affect the derivatives
+
+        :param source_filepath:
+        :param settings: JSON serialisable dict of everything else that affects the derivatives, e.g. compression
+            options and tool versions
+        :return: hex digest
+        """
+        key_hash = hashlib.sha256()
+        key_hash.update(hash_file(source_filepath).encode('utf-8'))
+        key_hash.update(json.dumps({'version': CACHE_FORMAT_VERSION, 'settings': settings},
+                                   sort_keys=True).encode('utf-8'))
+        return key_hash.hexdigest()
+
+    def fetch(self, key, destination_filepaths):
+        """
+        Copy or link the cached files for the key to their destinations, if they are all in the cache
+
+        :param key: from :func:`get_key`
+        :param destination_filepaths: dict of role to destination filepath
+        :return: True if the files were in the cache, False otherwise
+        """
+        entry_folder = self._entry_folder(key)
+        try:
+            if not all(os.path.exists(os.path.join(entry_folder, role)) for role in destination_filepaths):
+                raise IOError(errno.ENOENT, 'Not in cache', entry_folder)
+            for role, destination_filepath in destination_filepaths.items():
+                self._place_file(os.path.join(entry_folder, role), destination_filepath)
+            # mark the entry as recently used
+            os.utime(entry_folder, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            self.log.debug('Cache miss for {0}'.format(key))
+            return False
+        self.hits += 1
+        self.log.debug('Cache hit for {0}'.format(key))
+        return True
+
+    def store(self, key, source_filepaths):
+        """
+        Add files to the cache, then remove least recently used entries if the cache is too big.
+        If there is already an entry for the key, it is kept
+
+        :param key: from :func:`get_key`
+        :param source_filepaths: dict of role to the filepath of the file to store
+        """
+        entry_folder = self._entry_folder(key)
+        if os.path.isdir(entry_folder):
+            return
+        if not os.path.isdir(os.path.dirname(entry_folder)):
+            try:
+                os.makedirs(os.path.dirname(entry_folder))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        temp_folder = tempfile.mkdtemp(prefix=_TEMP_PREFIX, dir=self.cache_folder)
+        try:
+            for role, source_filepath in source_filepaths.items():
+                # copied, so later changes to the derivatives can't change the cached files
+                shutil.copy(source_filepath, os.path.join(temp_folder, role))
+            os.rename(temp_folder, entry_folder)
+        except OSError as e:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            # another process may have stored the same entry first
+            if not os.path.isdir(entry_folder):
+                raise
+            return
+        self.stores += 1
+        self.log.debug('Stored {0} in cache'.format(key))
+        if self.max_size_bytes is not None:
+            self.evict(self.max_size_bytes)
+
+    def evict(self, max_size_bytes):
+        """
+        Remove least recently used entries until the cache is no bigger than max_size_bytes
+
+        :param max_size_bytes:
+        """
+        entries = self._list_entries()
+        total_size = sum(size for _, _, size in entries)
+        for _, entry_folder, size in sorted(entries):
+            if total_size <= max_size_bytes:
+                break
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            total_size -= size
+            self.evictions += 1
+            self.log.debug('Evicted {0} from cache'.format(os.path.basename(entry_folder)))
+
+    @property
+    def size_bytes(self):
+        """
+        Total size of the files in the cache
+        """
+        return sum(size for _, _, size in self._list_entries())
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        for _, entry_folder, _ in self._list_entries():
+            shutil.rmtree(entry_folder, ignore_errors=True)
+
+    def _entry_folder(self, key):
+        # entries are split into subfolders by the start of the key, to keep folders small
+        return os.path.join(self.cache_folder, key[:2], key)
+
+    def _list_entries(self):
+        """
+        :return: list of (last used time, entry folder, size in bytes) tuples
+        """
+        entries = []
+        for prefix in os.listdir(self.cache_folder):
+            prefix_folder = os.path.join(self.cache_folder, prefix)
+            if prefix.startswith(_TEMP_PREFIX) or not os.path.isdir(prefix_folder):
+                continue
+            for key in os.listdir(prefix_folder):
+                entry_folder = os.path.join(prefix_folder, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_folder, filename))
+                               for filename in os.listdir(entry_folder))
+                    entries.append((os.path.getmtime(entry_folder), entry_folder, size))
+                except OSError:
+                    # removed by another process
+                    continue
+        return entries
+
+    def _place_file(self, cached_filepath, destination_filepath):
+        if os.path.lexists(destination_filepath):
+            os.remove(destination_filepath)
+        if self.link_files:
+            try:
+                os.link(cached_filepath, destination_filepath)
+                return
+            except OSError as e:
+                # e.g. the cache is on a different filesystem
+                if e.errno == errno.ENOENT:
+                    raise
+        shutil.copy(cached_filepath, destination_filepath)
+
+
+def unlink_linked_files(filepaths):
+    """
+    Remove any of the files which are hard linked, e.g. to a cache entry by :func:`DerivativeCache.fetch`, so that
+    writing new files to the same paths can't change the other links' contents
+
+    :param filepaths: iterable of filepaths, which don't have to exist
+    """
+    for filepath in filepaths:
+        try:
+            if os.stat(filepath).st_nlink > 1:
+                os.remove(filepath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def hash_file(filepath, buffer_size=1048576):
+    """
+    sha256 hex digest of a file's contents
+
+    :param filepath:
+    :param buffer_size:
+    """
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        data = f.read(buffer_size)
+        while data:
+            file_hash.update(data)
+            data = f.read(buffer_size)
+    return file_hash.hexdigest()
@@ -2,29 +2,126 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import collections
 import io
+import math
 import subprocess
 import logging
+import tempfile
+import threading
 
 import os
 from PIL import Image, ImageCms
 
-from image_processing import utils
-from image_processing.exceptions import ImageProcessingError
+from image_processing import inspection, jp2, jpeg, memory, metrics, utils
+from image_processing.exceptions import ImageProcessingError, MemoryBudgetError
+from image_processing.exiftool import ExifToolPool, ExifToolProcess
 
 MAX_JPEG_DIMENSION = 65500
 
+DEFAULT_XMP_BATCH_SIZE = 500
+"""Most image files :func:`Converter.extract_xmp_to_sidecar_files` passes to one exiftool command"""
+
+# the JPEG metadata segments of this many source files are kept by each converter
+_JPG_METADATA_CACHE_SIZE = 16
+# size of the JPEG exiftool copies the metadata to, for the metadata segments of other JPEGs
+_JPG_METADATA_TEMPLATE_SIZE = (8, 8)
+# colour modes JPEG doesn't support, and the modes they are converted to
+_JPG_MODE_CONVERSIONS = {'RGBA': 'RGB', 'RGBX': 'RGB', 'I;16': 'RGB'}
+
+# map icc profile name to photoshop:ICCProfile
+_EXTRACT_XMP_OPTIONS = ['-all', '-ICC_Profile:ProfileDescription>ICCProfileName']
+
+THUMBNAIL_RESAMPLING_FILTERS = {
+    'lanczos': Image.Resampling.LANCZOS,
+    'bicubic': Image.Resampling.BICUBIC,
+    'hamming': Image.Resampling.HAMMING,
+    'bilinear': Image.Resampling.BILINEAR,
+    'box': Image.Resampling.BOX
+}
+"""Resampling filters for resizing JPEG thumbnails, from slowest and sharpest to fastest"""
+
+DEFAULT_THUMBNAIL_RESAMPLING = 'lanczos'
+DEFAULT_THUMBNAIL_REDUCING_GAP = 2.0
+"""Pillow's default for :func:`PIL.Image.Image.thumbnail`. The image is first shrunk by the largest whole number
+factor that leaves it at least this many times bigger than the thumbnail, using a fast box reduction, before the
+resampling filter is applied. Smaller values are faster but lower quality. None always resamples the full image.
+Only has an effect when shrinking by at least twice this value"""
+
+
+def get_thumbnail_size(image_size, thumbnail_size):
+    """
+    The size :func:`PIL.Image.Image.thumbnail` resizes an image to: the largest size that fits within thumbnail_size
+    and keeps the image's aspect ratio. Images are never enlarged
+
+    :param image_size: (width, height) of the image
+    :param thumbnail_size: (width, height) to fit within
+    """
+    width, height = image_size
+    x, y = (int(math.floor(i)) for i in thumbnail_size)
+    if x >= width and y >= height:
+        return image_size
+    aspect = width / height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def check_resampling_filter(resampling):
+    """
+    Raise a ValueError if resampling isn't one of :data:`THUMBNAIL_RESAMPLING_FILTERS`
+    """
+    if resampling not in THUMBNAIL_RESAMPLING_FILTERS:
+        raise ValueError('Unsupported resampling filter {0}. Available filters are {1}'
+                         .format(resampling, ', '.join(sorted(THUMBNAIL_RESAMPLING_FILTERS))))
+
+
+def get_jpg_colour_mode(colour_mode):
+    """
+    The Pillow colour mode an image in colour_mode is saved as JPEG in, as JPEG doesn't support some modes
+    """
+    return _JPG_MODE_CONVERSIONS.get(colour_mode, colour_mode)
+
+
 class Converter(object):
     """
     Convert TIFF to and from JPEG while preserving technical metadata and ICC profiles
     """
 
-    def __init__(self, exiftool_path='exiftool'):
+    def __init__(self, exiftool_path='exiftool', exiftool_pool_size=0, embed_jpg_metadata=True):
+        """
+        :param exiftool_path: path to the exiftool executable
+        :param exiftool_pool_size: if above 0, run exiftool commands on up to this many long-running exiftool
+            processes (see :class:`~image_processing.exiftool.ExifToolPool`) instead of starting a new process
+            for every command
+        :param embed_jpg_metadata: write the embedded metadata of JPEGs along with their pixels (see
+            :func:`get_jpg_metadata_segments`), so each JPEG is only written once. Otherwise exiftool copies the
+            metadata to each saved JPEG, rewriting it
+        """
         if not utils.cmd_is_executable(exiftool_path):
             raise OSError("Could not find executable {0}. Check exiftool is installed and exists at the configured path"
                           .format(exiftool_path))
         self.exiftool_path = exiftool_path
+        self.exiftool_pool = ExifToolPool(exiftool_path, size=exiftool_pool_size) if exiftool_pool_size else None
+        self.embed_jpg_metadata = embed_jpg_metadata
         self.logger = logging.getLogger(__name__)
+        self._exiftool_version = None
+        self._jpg_metadata_cache = collections.OrderedDict()
+        self._jpg_metadata_lock = threading.Lock()
+
+    def exiftool_version(self):
+        """
+        The version number of exiftool, from ``exiftool -ver``. Only run once per instance.
+        """
+        if self._exiftool_version is None:
+            self._exiftool_version = subprocess.check_output([self.exiftool_path, '-ver']).decode('utf-8').strip()
+        return self._exiftool_version
 
     def convert_to_tiff(self, input_filepath, output_filepath):
         """
@@ -37,39 +134,336 @@ class Converter(object):
             input_pil.save(output_filepath, "TIFF")
         self.copy_over_embedded_metadata(input_filepath, output_filepath)
 
-    def convert_to_jpg(self, input_filepath, output_filepath, resize=None, quality=None):
+    def convert_to_jpg(self, input_filepath, output_filepath, resize=None, quality=None, image_context=None,
+                       resampling=DEFAULT_THUMBNAIL_RESAMPLING, reducing_gap=DEFAULT_THUMBNAIL_REDUCING_GAP,
+                       thumbnail_size=None, memory_budget=None):
         """
         Convert an image file to JPEG, preserving ICC profile and embedded metadata
         :param input_filepath:
         :param output_filepath:
         :param resize: if present, resize by this amount to make a thumbnail. e.g. 0.5 to make a thumbnail half the size
         :param quality: quality of created jpg: either None, or 1-95
+        :param image_context: if not None, a :class:`~image_processing.validation.ImageContext` for the input file,
+            whose already decoded pixels are used instead of opening the file again
+        :param resampling: name of the filter used to resize, from :data:`THUMBNAIL_RESAMPLING_FILTERS`
+        :param reducing_gap: see :data:`DEFAULT_THUMBNAIL_REDUCING_GAP`
+        :param thumbnail_size: if present, resize to fit within this (width, height) instead of by the resize factor
+        :param memory_budget: if not None, a :class:`~image_processing.memory.MemoryBudget`. Images over it are
+            resized a strip at a time (see :func:`~image_processing.memory.resize_in_strips`). Defaults to the
+            image context's budget
         """
-        with Image.open(input_filepath) as input_pil:
-            icc_profile = input_pil.info.get('icc_profile')
-            if input_pil.mode in ['RGBA', 'RGBX']:
-                self.logger.warning(
-                    'Image is %s - the fourth channel will be removed from the JPEG derivative image', input_pil.mode)
-                input_pil = input_pil.convert(mode="RGB")
-            if input_pil.mode == 'I;16':
-                # JPEG doesn't support 16bit
-                self.logger.warning(
-                    'Image is 16bpp - will be downsampled to 8bpp')
-                input_pil = input_pil.convert(mode="RGB")
-
-            # libjpeg has a maximum dimension of 65,500, which is lower than the actual maximum jpeg dimension of 65,535
-            # JPEG2000 does not have the restriction
-            # if we're not already scaling the jpeg, then clamp the thumbnail to the max supported dimensions
-            if resize is None and MAX_JPEG_DIMENSION <= max(input_pil.size):
-                resize = 1.0
-            if resize:
-                thumbnail_size = tuple(min(int(i * resize), MAX_JPEG_DIMENSION) for i in input_pil.size)
-                input_pil.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
-            if quality:
-                input_pil.save(output_filepath, "JPEG", quality=quality, icc_profile=icc_profile)
+        check_resampling_filter(resampling)
+        metadata_segments = self._get_jpg_metadata_segments_for_file(input_filepath, image_context)
+        # includes decoding the input, unless the image context has already decoded it
+        with metrics.record_stage('jpg', input_filepaths=input_filepath, output_filepaths=output_filepath):
+            if self._needs_strips(input_filepath, image_context, memory_budget):
+                self._save_as_jpg_in_strips(input_filepath, output_filepath, resize, quality,
+                                            memory_budget or image_context.memory_budget, resampling=resampling,
+                                            reducing_gap=reducing_gap, thumbnail_size=thumbnail_size,
+                                            metadata_segments=metadata_segments)
+            elif image_context is not None:
+                self.save_pil_image_as_jpg(image_context.image, output_filepath, resize, quality,
+                                           is_shared_image=True, resampling=resampling, reducing_gap=reducing_gap,
+                                           thumbnail_size=thumbnail_size, metadata_segments=metadata_segments)
             else:
-                input_pil.save(output_filepath, "JPEG", icc_profile=icc_profile)
-        self.copy_over_embedded_metadata(input_filepath, output_filepath)
+                with Image.open(input_filepath) as input_pil:
+                    self.save_pil_image_as_jpg(input_pil, output_filepath, resize, quality, resampling=resampling,
+                                               reducing_gap=reducing_gap, thumbnail_size=thumbnail_size,
+                                               metadata_segments=metadata_segments)
+        if metadata_segments is None:
+            self.copy_over_embedded_metadata(input_filepath, output_filepath)
+
+    def _needs_strips(self, input_filepath, image_context, memory_budget):
+        """
+        Check whether the input has to be read in strips to stay within the memory budget, or the image context's
+        budget if memory_budget is None
+        """
+        if memory_budget is not None:
+            return memory_budget.needs_strips(input_filepath)
+        return image_context is not None and image_context.in_strips
+
+    def convert_pil_image_to_jpg(self, input_pil, output_filepath, metadata_filepath, resize=None, quality=None,
+                                 resampling=DEFAULT_THUMBNAIL_RESAMPLING, reducing_gap=DEFAULT_THUMBNAIL_REDUCING_GAP,
+                                 thumbnail_size=None, is_shared_image=False):
+        """
+        Save an already decoded image as JPEG, with the embedded metadata of another file, e.g. the file it was
+        decoded from. The ICC profile is taken from the image's info. See :func:`convert_to_jpg` for the options
+
+        :param input_pil: :class:`PIL.Image` instance
+        :param output_filepath:
+        :param metadata_filepath: file to copy the embedded metadata from
+        :param is_shared_image: if true, input_pil is used elsewhere, so is copied rather than resized in place
+        """
+        check_resampling_filter(resampling)
+        metadata_segments = None
+        if self.embed_jpg_metadata:
+            metadata_segments = self.get_jpg_metadata_segments(
+                metadata_filepath, get_jpg_colour_mode(input_pil.mode), input_pil.info.get('icc_profile'))
+        with metrics.record_stage('jpg', output_filepaths=output_filepath):
+            self.save_pil_image_as_jpg(input_pil, output_filepath, resize, quality, is_shared_image=is_shared_image,
+                                       resampling=resampling, reducing_gap=reducing_gap, thumbnail_size=thumbnail_size,
+                                       metadata_segments=metadata_segments)
+        if metadata_segments is None:
+            self.copy_over_embedded_metadata(metadata_filepath, output_filepath)
+
+    def save_pil_image_as_jpg(self, input_pil, output_filepath, resize=None, quality=None, is_shared_image=False,
+                              resampling=DEFAULT_THUMBNAIL_RESAMPLING, reducing_gap=DEFAULT_THUMBNAIL_REDUCING_GAP,
+                              thumbnail_size=None, metadata_segments=None):
+        """
+        Save an already decoded image as JPEG, without copying any embedded metadata with exiftool.
+        See :func:`convert_to_jpg` for the options
+
+        :param input_pil: :class:`PIL.Image` instance
+        :param output_filepath:
+        :param is_shared_image: if true, input_pil is used elsewhere, so is copied rather than resized in place
+        :param metadata_segments: if not None, JPEG metadata segments to write with the image. See
+            :func:`get_jpg_metadata_segments`
+        """
+        icc_profile = input_pil.info.get('icc_profile')
+        input_pil, is_shared_image = self._convert_mode_for_jpg(input_pil, is_shared_image)
+
+        # libjpeg has a maximum dimension of 65,500, which is lower than the actual maximum jpeg dimension of 65,535
+        # JPEG2000 does not have the restriction
+        # if we're not already scaling the jpeg, then clamp the thumbnail to the max supported dimensions
+        if resize is None and thumbnail_size is None and MAX_JPEG_DIMENSION <= max(input_pil.size):
+            resize = 1.0
+        if resize and thumbnail_size is None:
+            thumbnail_size = tuple(int(i * resize) for i in input_pil.size)
+        if thumbnail_size:
+            thumbnail_size = tuple(min(i, MAX_JPEG_DIMENSION) for i in thumbnail_size)
+            if is_shared_image:
+                input_pil = input_pil.copy()
+            input_pil.thumbnail(thumbnail_size, THUMBNAIL_RESAMPLING_FILTERS[resampling], reducing_gap=reducing_gap)
+        _save_jpg(input_pil, output_filepath, quality, icc_profile, metadata_segments=metadata_segments)
+
+    def _save_as_jpg_in_strips(self, input_filepath, output_filepath, resize, quality, memory_budget,
+                               resampling=DEFAULT_THUMBNAIL_RESAMPLING, reducing_gap=DEFAULT_THUMBNAIL_REDUCING_GAP,
+                               thumbnail_size=None, metadata_segments=None):
+        """
+        Resize the input a strip at a time, then save the resized image as JPEG.
+        Raises a :class:`~image_processing.exceptions.MemoryBudgetError` if the JPEG itself is over the budget
+        """
+        strip_reader = memory.StripReader(input_filepath)
+        jpg_size = self._get_jpg_size(strip_reader.size, resize, thumbnail_size)
+        jpg_mode = self._get_jpg_mode(strip_reader.mode)
+        memory_budget.check(jpg_mode or strip_reader.mode, jpg_size, 'The JPEG of {0}'.format(input_filepath))
+        self.logger.debug('{0} is over the memory budget, so resizing it in strips'.format(input_filepath))
+        jpg_pil = memory.resize_in_strips(strip_reader, jpg_size, THUMBNAIL_RESAMPLING_FILTERS[resampling],
+                                          reducing_gap=reducing_gap,
+                                          strip_height=memory_budget.strip_height(strip_reader.mode,
+                                                                                  strip_reader.size[0]),
+                                          colour_mode=jpg_mode)
+        _save_jpg(jpg_pil, output_filepath, quality, strip_reader.info.get('icc_profile'),
+                  metadata_segments=metadata_segments)
+
+    def _get_jpg_size(self, image_size, resize, thumbnail_size):
+        """
+        The size :func:`save_pil_image_as_jpg` saves an image of this size as
+        """
+        if resize is None and thumbnail_size is None and MAX_JPEG_DIMENSION <= max(image_size):
+            resize = 1.0
+        if resize and thumbnail_size is None:
+            thumbnail_size = tuple(int(i * resize) for i in image_size)
+        if not thumbnail_size:
+            return image_size
+        return get_thumbnail_size(image_size, tuple(min(i, MAX_JPEG_DIMENSION) for i in thumbnail_size))
+
+    def _convert_mode_for_jpg(self, input_pil, is_shared_image):
+        """
+        Convert colour modes JPEG doesn't support to RGB
+
+        :return: tuple of the image, and whether it is still the shared input image
+        """
+        jpg_mode = self._get_jpg_mode(input_pil.mode)
+        if jpg_mode is not None:
+            input_pil = input_pil.convert(mode=jpg_mode)
+            is_shared_image = False
+        return input_pil, is_shared_image
+
+    def _get_jpg_mode(self, colour_mode):
+        """
+        The colour mode to convert images JPEG doesn't support to, or None if they don't need converting
+        """
+        if colour_mode in ['RGBA', 'RGBX']:
+            self.logger.warning(
+                'Image is %s - the fourth channel will be removed from the JPEG derivative image', colour_mode)
+            return "RGB"
+        if colour_mode == 'I;16':
+            # JPEG doesn't support 16bit
+            self.logger.warning(
+                'Image is 16bpp - will be downsampled to 8bpp')
+            return "RGB"
+        return None
+
+    def convert_to_jpgs(self, input_filepath, jpg_outputs, image_context=None,
+                        resampling=DEFAULT_THUMBNAIL_RESAMPLING, reducing_gap=DEFAULT_THUMBNAIL_REDUCING_GAP,
+                        memory_budget=None):
+        """
+        Convert an image file to several JPEGs of different sizes, preserving ICC profile and embedded metadata.
+        The image is only decoded once. The JPEGs are resized in a cascade from the largest to the smallest, each from
+        the one before, so only the largest is resized from the full image. The embedded metadata is copied to all of
+        them with one exiftool command
+
+        :param input_filepath:
+        :param jpg_outputs: list of (output filepath, size, quality) tuples. size is the maximum width and height in
+            pixels, or None to keep the full size. quality is either None, or 1-95
+        :param image_context: if not None, a :class:`~image_processing.validation.ImageContext` for the input file,
+            whose already decoded pixels are used instead of opening the file again
+        :param resampling: name of the filter used to resize, from :data:`THUMBNAIL_RESAMPLING_FILTERS`
+        :param reducing_gap: see :data:`DEFAULT_THUMBNAIL_REDUCING_GAP`
+        :param memory_budget: if not None, a :class:`~image_processing.memory.MemoryBudget`. For images over it, the
+            largest JPEG is resized a strip at a time, and the others from that. Defaults to the image context's
+            budget
+        """
+        check_resampling_filter(resampling)
+        metadata_segments = self._get_jpg_metadata_segments_for_file(input_filepath, image_context)
+        with metrics.record_stage('jpg', input_filepaths=input_filepath,
+                                  output_filepaths=[output[0] for output in jpg_outputs]):
+            if self._needs_strips(input_filepath, image_context, memory_budget):
+                self._save_as_jpgs_in_strips(input_filepath, jpg_outputs,
+                                             memory_budget or image_context.memory_budget, resampling, reducing_gap,
+                                             metadata_segments=metadata_segments)
+            elif image_context is not None:
+                self.save_pil_image_as_jpgs(image_context.image, jpg_outputs, resampling, reducing_gap,
+                                            metadata_segments=metadata_segments)
+            else:
+                with Image.open(input_filepath) as input_pil:
+                    self.save_pil_image_as_jpgs(input_pil, jpg_outputs, resampling, reducing_gap,
+                                                metadata_segments=metadata_segments)
+        if metadata_segments is None:
+            self.copy_over_embedded_metadata_to_files(input_filepath, [output[0] for output in jpg_outputs])
+
+    def _save_as_jpgs_in_strips(self, input_filepath, jpg_outputs, memory_budget, resampling, reducing_gap,
+                                metadata_segments=None):
+        """
+        Resize the input to the largest JPEG a strip at a time, then make all the JPEGs from that.
+        Raises a :class:`~image_processing.exceptions.MemoryBudgetError` if the largest JPEG is over the budget
+        """
+        strip_reader = memory.StripReader(input_filepath)
+        largest_size = max(MAX_JPEG_DIMENSION if output[1] is None else min(output[1], MAX_JPEG_DIMENSION)
+                           for output in jpg_outputs)
+        largest_jpg_size = get_thumbnail_size(strip_reader.size, (largest_size, largest_size))
+        jpg_mode = self._get_jpg_mode(strip_reader.mode)
+        memory_budget.check(jpg_mode or strip_reader.mode, largest_jpg_size,
+                            'The largest JPEG of {0}'.format(input_filepath))
+        self.logger.debug('{0} is over the memory budget, so resizing it in strips'.format(input_filepath))
+        largest_jpg_pil = memory.resize_in_strips(strip_reader, largest_jpg_size,
+                                                  THUMBNAIL_RESAMPLING_FILTERS[resampling], reducing_gap=reducing_gap,
+                                                  strip_height=memory_budget.strip_height(strip_reader.mode,
+                                                                                          strip_reader.size[0]),
+                                                  colour_mode=jpg_mode)
+        largest_jpg_pil.info = strip_reader.info
+        self.save_pil_image_as_jpgs(largest_jpg_pil, jpg_outputs, resampling, reducing_gap,
+                                    full_size=strip_reader.size, metadata_segments=metadata_segments)
+
+    def save_pil_image_as_jpgs(self, input_pil, jpg_outputs, resampling=DEFAULT_THUMBNAIL_RESAMPLING,
+                               reducing_gap=DEFAULT_THUMBNAIL_REDUCING_GAP, full_size=None, metadata_segments=None):
+        """
+        Save an already decoded image as several JPEGs, without copying any embedded metadata with exiftool.
+        See :func:`convert_to_jpgs` for the options
+
+        :param input_pil: :class:`PIL.Image` instance
+        :param jpg_outputs:
+        :param full_size: size of the original image, if input_pil has already been resized
+        :param metadata_segments: see :func:`save_pil_image_as_jpg`
+        """
+        icc_profile = input_pil.info.get('icc_profile')
+        # resize never changes the image in place, so a shared image doesn't need to be copied
+        input_pil, _ = self._convert_mode_for_jpg(input_pil, is_shared_image=True)
+        full_size = full_size or input_pil.size
+        resized_pil = input_pil
+        for output_filepath, size, quality in sorted(
+                jpg_outputs, key=lambda output: MAX_JPEG_DIMENSION if output[1] is None else output[1], reverse=True):
+            # sizes are worked out from the full image, so they match JPEGs resized from it directly
+            max_size = MAX_JPEG_DIMENSION if size is None else min(size, MAX_JPEG_DIMENSION)
+            jpg_size = get_thumbnail_size(full_size, (max_size, max_size))
+            if jpg_size != resized_pil.size:
+                resized_pil = resized_pil.resize(jpg_size, THUMBNAIL_RESAMPLING_FILTERS[resampling],
+                                                 reducing_gap=reducing_gap)
+            _save_jpg(resized_pil, output_filepath, quality, icc_profile, metadata_segments=metadata_segments)
+            self.logger.debug('jpeg file {0} generated at {1}'.format(output_filepath, jpg_size))
+
+    def get_jpg_metadata_segments(self, metadata_filepath, colour_mode, icc_profile):
+        """
+        Build the metadata segments (EXIF, XMP, IPTC etc.) of a JPEG with the embedded metadata of another file.
+        Exiftool copies the metadata to a tiny JPEG saved with the same colour mode and ICC profile, so its segments
+        are the ones exiftool would write to the JPEG itself, and the JPEG can be written once with them rather than
+        being rewritten by exiftool. The segments of the last few files are cached, so JPEGs of several sizes only
+        need one exiftool command
+
+        :param metadata_filepath: file to copy the embedded metadata from
+        :param colour_mode: Pillow colour mode the JPEG is saved in
+        :param icc_profile: ICC profile of the JPEG, or None
+        :return: the segments as bytes. See :func:`~image_processing.jpeg.write_with_metadata_segments`
+        """
+        metadata_segments = self.get_cached_jpg_metadata_segments(metadata_filepath, colour_mode, icc_profile)
+        if metadata_segments is None:
+            with tempfile.TemporaryDirectory(prefix='image-processing_') as temp_folder:
+                template_filepath = self.write_jpg_metadata_template(temp_folder, colour_mode, icc_profile)
+                self.copy_over_embedded_metadata(metadata_filepath, template_filepath)
+                metadata_segments = self.cache_jpg_metadata_segments(metadata_filepath, colour_mode, icc_profile,
+                                                                     template_filepath)
+        return metadata_segments
+
+    def _get_jpg_metadata_segments_for_file(self, input_filepath, image_context):
+        """
+        The metadata segments for JPEGs of an image file, or None if embed_jpg_metadata isn't set.
+        The colour mode and ICC profile are read from the image context, or else the file's headers
+        """
+        if not self.embed_jpg_metadata:
+            return None
+        if image_context is None:
+            image_context = inspection.inspect_image(input_filepath)
+        return self.get_jpg_metadata_segments(input_filepath,
+                                              get_jpg_colour_mode(image_context.mode), image_context.icc_profile)
+
+    def _get_jpg_metadata_cache_key(self, metadata_filepath, colour_mode, icc_profile):
+        file_stat = os.stat(metadata_filepath)
+        return (os.path.abspath(metadata_filepath), file_stat.st_size, file_stat.st_mtime_ns, colour_mode,
+                icc_profile)
+
+    def get_cached_jpg_metadata_segments(self, metadata_filepath, colour_mode, icc_profile):
+        """
+        The cached metadata segments from :func:`get_jpg_metadata_segments`, or None if they aren't cached
+
+        :param metadata_filepath: file to copy the embedded metadata from
+        :param colour_mode: Pillow colour mode the JPEG is saved in
+        :param icc_profile: ICC profile of the JPEG, or None
+        """
+        cache_key = self._get_jpg_metadata_cache_key(metadata_filepath, colour_mode, icc_profile)
+        with self._jpg_metadata_lock:
+            metadata_segments = self._jpg_metadata_cache.get(cache_key)
+            if metadata_segments is not None:
+                self._jpg_metadata_cache.move_to_end(cache_key)
+            return metadata_segments
+
+    def cache_jpg_metadata_segments(self, metadata_filepath, colour_mode, icc_profile, template_filepath):
+        """
+        Read the metadata segments of the template JPEG exiftool copied the metadata to, and cache them.
+        See :func:`get_jpg_metadata_segments` for the other parameters
+
+        :param template_filepath: from :func:`write_jpg_metadata_template`
+        :return: the segments as bytes
+        """
+        cache_key = self._get_jpg_metadata_cache_key(metadata_filepath, colour_mode, icc_profile)
+        with open(template_filepath, 'rb') as template_file:
+            metadata_segments = jpeg.get_metadata_segments(template_file.read())
+        with self._jpg_metadata_lock:
+            self._jpg_metadata_cache[cache_key] = metadata_segments
+            while len(self._jpg_metadata_cache) > _JPG_METADATA_CACHE_SIZE:
+                self._jpg_metadata_cache.popitem(last=False)
+        return metadata_segments
+
+    def write_jpg_metadata_template(self, output_folder, colour_mode, icc_profile):
+        """
+        Save a tiny JPEG with the same metadata segments Pillow writes for a JPEG with this colour mode and ICC profile,
+        for exiftool to copy the embedded metadata to
+
+        :return: the template's filepath
+        """
+        template_filepath = os.path.join(output_folder, 'metadata.jpg')
+        _save_jpg(Image.new(colour_mode, _JPG_METADATA_TEMPLATE_SIZE), template_filepath, None, icc_profile)
+        return template_filepath
 
     def copy_over_embedded_metadata(self, input_image_filepath, output_image_filepath, write_only_xmp=False):
         """
@@ -78,27 +472,111 @@ class Converter(object):
         :param output_image_filepath: output filepath
         :param write_only_xmp: Copy all information to the same-named tags in XMP (if they exist). With JP2 it's safest to only use xmp tags, as other ones may not be supported by all software
         """
+        self.copy_over_embedded_metadata_to_files(input_image_filepath, [output_image_filepath],
+                                                  write_only_xmp=write_only_xmp)
+
+    def copy_over_embedded_metadata_to_files(self, input_image_filepath, output_image_filepaths,
+                                             write_only_xmp=False):
+        """
+        Copy embedded image metadata from the input_image_filepath to each of the output_image_filepaths, with a
+        single exiftool command
+        :param input_image_filepath: input filepath
+        :param output_image_filepaths: list of output filepaths
+        :param write_only_xmp: see :func:`copy_over_embedded_metadata`
+        """
+        command_options = self.get_copy_metadata_options(input_image_filepath, output_image_filepaths,
+                                                         write_only_xmp=write_only_xmp)
+        try:
+            with metrics.record_stage('metadata_copy', output_filepaths=output_image_filepaths):
+                self.run_exiftool(command_options)
+        except subprocess.CalledProcessError as e:
+            self.raise_copy_metadata_error(input_image_filepath, e)
+
+    def get_copy_metadata_options(self, input_image_filepath, output_image_filepaths, write_only_xmp=False):
+        """
+        Check the files can be accessed, and build the exiftool arguments for
+        :func:`copy_over_embedded_metadata_to_files`
+        """
         if not os.access(input_image_filepath, os.R_OK):
             raise IOError("Could not read input image path {0}".format(input_image_filepath))
-        if not os.access(output_image_filepath, os.W_OK):
-            raise IOError("Could not write to output path {0}".format(output_image_filepath))
+        for output_image_filepath in output_image_filepaths:
+            if not os.access(output_image_filepath, os.W_OK):
+                raise IOError("Could not write to output path {0}".format(output_image_filepath))
 
-        command_options = [self.exiftool_path, '-tagsFromFile', input_image_filepath, '-overwrite_original']
+        command_options = ['-tagsFromFile', input_image_filepath, '-overwrite_original']
         if write_only_xmp:
             command_options += ['-xmp:all<all']
-        command_options += [output_image_filepath]
-        self.logger.debug(' '.join(command_options))
-        try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise ImageProcessingError('Exiftool at {0} failed to copy from {1}. Command: {2}, Error: {3}'.
-                                       format(self.exiftool_path, input_image_filepath, ' '.join(command_options), e))
+        return command_options + list(output_image_filepaths)
+
+    def raise_copy_metadata_error(self, input_image_filepath, error):
+        raise ImageProcessingError('Exiftool at {0} failed to copy from {1}. Command: {2}, Error: {3}'.
+                                   format(self.exiftool_path, input_image_filepath, ' '.join(error.cmd), error))
+
+    def copy_over_xmp_to_jp2(self, input_image_filepath, jp2_filepath):
+        """
+        Copy embedded image metadata from the input_image_filepath to XMP in a JP2, like
+        :func:`copy_over_embedded_metadata` with write_only_xmp. Exiftool only writes the XMP packet to a temporary
+        file, which is appended to the JP2 as a UUID box (see :func:`~image_processing.jp2.append_xmp_box`), so the
+        JP2 isn't parsed and rewritten by exiftool. If the box can't be appended, exiftool rewrites the JP2 instead
+        :param input_image_filepath: input filepath
+        :param jp2_filepath: output JP2 filepath
+        """
+        with tempfile.TemporaryDirectory(prefix='image-processing_') as temp_folder:
+            xmp_filepath = os.path.join(temp_folder, 'metadata.xmp')
+            command_options = self.get_xmp_packet_options(input_image_filepath, jp2_filepath, xmp_filepath)
+            with metrics.record_stage('metadata_copy', output_filepaths=jp2_filepath):
+                try:
+                    self.run_exiftool(command_options)
+                except subprocess.CalledProcessError as e:
+                    self.raise_copy_metadata_error(input_image_filepath, e)
+                appended = self.append_xmp_packet_to_jp2(xmp_filepath, jp2_filepath)
+        if not appended:
+            self.copy_over_embedded_metadata(input_image_filepath, jp2_filepath, write_only_xmp=True)
+
+    def get_xmp_packet_options(self, input_image_filepath, jp2_filepath, xmp_filepath):
+        """
+        Check the files can be accessed, and build the exiftool arguments to write the XMP packet for
+        :func:`copy_over_xmp_to_jp2` to xmp_filepath, which must not exist already
+        """
+        if not os.access(input_image_filepath, os.R_OK):
+            raise IOError("Could not read input image path {0}".format(input_image_filepath))
+        if not os.access(jp2_filepath, os.W_OK):
+            raise IOError("Could not write to output path {0}".format(jp2_filepath))
+        return ['-tagsFromFile', input_image_filepath, '-xmp:all<all', '-o', xmp_filepath]
+
+    def append_xmp_packet_to_jp2(self, xmp_filepath, jp2_filepath):
+        """
+        Append the XMP packet written by exiftool for :func:`copy_over_xmp_to_jp2` to the JP2
+
+        :return: False if the JP2 has to be rewritten to add it
+        """
+        if not os.path.isfile(xmp_filepath):
+            # exiftool found no metadata to copy
+            return True
+        with open(xmp_filepath, 'rb') as xmp_file:
+            xmp_packet = xmp_file.read()
+        if jp2.append_xmp_box(jp2_filepath, xmp_packet):
+            return True
+        self.logger.debug('Could not append the XMP packet to {0}, so rewriting it with exiftool'.format(jp2_filepath))
+        return False
 
     def extract_xmp_to_sidecar_file(self, image_filepath, output_xmp_filepath):
         """
         Extract embedded image metadata from the image_filepath to an xmp file.
         Includes the ICC profile description.
         """
+        command_options = self.get_extract_xmp_options(image_filepath, output_xmp_filepath)
+        try:
+            with metrics.record_stage('xmp', output_filepaths=output_xmp_filepath):
+                self.run_exiftool(command_options)
+        except subprocess.CalledProcessError as e:
+            self.raise_extract_xmp_error(image_filepath, e)
+
+    def get_extract_xmp_options(self, image_filepath, output_xmp_filepath):
+        """
+        Check the files can be accessed, remove any existing output file, and build the exiftool arguments for
+        :func:`extract_xmp_to_sidecar_file`
+        """
         if os.path.isfile(output_xmp_filepath):
             os.remove(output_xmp_filepath)
         if not os.access(image_filepath, os.R_OK):
@@ -108,18 +586,117 @@ class Converter(object):
         if not os.path.splitext(output_xmp_filepath)[1] == ".xmp":
             raise IOError("XMP output file {0} needs an xmp extension".format(output_xmp_filepath))
 
-        command_options = [self.exiftool_path, '-tagsFromFile', image_filepath, '-all',
-                           '-ICC_Profile:ProfileDescription>ICCProfileName',  # map icc profile name to photoshop:ICCProfile
-                           '-o', output_xmp_filepath]  # must not exist already
+        command_options = ['-tagsFromFile', image_filepath] + _EXTRACT_XMP_OPTIONS + \
+                          ['-o', output_xmp_filepath]  # must not exist already
+        return command_options
+
+    def extract_xmp_to_sidecar_files(self, xmp_jobs, batch_size=DEFAULT_XMP_BATCH_SIZE):
+        """
+        Extract embedded image metadata from many image files to xmp files, like :func:`extract_xmp_to_sidecar_file`,
+        with as few exiftool commands as possible, all run on one long-running exiftool process (or the exiftool pool,
+        if one is configured).
+
+        Sidecars named after their image file (e.g. ``a.tif`` to ``a.xmp``) are extracted batch_size at a time for
+        each output folder, with an exiftool output pattern. Others need a command each.
+        A failure in one file does not stop the others: check the results.
 
-        self.logger.debug(' '.join(command_options))
+        :param xmp_jobs: iterable of (image filepath, output xmp filepath) pairs
+        :param batch_size: most image files in one exiftool command
+        :return: list of :class:`XmpSidecarResult`, in the same order as xmp_jobs
+        """
+        results = []
+        batches = {}
+        single_jobs = []
+        output_xmp_filepaths = set()
+        for image_filepath, output_xmp_filepath in xmp_jobs:
+            result = XmpSidecarResult(image_filepath, output_xmp_filepath)
+            results.append(result)
+            output_folder, output_filename = os.path.split(os.path.abspath(output_xmp_filepath))
+            if os.path.join(output_folder, output_filename) in output_xmp_filepaths:
+                result.error = 'XMP output file {0} is also the output of an earlier image file'.format(
+                    output_xmp_filepath)
+                continue
+            try:
+                self.get_extract_xmp_options(image_filepath, output_xmp_filepath)
+            except IOError as e:
+                result.error = str(e)
+                continue
+            output_xmp_filepaths.add(os.path.join(output_folder, output_filename))
+            image_name = os.path.splitext(os.path.basename(image_filepath))[0]
+            if output_filename == image_name + '.xmp' and not image_filepath.startswith('-'):
+                batches.setdefault(output_folder, []).append(result)
+            else:
+                single_jobs.append(result)
+
+        commands = []
+        for output_folder, batch_results in batches.items():
+            # exiftool replaces %f with the name of each image file, without its extension
+            output_pattern = os.path.join(output_folder.replace('%', '%%'), '%f.xmp')
+            for start in range(0, len(batch_results), batch_size):
+                chunk = batch_results[start:start + batch_size]
+                commands.append((['-tagsFromFile', '@'] + _EXTRACT_XMP_OPTIONS + ['-o', output_pattern] +
+                                 [result.image_filepath for result in chunk], chunk))
+        for result in single_jobs:
+            commands.append((self.get_extract_xmp_options(result.image_filepath, result.output_xmp_filepath),
+                             [result]))
+
+        exiftool_process = None if self.exiftool_pool else ExifToolProcess(self.exiftool_path)
         try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise ImageProcessingError('Exiftool at {0} failed to extract metadata from {1}. Command: {2}, Error: {3}'.
-                                       format(self.exiftool_path, image_filepath, ' '.join(command_options), e))
+            with metrics.record_stage('xmp', output_filepaths=[result.output_xmp_filepath for result in results
+                                                               if result.error is None]):
+                for command_options, command_results in commands:
+                    self._extract_xmp_batch(exiftool_process, command_options, command_results)
+        finally:
+            if exiftool_process is not None:
+                exiftool_process.stop()
+        failures = [result for result in results if not result.success]
+        self.logger.debug('Extracted {0} of {1} xmp files'.format(len(results) - len(failures), len(results)))
+        for result in failures:
+            self.logger.error('Failed to extract xmp from {0}: {1}'.format(result.image_filepath, result.error))
+        return results
+
+    def _extract_xmp_batch(self, exiftool_process, command_options, command_results):
+        """
+        Run one exiftool command extracting xmp files, and record which of them were created
+        """
+        self.logger.debug(' '.join([self.exiftool_path] + command_options))
+        try:
+            if exiftool_process is None:
+                output = self.exiftool_pool.execute(command_options)
+            else:
+                output = exiftool_process.execute(command_options)
+        except (subprocess.CalledProcessError, ImageProcessingError) as e:
+            output = getattr(e, 'output', None) or str(e)
+        output_lines = output.splitlines()
+        for result in command_results:
+            if os.path.isfile(result.output_xmp_filepath):
+                continue
+            # exiftool reports errors with the filepath at the end of the line
+            error_lines = [line.strip() for line in output_lines if line.rstrip().endswith(result.image_filepath)]
+            result.error = 'Exiftool at {0} failed to extract metadata from {1}: {2}'.format(
+                self.exiftool_path, result.image_filepath,
+                '; '.join(error_lines) or 'no xmp file was created')
+
+    def raise_extract_xmp_error(self, image_filepath, error):
+        raise ImageProcessingError('Exiftool at {0} failed to extract metadata from {1}. Command: {2}, Error: {3}'.
+                                   format(self.exiftool_path, image_filepath, ' '.join(error.cmd), error))
+
+    def run_exiftool(self, command_options):
+        """
+        Run exiftool, either as a new process or on the exiftool pool if one is configured.
+        Raises :class:`subprocess.CalledProcessError` if exiftool fails
+
+        :param command_options: exiftool command line arguments, not including the executable
+        """
+        self.logger.debug(' '.join([self.exiftool_path] + command_options))
+        if self.exiftool_pool:
+            output = self.exiftool_pool.execute(command_options)
+            self.logger.debug(output.strip())
+        else:
+            subprocess.check_call([self.exiftool_path] + command_options, stderr=subprocess.STDOUT)
 
-    def convert_icc_profile(self, image_filepath, output_filepath, icc_profile_filepath, new_colour_mode=None):
+    def convert_icc_profile(self, image_filepath, output_filepath, icc_profile_filepath, new_colour_mode=None,
+                            memory_budget=None):
         """
         Convert the image to a new icc profile. This is lossy, so should only be done when necessary (e.g. if jp2 doesn't support the colour profile)
         Doesn't support 16bit images due to limitations of Pillow
@@ -131,6 +708,8 @@ class Converter(object):
         :param output_filepath:
         :param icc_profile_filepath:
         :param new_colour_mode:
+        :param memory_budget: if not None, a :class:`~image_processing.memory.MemoryBudget`. Images over it are
+            converted and written a strip at a time, and output_filepath must be a TIFF
         :return:
         """
         with Image.open(image_filepath) as input_pil:
@@ -148,8 +727,77 @@ class Converter(object):
                 raise ImageProcessingError("Image doesn't have a profile")
 
             input_profile = ImageCms.getOpenProfile(io.BytesIO(input_icc_obj))
-            output_pil = ImageCms.profileToProfile(input_pil, input_profile, icc_profile_filepath,
-                                                   renderingIntent=ImageCms.Intent.PERCEPTUAL,
-                                                   outputMode=new_colour_mode, inPlace=0)
-            output_pil.save(output_filepath)
+            if memory_budget is not None and memory_budget.needs_strips(image_filepath, input_pil):
+                self._convert_icc_profile_in_strips(image_filepath, output_filepath, input_profile,
+                                                    icc_profile_filepath, new_colour_mode, memory_budget)
+            else:
+                output_pil = ImageCms.profileToProfile(input_pil, input_profile, icc_profile_filepath,
+                                                       renderingIntent=ImageCms.Intent.PERCEPTUAL,
+                                                       outputMode=new_colour_mode, inPlace=0)
+                output_pil.save(output_filepath)
         self.copy_over_embedded_metadata(image_filepath, output_filepath)
+
+    def _convert_icc_profile_in_strips(self, image_filepath, output_filepath, input_profile, icc_profile_filepath,
+                                       new_colour_mode, memory_budget):
+        """
+        Convert the ICC profile of each strip of the image, writing them to an uncompressed TIFF as they are made
+        """
+        if os.path.splitext(output_filepath)[1].lower() not in ['.tif', '.tiff']:
+            raise MemoryBudgetError('{0} is over the memory budget, so can only be converted to a TIFF, not {1}'
+                                    .format(image_filepath, output_filepath))
+        strip_reader = memory.StripReader(image_filepath)
+        output_mode = new_colour_mode or strip_reader.mode
+        transform = ImageCms.buildTransform(input_profile, icc_profile_filepath, strip_reader.mode, output_mode,
+                                            renderingIntent=ImageCms.Intent.PERCEPTUAL)
+        self.logger.debug('{0} is over the memory budget, so converting its ICC profile in strips'
+                          .format(image_filepath))
+        strips = (ImageCms.applyTransform(strip, transform)
+                  for _, strip in strip_reader.iter_strips(memory_budget.strip_height(strip_reader.mode,
+                                                                                      strip_reader.size[0])))
+        memory.write_tiff_in_strips(output_filepath, output_mode, strip_reader.size, strips,
+                                    icc_profile=transform.output_profile.tobytes())
+
+
+class XmpSidecarResult(object):
+    """
+    The outcome of extracting the xmp sidecar of one image file with
+    :func:`Converter.extract_xmp_to_sidecar_files`
+    """
+
+    def __init__(self, image_filepath, output_xmp_filepath, error=None):
+        """
+        :param image_filepath:
+        :param output_xmp_filepath:
+        :param error: description of the error, if the sidecar wasn't extracted
+        """
+        self.image_filepath = image_filepath
+        self.output_xmp_filepath = output_xmp_filepath
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            'image_filepath': self.image_filepath,
+            'output_xmp_filepath': self.output_xmp_filepath,
+            'error': self.error
+        }
+
+
+def _save_jpg(image_pil, output_filepath, quality, icc_profile, metadata_segments=None):
+    """
+    :param metadata_segments: if not None, replace the metadata segments Pillow writes with these as the JPEG is
+        written, so the file is only written once. Only the JPEG's header is held in memory
+    """
+    save_options = {'icc_profile': icc_profile}
+    if quality:
+        save_options['quality'] = quality
+    if metadata_segments is None:
+        image_pil.save(output_filepath, "JPEG", **save_options)
+        return
+    with open(output_filepath, 'wb') as jpg_file:
+        jpg_writer = jpeg.MetadataSegmentsWriter(jpg_file, metadata_segments)
+        image_pil.save(jpg_writer, "JPEG", **save_options)
+        jpg_writer.finish()
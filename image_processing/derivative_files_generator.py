@@ -3,13 +3,19 @@ from __future__ import print_function
 from __future__ import division
 
 import errno
+import functools
+import math
 import os
 import shutil
 import logging
 import tempfile
+from concurrent import futures
+from contextlib import contextmanager
 
-from image_processing import conversion, validation, kakadu
+from image_processing import conversion, validation, kakadu, jp2, memory, metrics
+from image_processing.cache import unlink_linked_files
 from image_processing.kakadu import Kakadu
+from image_processing.manifest import DerivativeManifest
 from PIL import Image
 
 DEFAULT_TIFF_FILENAME = 'full.tiff'
@@ -17,6 +23,7 @@ DEFAULT_EMBEDDED_METADATA_FILENAME = 'full.xmp'
 DEFAULT_JPG_FILENAME = 'full.jpg'
 DEFAULT_LOSSLESS_JP2_FILENAME = 'full_lossless.jp2'
 DEFAULT_JPYLYZER_XML_FILENAME = 'full_lossless.jp2.jpylyzer.xml'
+DEFAULT_MANIFEST_FILENAME = 'full.manifest.json'
 
 DEFAULT_JPG_THUMBNAIL_RESIZE_VALUE = 0.6
 DEFAULT_JPG_HIGH_QUALITY_VALUE = 92
@@ -25,6 +32,32 @@ DEFAULT_EXIFTOOL_PATH = "exiftool"
 DEFAULT_KAKADU_BASE_PATH = ""
 
 
+class JpgDerivativeSpec(object):
+    """
+    An extra JPEG derivative to generate from each TIFF, e.g. one size of a ladder of access copies for a IIIF
+    image server
+    """
+
+    def __init__(self, size, filename, quality=None):
+        """
+        :param size: maximum width and height in pixels, e.g. 1200 for a 1200px long edge. Images are never enlarged.
+            None keeps the full size
+        :param filename: filename in the output folder. Used as given, whatever use_default_filenames is set to
+        :param quality: quality of the jpg: either None, or 1-95
+        """
+        if size is not None and size < 1:
+            raise ValueError('Invalid size {0} for jpg derivative {1}'.format(size, filename))
+        if os.path.splitext(filename)[1].lower() not in ['.jpg', '.jpeg']:
+            raise ValueError('Jpg derivative filename {0} needs a jpg extension'.format(filename))
+        self.size = size
+        self.filename = filename
+        self.quality = quality
+
+    def __repr__(self):
+        return 'JpgDerivativeSpec(size={0!r}, filename={1!r}, quality={2!r})'.format(self.size, self.filename,
+                                                                                    self.quality)
+
+
 class DerivativeFilesGenerator(object):
     """
     Given a source image file, generates the derivative files (preservation/display image formats, 
@@ -38,7 +71,23 @@ class DerivativeFilesGenerator(object):
                  use_default_filenames=True,
                  require_icc_profile_for_greyscale=False,
                  require_icc_profile_for_colour=True,
-                 exiftool_path=DEFAULT_EXIFTOOL_PATH):
+                 exiftool_path=DEFAULT_EXIFTOOL_PATH,
+                 exiftool_pool_size=0,
+                 stream_lossless_check=False,
+                 pixel_checksum_options=None,
+                 cache=None,
+                 incremental=False,
+                 jpg_thumbnail_resampling=conversion.DEFAULT_THUMBNAIL_RESAMPLING,
+                 jpg_thumbnail_reducing_gap=conversion.DEFAULT_THUMBNAIL_REDUCING_GAP,
+                 jpg_from_jp2=False,
+                 jpg_derivative_specs=None,
+                 kakadu_num_threads=None,
+                 kakadu_double_buffering=None,
+                 kakadu_report_cpu=False,
+                 pipeline_stages=True,
+                 metrics_sinks=None,
+                 memory_budget_bytes=None,
+                 append_jp2_xmp=True):
         """
 
         :param kakadu_base_path: the location of the kdu_compress and kdu_expand executables
@@ -50,22 +99,78 @@ class DerivativeFilesGenerator(object):
             Note: bitonal images do not need ICC profiles even if this is true
         :param require_icc_profile_for_colour: raise an error if a colour image does not have an ICC profile
         :param exiftool_path: path to the exiftool executable
+        :param exiftool_pool_size: if above 0, keep this many exiftool processes running between files instead of
+            starting exiftool for every metadata operation. See :class:`~image_processing.exiftool.ExifToolPool`
+        :param stream_lossless_check: check 8 bit RGB and greyscale conversions were lossless by streaming the
+            expanded pixels from kdu_expand, instead of writing them to a temporary TIFF first
+        :param pixel_checksum_options: keyword arguments for
+            :func:`~image_processing.validation.generate_pixel_checksum`, to choose the hash algorithm and whether to
+            hash in parallel for the lossless check. Defaults to serial sha256
+        :param cache: if not None, a :class:`~image_processing.cache.DerivativeCache`. Derivatives of TIFFs are
+            reused from it if the source file and settings haven't changed, and stored in it when generated
+        :param incremental: write a manifest of the source file and derivatives to the output folder
+            (see :class:`~image_processing.manifest.DerivativeManifest`), and on re-runs only generate the
+            derivatives which are missing, have changed, or would be generated with different parameters
+        :param jpg_thumbnail_resampling: filter used to resize JPEG thumbnails. See
+            :data:`~image_processing.conversion.THUMBNAIL_RESAMPLING_FILTERS`
+        :param jpg_thumbnail_reducing_gap: how early to use fast box reduction when resizing JPEG thumbnails. See
+            :data:`~image_processing.conversion.DEFAULT_THUMBNAIL_REDUCING_GAP`
+        :param jpg_from_jp2: create JPEG thumbnails of 8 bit RGB and greyscale TIFFs from a reduced resolution level
+            of the JP2 (see :func:`generate_jpg_from_jp2`), when the thumbnail is at most half the size of the image.
+            Only a fraction of the pixels are decoded, and only a small final resize is needed
+        :param jpg_derivative_specs: list of :class:`JpgDerivativeSpec` for extra JPEG sizes to generate from TIFFs,
+            alongside the main JPEG. They are all made from the same decoded image, resized in a cascade from the
+            largest to the smallest (see :func:`~image_processing.conversion.Converter.convert_to_jpgs`)
+        :param kakadu_num_threads: threads for each kakadu command, or 0 for single threaded. None uses one per CPU.
+            See :class:`~image_processing.kakadu.Kakadu`
+        :param kakadu_double_buffering: ``-double_buffering`` stripe height for kakadu commands. None uses kakadu's
+            default
+        :param kakadu_report_cpu: record kakadu's ``-cpu`` timings for each command. See
+            :func:`~image_processing.kakadu.Kakadu.pop_metrics`
+        :param pipeline_stages: run the stages of generate_derivatives_from_tiff which don't depend on each other
+            concurrently: JPEG encoding and the lossless check's checksum, XMP extraction, the TIFF copy, and
+            kdu_compress followed by the JP2 validation. If false, they run one after another
+        :param metrics_sinks: list of :class:`~image_processing.metrics.MetricsSink` to write the
+            :class:`~image_processing.metrics.StageMetrics` of each source file to
+        :param memory_budget_bytes: if not None, the most memory to use for the decoded pixels of a TIFF (see
+            :class:`~image_processing.memory.MemoryBudget`). Uncompressed TIFFs over it are checksummed and resized
+            a strip at a time, and others raise a :class:`~image_processing.exceptions.MemoryBudgetError` before any
+            derivatives are generated. The full size JPEG (create_jpg_as_thumbnail=False) of a TIFF over the budget
+            is also rejected, as it can't be made in strips
+        :param append_jp2_xmp: append the XMP metadata to the end of the JP2 (see
+            :func:`~image_processing.conversion.Converter.copy_over_xmp_to_jp2`), rather than having exiftool rewrite
+            the whole JP2 to add it
         """
 
         self.jpg_high_quality_value = jpg_high_quality_value
         self.jpg_thumbnail_resize_value = jpg_thumbnail_resize_value
+        self.jpg_thumbnail_resampling = jpg_thumbnail_resampling
+        self.jpg_thumbnail_reducing_gap = jpg_thumbnail_reducing_gap
+        self.jpg_from_jp2 = jpg_from_jp2
+        self.jpg_derivative_specs = list(jpg_derivative_specs or [])
+        _check_jpg_derivative_filenames(self.jpg_derivative_specs)
         self.require_icc_profile_for_greyscale = require_icc_profile_for_greyscale
         self.require_icc_profile_for_colour = require_icc_profile_for_colour
         self.use_default_filenames = use_default_filenames
         self.kakadu_compress_options = kakadu_compress_options
-        self.converter = conversion.Converter(exiftool_path=exiftool_path)
-
-        self.kakadu = Kakadu(kakadu_base_path=kakadu_base_path)
+        self.stream_lossless_check = stream_lossless_check
+        self.pixel_checksum_options = pixel_checksum_options or {}
+        self.cache = cache
+        self.incremental = incremental
+        self.pipeline_stages = pipeline_stages
+        self.metrics_sinks = list(metrics_sinks or [])
+        self.memory_budget = memory.MemoryBudget(memory_budget_bytes) if memory_budget_bytes else None
+        self.append_jp2_xmp = append_jp2_xmp
+        self._tool_versions = None
+        self.converter = conversion.Converter(exiftool_path=exiftool_path, exiftool_pool_size=exiftool_pool_size)
+
+        self.kakadu = Kakadu(kakadu_base_path=kakadu_base_path, num_threads=kakadu_num_threads,
+                             double_buffering=kakadu_double_buffering, report_cpu=kakadu_report_cpu)
 
         self.log = logging.getLogger(__name__)
 
     def generate_derivatives_from_jpg(self, jpg_filepath, output_folder, save_embedded_metadata=True,
-                                      check_lossless=True, save_jpylyzer_output=False):
+                                      check_lossless=True, save_jpylyzer_output=False, return_metrics=False):
         """
         Extracts the embedded metadata, creates a copy of the JPEG file and a validated JPEG2000 file.
         Stores all in the given folder.
@@ -75,55 +180,88 @@ class DerivativeFilesGenerator(object):
         :param save_embedded_metadata: If true, metadata will be extracted from the image file and preserved in a separate xml file
         :param save_jpylyzer_output: If true, the jyplyzer output from validating the jp2 will be preserved in a separate xml file
         :param check_lossless: If true, check the created JPEG2000 file is visually identical to the TIFF created from the source file
-        :return: filepaths of created files
+        :param return_metrics: If true, also return the metrics of each stage
+        :return: filepaths of created files, or if return_metrics is true, a tuple of them and a list of
+            :class:`~image_processing.metrics.StageMetrics`
         """
+        with self._recording_metrics(jpg_filepath) as recorder:
+            generated_files = self._generate_derivatives_from_jpg(
+                jpg_filepath, output_folder, save_embedded_metadata=save_embedded_metadata,
+                check_lossless=check_lossless, save_jpylyzer_output=save_jpylyzer_output)
+        return (generated_files, recorder.stages) if return_metrics else generated_files
+
+    def _generate_derivatives_from_jpg(self, jpg_filepath, output_folder, save_embedded_metadata, check_lossless,
+                                       save_jpylyzer_output):
         self.log.debug("Processing {0}".format(jpg_filepath))
         self.log.info("There may be some loss in converting from jpg to jpg2000, as jpg compression is lossy. "
                       "The lossless check is against the tiff created from the jpg")
         source_file_name = os.path.basename(jpg_filepath)
 
-        validation.check_image_suitable_for_jp2_conversion(
-            jpg_filepath, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
-            require_icc_profile_for_greyscale=self.require_icc_profile_for_greyscale)
+        roles = [DEFAULT_JPG_FILENAME]
+        if save_embedded_metadata:
+            roles.append(DEFAULT_EMBEDDED_METADATA_FILENAME)
+        roles.append(DEFAULT_LOSSLESS_JP2_FILENAME)
+        output_filepaths = {role: os.path.join(output_folder, self._get_filename(role, source_file_name))
+                            for role in roles + [DEFAULT_JPYLYZER_XML_FILENAME]}
+        generated_files = [output_filepaths[role] for role in roles]
+        if save_jpylyzer_output:
+            roles.append(DEFAULT_JPYLYZER_XML_FILENAME)
+
+        derivative_parameters = None
+        if self.incremental:
+            derivative_parameters = self._get_derivative_parameters(check_lossless=check_lossless, jpg_is_copy=True)
+        manifest, stale_roles = self._find_stale_derivatives(jpg_filepath, output_folder, roles, output_filepaths,
+                                                             derivative_parameters)
+        if not stale_roles:
+            self.log.debug("Derivatives for {0} in {1} are up to date".format(jpg_filepath, output_folder))
+            return generated_files
+
+        with validation.ImageContext(jpg_filepath) as image_context:
+            validation.check_image_suitable_for_jp2_conversion(
+                jpg_filepath, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
+                require_icc_profile_for_greyscale=self.require_icc_profile_for_greyscale, image_context=image_context)
 
         _make_dirs_if_exist(output_folder)
 
-        output_jpg_filepath = os.path.join(output_folder, self._get_filename(DEFAULT_JPG_FILENAME, source_file_name))
-        shutil.copy(jpg_filepath, output_jpg_filepath)
-        generated_files = [output_jpg_filepath]
+        if DEFAULT_JPG_FILENAME in stale_roles:
+            shutil.copy(jpg_filepath, output_filepaths[DEFAULT_JPG_FILENAME])
 
-        if save_embedded_metadata:
-            embedded_metadata_file_path = os.path.join(output_folder,
-                                                       self._get_filename(DEFAULT_EMBEDDED_METADATA_FILENAME, source_file_name))
+        if DEFAULT_EMBEDDED_METADATA_FILENAME in stale_roles:
+            embedded_metadata_file_path = output_filepaths[DEFAULT_EMBEDDED_METADATA_FILENAME]
             self.converter.extract_xmp_to_sidecar_file(jpg_filepath, embedded_metadata_file_path)
             self.log.debug('Extracted metadata file {0} generated'.format(embedded_metadata_file_path))
-            generated_files += [embedded_metadata_file_path]
 
-        with tempfile.NamedTemporaryFile(prefix='image-processing_', suffix='.tif') as scratch_tiff_file_obj:
-            scratch_tiff_filepath = scratch_tiff_file_obj.name
-            self.converter.convert_to_tiff(jpg_filepath, scratch_tiff_filepath)
+        if DEFAULT_LOSSLESS_JP2_FILENAME in stale_roles:
+            with tempfile.NamedTemporaryFile(prefix='image-processing_', suffix='.tif') as scratch_tiff_file_obj:
+                scratch_tiff_filepath = scratch_tiff_file_obj.name
+                self.converter.convert_to_tiff(jpg_filepath, scratch_tiff_filepath)
+
+                validation.check_colour_profiles_match(jpg_filepath, scratch_tiff_filepath,
+                                                       source_image_context=image_context)
 
-            validation.check_colour_profiles_match(jpg_filepath, scratch_tiff_filepath)
+                lossless_filepath = output_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME]
+                self.generate_jp2_from_tiff(scratch_tiff_filepath, lossless_filepath)
 
-            lossless_filepath = os.path.join(output_folder,
-                                             self._get_filename(DEFAULT_LOSSLESS_JP2_FILENAME, source_file_name))
-            self.generate_jp2_from_tiff(scratch_tiff_filepath, lossless_filepath)
+                jpylyzer_output_filepath = None
+                if save_jpylyzer_output:
+                    jpylyzer_output_filepath = output_filepaths[DEFAULT_JPYLYZER_XML_FILENAME]
 
-            jpylyzer_output_filepath = None
-            if save_jpylyzer_output:
-                jpylyzer_output_filepath = os.path.join(output_folder,
-                                                        self._get_filename(DEFAULT_JPYLYZER_XML_FILENAME, source_file_name))
+                self.validate_jp2_conversion(scratch_tiff_filepath, lossless_filepath, check_lossless=check_lossless,
+                                             jpylyzer_output_filepath=jpylyzer_output_filepath)
+        elif DEFAULT_JPYLYZER_XML_FILENAME in stale_roles:
+            validation.validate_jp2(output_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME],
+                                    output_filepaths[DEFAULT_JPYLYZER_XML_FILENAME])
 
-            self.validate_jp2_conversion(scratch_tiff_filepath, lossless_filepath, check_lossless=check_lossless,
-                                         jpylyzer_output_filepath=jpylyzer_output_filepath)
-            generated_files.append(lossless_filepath)
+        if manifest is not None:
+            self._update_manifest(manifest, jpg_filepath, stale_roles, output_filepaths, derivative_parameters)
 
         self.log.debug("Successfully generated derivatives for {0} in {1}".format(jpg_filepath, output_folder))
 
         return generated_files
 
     def generate_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff=False, save_embedded_metadata=True,
-                                       create_jpg_as_thumbnail=True, check_lossless=True, save_jpylyzer_output=False):
+                                       create_jpg_as_thumbnail=True, check_lossless=True, save_jpylyzer_output=False,
+                                       return_metrics=False):
         """
         Extracts the embedded metadata, creates a JPEG file and a validated JPEG2000 file.
         Stores all in the given folder.
@@ -136,23 +274,214 @@ class DerivativeFilesGenerator(object):
         :param save_embedded_metadata: If true, metadata will be extracted from the image file and preserved in a separate xml file
         :param save_jpylyzer_output: If true, the jyplyzer output from validating the jp2 will be preserved in a separate xml file
         :param check_lossless: If true, check the created jpg2000 file is visually identical to the source file
-        :return: filepaths of created files
+        :param return_metrics: If true, also return the metrics of each stage
+        :return: filepaths of created files, or if return_metrics is true, a tuple of them and a list of
+            :class:`~image_processing.metrics.StageMetrics`
+
+        If the generator has a cache, and the source file has been processed before with the same settings, the
+        cached derivatives are used instead of generating them again
+        """
+        with self._recording_metrics(tiff_filepath) as recorder:
+            generated_files = self._generate_or_fetch_derivatives_from_tiff(
+                tiff_filepath, output_folder, include_tiff=include_tiff, save_embedded_metadata=save_embedded_metadata,
+                create_jpg_as_thumbnail=create_jpg_as_thumbnail, check_lossless=check_lossless,
+                save_jpylyzer_output=save_jpylyzer_output)
+        return (generated_files, recorder.stages) if return_metrics else generated_files
+
+    def _generate_or_fetch_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff,
+                                                 save_embedded_metadata, create_jpg_as_thumbnail, check_lossless,
+                                                 save_jpylyzer_output):
+        if self.cache is None:
+            return self._generate_derivatives_from_tiff(
+                tiff_filepath, output_folder, include_tiff=include_tiff, save_embedded_metadata=save_embedded_metadata,
+                create_jpg_as_thumbnail=create_jpg_as_thumbnail, check_lossless=check_lossless,
+                save_jpylyzer_output=save_jpylyzer_output)
+
+        source_file_name = os.path.basename(tiff_filepath)
+        # the cache stores files by their default filename, whatever they are called in the output folder
+        cached_roles = [DEFAULT_JPG_FILENAME, DEFAULT_LOSSLESS_JP2_FILENAME]
+        if save_embedded_metadata:
+            cached_roles.append(DEFAULT_EMBEDDED_METADATA_FILENAME)
+        if save_jpylyzer_output:
+            cached_roles.append(DEFAULT_JPYLYZER_XML_FILENAME)
+        cacheable_filepaths = {role: os.path.join(output_folder, self._get_filename(role, source_file_name))
+                               for role in cached_roles}
+        cacheable_filepaths.update(self._get_jpg_derivative_filepaths(output_folder))
+
+        cache_key = self.cache.get_key(tiff_filepath, self._get_cache_settings(
+            save_embedded_metadata=save_embedded_metadata, create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+            check_lossless=check_lossless, save_jpylyzer_output=save_jpylyzer_output))
+        _make_dirs_if_exist(output_folder)
+        if not self.cache.fetch(cache_key, cacheable_filepaths):
+            generated_files = self._generate_derivatives_from_tiff(
+                tiff_filepath, output_folder, include_tiff=include_tiff, save_embedded_metadata=save_embedded_metadata,
+                create_jpg_as_thumbnail=create_jpg_as_thumbnail, check_lossless=check_lossless,
+                save_jpylyzer_output=save_jpylyzer_output)
+            self.cache.store(cache_key, cacheable_filepaths)
+            return generated_files
+
+        self.log.debug("Using cached derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+        generated_files = [cacheable_filepaths[DEFAULT_JPG_FILENAME]]
+        if save_embedded_metadata:
+            generated_files.append(cacheable_filepaths[DEFAULT_EMBEDDED_METADATA_FILENAME])
+        if include_tiff:
+            output_tiff_filepath = os.path.join(output_folder,
+                                                self._get_filename(DEFAULT_TIFF_FILENAME, source_file_name))
+            shutil.copy(tiff_filepath, output_tiff_filepath)
+            generated_files.append(output_tiff_filepath)
+        generated_files.append(cacheable_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME])
+        generated_files += [cacheable_filepaths[spec.filename] for spec in self.jpg_derivative_specs]
+
+        if self.incremental:
+            manifest = DerivativeManifest(os.path.join(output_folder, self._get_filename(DEFAULT_MANIFEST_FILENAME,
+                                                                                         source_file_name)))
+            derivative_parameters = self._get_derivative_parameters(create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                                                                    check_lossless=check_lossless)
+            output_filepaths = dict(cacheable_filepaths)
+            if include_tiff:
+                output_filepaths[DEFAULT_TIFF_FILENAME] = output_tiff_filepath
+            self._update_manifest(manifest, tiff_filepath, output_filepaths, output_filepaths, derivative_parameters)
+        return generated_files
+
+    def _get_cache_settings(self, save_embedded_metadata, create_jpg_as_thumbnail, check_lossless,
+                            save_jpylyzer_output):
+        """
+        Everything apart from the source file that affects the derivatives, for the cache key
         """
+        settings = self._get_derivative_parameters(create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                                                   check_lossless=check_lossless)
+        settings['save_embedded_metadata'] = save_embedded_metadata
+        settings['save_jpylyzer_output'] = save_jpylyzer_output
+        return settings
+
+    def _generate_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff, save_embedded_metadata,
+                                        create_jpg_as_thumbnail, check_lossless, save_jpylyzer_output):
         self.log.debug("Processing {0}".format(tiff_filepath))
         source_file_name = os.path.basename(tiff_filepath)
 
-        validation.check_image_suitable_for_jp2_conversion(
-            tiff_filepath, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
-            require_icc_profile_for_greyscale=self.require_icc_profile_for_greyscale)
+        roles = [DEFAULT_JPG_FILENAME]
+        if save_embedded_metadata:
+            roles.append(DEFAULT_EMBEDDED_METADATA_FILENAME)
+        if include_tiff:
+            roles.append(DEFAULT_TIFF_FILENAME)
+        roles.append(DEFAULT_LOSSLESS_JP2_FILENAME)
+        output_filepaths = {role: os.path.join(output_folder, self._get_filename(role, source_file_name))
+                            for role in roles + [DEFAULT_JPYLYZER_XML_FILENAME]}
+        output_filepaths.update(self._get_jpg_derivative_filepaths(output_folder))
+        roles += [spec.filename for spec in self.jpg_derivative_specs]
+        generated_files = [output_filepaths[role] for role in roles]
+        if save_jpylyzer_output:
+            roles.append(DEFAULT_JPYLYZER_XML_FILENAME)
+
+        derivative_parameters = None
+        if self.incremental:
+            derivative_parameters = self._get_derivative_parameters(create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                                                                    check_lossless=check_lossless)
+        manifest, stale_roles = self._find_stale_derivatives(tiff_filepath, output_folder, roles, output_filepaths,
+                                                             derivative_parameters)
+        if not stale_roles:
+            self.log.debug("Derivatives for {0} in {1} are up to date".format(tiff_filepath, output_folder))
+            return generated_files
+
+        _make_dirs_if_exist(output_folder)
+        # cached derivatives may have been linked to these paths, and some are written in place
+        unlink_linked_files(output_filepaths[role] for role in stale_roles)
+        # stages which don't depend on each other, run concurrently if pipeline_stages is set
+        stages = []
+        image_roles = [DEFAULT_JPG_FILENAME, DEFAULT_LOSSLESS_JP2_FILENAME] + \
+            [spec.filename for spec in self.jpg_derivative_specs]
+        if any(role in stale_roles for role in image_roles):
+            stages.append(functools.partial(self._generate_image_derivatives_from_tiff, tiff_filepath,
+                                            output_filepaths, stale_roles,
+                                            create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                                            check_lossless=check_lossless,
+                                            save_jpylyzer_output=save_jpylyzer_output))
+        elif DEFAULT_JPYLYZER_XML_FILENAME in stale_roles:
+            # the jp2 is up to date, so only its jpylyzer output needs to be written
+            stages.append(functools.partial(validation.validate_jp2, output_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME],
+                                            output_filepaths[DEFAULT_JPYLYZER_XML_FILENAME]))
+
+        if DEFAULT_EMBEDDED_METADATA_FILENAME in stale_roles:
+            stages.append(functools.partial(self._extract_xmp_to_sidecar_file, tiff_filepath,
+                                            output_filepaths[DEFAULT_EMBEDDED_METADATA_FILENAME]))
+
+        if DEFAULT_TIFF_FILENAME in stale_roles:
+            stages.append(functools.partial(_copy_tiff, tiff_filepath, output_filepaths[DEFAULT_TIFF_FILENAME]))
+
+        self._run_stages(stages)
+
+        if manifest is not None:
+            self._update_manifest(manifest, tiff_filepath, stale_roles, output_filepaths, derivative_parameters)
+
+        self.log.debug("Successfully generated derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+        return generated_files
+
+    @contextmanager
+    def _recording_metrics(self, source_filepath):
+        """
+        Record the metrics of the stages run inside it, and write them to the metrics sinks even if a stage fails
+        """
+        with metrics.recording() as recorder:
+            try:
+                yield recorder
+            finally:
+                for sink in self.metrics_sinks:
+                    try:
+                        sink.write(recorder.stages, source_filepath=source_filepath)
+                    except Exception:
+                        # losing metrics shouldn't fail the conversion
+                        self.log.exception('Could not write metrics for {0} to {1}'.format(source_filepath, sink))
+
+    def _extract_xmp_to_sidecar_file(self, image_filepath, embedded_metadata_file_path):
+        self.converter.extract_xmp_to_sidecar_file(image_filepath, embedded_metadata_file_path)
+        self.log.debug('Extracted metadata file {0} generated'.format(embedded_metadata_file_path))
+
+    def _run_stages(self, stages):
+        """
+        Call each of the stages, which must not depend on each other. If pipeline_stages is set, they run
+        concurrently, with the first on this thread. Otherwise they run one after another.
+        All the stages finish before an error from any of them is raised.
 
-        with Image.open(tiff_filepath) as tiff_pil:
-            if tiff_pil.mode == 'RGBA':
+        :param stages: list of functions without arguments
+        """
+        if not self.pipeline_stages or len(stages) < 2:
+            for stage in stages:
+                stage()
+            return
+
+        with futures.ThreadPoolExecutor(max_workers=len(stages) - 1) as executor:
+            stage_futures = [executor.submit(metrics.bind_recorder(stage)) for stage in stages[1:]]
+            try:
+                stages[0]()
+            finally:
+                futures.wait(stage_futures)
+        for stage_future in stage_futures:
+            stage_future.result()
+
+    def _generate_image_derivatives_from_tiff(self, tiff_filepath, output_filepaths, stale_roles,
+                                              create_jpg_as_thumbnail, check_lossless, save_jpylyzer_output):
+        """
+        Generate the JPEGs and/or the validated JPEG2000, as they share the decoded source image
+        """
+        # the source is only opened and decoded once, and shared between the stages below
+        with validation.ImageContext(tiff_filepath, checksum_options=self.pixel_checksum_options,
+                                     memory_budget=self.memory_budget) as image_context, \
+                tempfile.NamedTemporaryFile(prefix='image-processing_', suffix='.tif') as temp_tiff_file_obj, \
+                futures.ThreadPoolExecutor(max_workers=1) as pixels_executor:
+            validation.check_image_suitable_for_jp2_conversion(
+                tiff_filepath, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
+                require_icc_profile_for_greyscale=self.require_icc_profile_for_greyscale, image_context=image_context)
+            # rejects images over the memory budget which can't be read in strips, before any work is done
+            if image_context.in_strips:
+                self.log.info('{0} is over the memory budget, so will be processed in strips'.format(tiff_filepath))
+                if DEFAULT_JPG_FILENAME in stale_roles and not create_jpg_as_thumbnail:
+                    self.memory_budget.check(image_context.mode, image_context.size,
+                                             'The full size JPEG of {0}'.format(tiff_filepath))
+
+            if image_context.mode == 'RGBA':
                 # some RGBA tiffs don't convert properly back from jp2 - kakadu warns about unassociated alpha channels
                 check_lossless = True
 
-        _make_dirs_if_exist(output_folder)
-
-        with tempfile.NamedTemporaryFile(prefix='image-processing_', suffix='.tif') as temp_tiff_file_obj:
             # only work from a temporary file if we need to - e.g. if the tiff filepath is invalid,
             # or if we need to normalise the tiff. Otherwise just use the original tiff
             temp_tiff_filepath = temp_tiff_file_obj.name
@@ -162,72 +491,251 @@ class DerivativeFilesGenerator(object):
             else:
                 normalised_tiff_filepath = tiff_filepath
 
-            jpeg_filepath = os.path.join(output_folder, self._get_filename(DEFAULT_JPG_FILENAME, source_file_name))
-
+            jpeg_filepath = output_filepaths[DEFAULT_JPG_FILENAME]
             jpg_quality = None if create_jpg_as_thumbnail else self.jpg_high_quality_value
             jpg_resize = self.jpg_thumbnail_resize_value if create_jpg_as_thumbnail else None
+            jpg_from_jp2 = DEFAULT_JPG_FILENAME in stale_roles and create_jpg_as_thumbnail \
+                and self._can_reduce_jp2_for_jpg(image_context, jpg_resize)
+
+            stale_jpg_derivative_specs = [spec for spec in self.jpg_derivative_specs if spec.filename in stale_roles]
+
+            def convert_to_jpgs():
+                if DEFAULT_JPG_FILENAME in stale_roles and not jpg_from_jp2:
+                    self.converter.convert_to_jpg(normalised_tiff_filepath, jpeg_filepath,
+                                                  quality=jpg_quality, resize=jpg_resize, image_context=image_context,
+                                                  resampling=self.jpg_thumbnail_resampling,
+                                                  reducing_gap=self.jpg_thumbnail_reducing_gap)
+                    self.log.debug('jpeg file {0} generated'.format(jpeg_filepath))
+
+                if stale_jpg_derivative_specs:
+                    self.converter.convert_to_jpgs(normalised_tiff_filepath,
+                                                   [(output_filepaths[spec.filename], spec.size, spec.quality)
+                                                    for spec in stale_jpg_derivative_specs],
+                                                   image_context=image_context,
+                                                   resampling=self.jpg_thumbnail_resampling,
+                                                   reducing_gap=self.jpg_thumbnail_reducing_gap)
+
+            generate_jp2 = DEFAULT_LOSSLESS_JP2_FILENAME in stale_roles
+            if not self.pipeline_stages:
+                convert_to_jpgs()
+                convert_to_jpgs = None
+            # the jpgs (if pipelined) and then the checksum for the lossless check are made from the decoded pixels on
+            # another thread while kakadu runs, and the pixels are freed afterwards
+            pixels_future = pixels_executor.submit(metrics.bind_recorder(_use_pixels_and_close), image_context,
+                                                   convert_to_jpgs, generate_checksum=generate_jp2 and check_lossless)
+
+            lossless_filepath = output_filepaths[DEFAULT_LOSSLESS_JP2_FILENAME]
+            if generate_jp2:
+                self.generate_jp2_from_tiff(normalised_tiff_filepath, lossless_filepath, image_context=image_context)
+
+                jpylyzer_output_filepath = None
+                if save_jpylyzer_output:
+                    jpylyzer_output_filepath = output_filepaths[DEFAULT_JPYLYZER_XML_FILENAME]
+                # only the lossless check has to wait for the pixels
+                validation.validate_jp2(lossless_filepath, jpylyzer_output_filepath)
+                if check_lossless:
+                    self.check_conversion_was_lossless(normalised_tiff_filepath, lossless_filepath,
+                                                       image_context=image_context,
+                                                       source_pixel_checksum=pixels_future.result())
+            pixels_future.result()
+
+            if jpg_from_jp2:
+                # made from the validated jp2, which has the same pixels as the tiff
+                self.generate_jpg_from_jp2(lossless_filepath, jpeg_filepath, tiff_filepath, resize=jpg_resize,
+                                           quality=jpg_quality)
+
+    def _can_reduce_jp2_for_jpg(self, image_context, jpg_resize):
+        """
+        Check whether a thumbnail can be made from a reduced resolution level of the jp2
+        """
+        if not self.jpg_from_jp2 or image_context.mode not in validation.PNM_EXTENSIONS:
+            return False
+        thumbnail_size = tuple(int(i * jpg_resize) for i in image_context.size)
+        resolution_levels = kakadu.get_resolution_levels(self.kakadu_compress_options)
+        return self._get_jp2_reduce_level(image_context.size, thumbnail_size, resolution_levels) > 0
 
-            self.converter.convert_to_jpg(normalised_tiff_filepath, jpeg_filepath,
-                                          quality=jpg_quality, resize=jpg_resize)
-            self.log.debug('jpeg file {0} generated'.format(jpeg_filepath))
-            generated_files = [jpeg_filepath]
-
-            if save_embedded_metadata:
-                embedded_metadata_file_path = os.path.join(output_folder,
-                                                           self._get_filename(DEFAULT_EMBEDDED_METADATA_FILENAME, source_file_name))
-                self.converter.extract_xmp_to_sidecar_file(tiff_filepath, embedded_metadata_file_path)
-                self.log.debug('Extracted metadata file {0} generated'.format(embedded_metadata_file_path))
-                generated_files += [embedded_metadata_file_path]
+    def _get_jp2_reduce_level(self, image_size, thumbnail_size, resolution_levels):
+        """
+        Like the reducing gap of the thumbnail resize, leave the reduced image this many times bigger than the
+        thumbnail, as the lowest resolution levels of a jp2 are not as good a downsample as the final resize.
+        A reducing gap of None always decodes the full image
+        """
+        if self.jpg_thumbnail_reducing_gap is None:
+            return 0
+        minimum_size = tuple(int(math.ceil(i * self.jpg_thumbnail_reducing_gap)) for i in thumbnail_size)
+        return kakadu.get_reduce_level(image_size, minimum_size, resolution_levels)
 
-            if include_tiff:
-                output_tiff_filepath = os.path.join(output_folder,
-                                                    self._get_filename(DEFAULT_TIFF_FILENAME, source_file_name))
-                shutil.copy(tiff_filepath, output_tiff_filepath)
-                generated_files += [output_tiff_filepath]
+    def generate_jpg_from_jp2(self, jp2_filepath, jpeg_filepath, metadata_source_filepath, resize=None,
+                              thumbnail_size=None, quality=None):
+        """
+        Create a JPEG thumbnail by expanding the smallest resolution level of the JPEG2000 that is still
+        jpg_thumbnail_reducing_gap times bigger than the thumbnail (using kdu_expand ``-reduce``), then resizing that
+        to the thumbnail size. The thumbnail is the same size as one resized from the full image.
+        Only supports 8 bit RGB and greyscale JPEG2000s.
 
-            lossless_filepath = os.path.join(output_folder,
-                                             self._get_filename(DEFAULT_LOSSLESS_JP2_FILENAME, source_file_name))
-            self.generate_jp2_from_tiff(normalised_tiff_filepath, lossless_filepath)
+        :param jp2_filepath:
+        :param jpeg_filepath: The output filepath
+        :param metadata_source_filepath: file to copy the embedded metadata from, e.g. the TIFF the jp2 was made from
+        :param resize: resize by this amount, e.g. 0.5 to make a thumbnail half the size
+        :param thumbnail_size: resize to fit within this (width, height) instead of by the resize factor
+        :param quality: quality of created jpg: either None, or 1-95
+        """
+        image_size, components, bit_depth = jp2.get_image_header(jp2_filepath)
+        if components not in [1, 3] or bit_depth != 8:
+            raise ValueError('Cannot create a jpg from {0}: only 8 bit RGB and greyscale jp2s are supported'
+                             .format(jp2_filepath))
+        if thumbnail_size is None:
+            thumbnail_size = tuple(int(i * resize) for i in image_size)
+        thumbnail_size = conversion.get_thumbnail_size(image_size, thumbnail_size)
+        reduce_level = self._get_jp2_reduce_level(image_size, thumbnail_size,
+                                                  jp2.get_decomposition_levels(jp2_filepath))
+        self.log.debug('Expanding {0} at reduce level {1} to make a {2} thumbnail'
+                       .format(jp2_filepath, reduce_level, thumbnail_size))
+
+        output_extension = validation.PNM_EXTENSIONS['RGB' if components == 3 else validation.GREYSCALE]
+        with self.kakadu.kdu_expand_to_stream(jp2_filepath, output_extension,
+                                              kakadu_options=['-reduce', str(reduce_level)]) as expanded_stream:
+            colour_mode, reduced_size = validation.read_pnm_header(expanded_stream)
+            pixel_data = expanded_stream.read(reduced_size[0] * reduced_size[1] * Image.getmodebands(colour_mode))
+        reduced_image = Image.frombytes(colour_mode, reduced_size, pixel_data)
+        # resized to the exact size, as the reduced image's aspect ratio can be slightly different after rounding
+        thumbnail = reduced_image.resize(thumbnail_size,
+                                         conversion.THUMBNAIL_RESAMPLING_FILTERS[self.jpg_thumbnail_resampling],
+                                         reducing_gap=self.jpg_thumbnail_reducing_gap)
+        icc_profile = jp2.get_icc_profile(jp2_filepath)
+        if icc_profile:
+            thumbnail.info['icc_profile'] = icc_profile
+
+        self.converter.convert_pil_image_to_jpg(thumbnail, jpeg_filepath, metadata_source_filepath, quality=quality)
+        self.log.debug('jpeg file {0} generated from {1}'.format(jpeg_filepath, jp2_filepath))
+
+    def _get_derivative_parameters(self, create_jpg_as_thumbnail=True, check_lossless=True, jpg_is_copy=False):
+        """
+        The parameters each derivative depends on, apart from the source file. A derivative recorded in the manifest
+        with different parameters is generated again. Only needed for cache keys and incremental manifests
 
-            jpylyzer_output_filepath = None
-            if save_jpylyzer_output:
-                jpylyzer_output_filepath = os.path.join(output_folder,
-                                                        self._get_filename(DEFAULT_JPYLYZER_XML_FILENAME, source_file_name))
+        :param jpg_is_copy: the JPEG is a copy of a JPEG source, rather than converted from it
+        :return: dict of role to parameters
+        """
+        exiftool_version, kakadu_version = self._get_tool_versions()
+        if jpg_is_copy:
+            jpg_parameters = {}
+        else:
+            jpg_parameters = {
+                'jpg_quality': None if create_jpg_as_thumbnail else self.jpg_high_quality_value,
+                'jpg_resize': self.jpg_thumbnail_resize_value if create_jpg_as_thumbnail else None,
+                'jpg_resampling': self.jpg_thumbnail_resampling,
+                'jpg_reducing_gap': self.jpg_thumbnail_reducing_gap,
+                'jpg_from_jp2': self.jpg_from_jp2,
+                'exiftool_version': exiftool_version
+            }
+        parameters = {
+            DEFAULT_JPG_FILENAME: jpg_parameters,
+            DEFAULT_EMBEDDED_METADATA_FILENAME: {'exiftool_version': exiftool_version},
+            DEFAULT_TIFF_FILENAME: {},
+            DEFAULT_LOSSLESS_JP2_FILENAME: {
+                'kakadu_compress_options': list(self.kakadu_compress_options),
+                'kakadu_version': kakadu_version,
+                'exiftool_version': exiftool_version,
+                'require_icc_profile_for_greyscale': self.require_icc_profile_for_greyscale,
+                'require_icc_profile_for_colour': self.require_icc_profile_for_colour,
+                'check_lossless': check_lossless
+            },
+            DEFAULT_JPYLYZER_XML_FILENAME: {}
+        }
+        for spec in self.jpg_derivative_specs:
+            parameters[spec.filename] = {
+                'jpg_size': spec.size,
+                'jpg_quality': spec.quality,
+                'jpg_resampling': self.jpg_thumbnail_resampling,
+                'jpg_reducing_gap': self.jpg_thumbnail_reducing_gap,
+                'exiftool_version': exiftool_version
+            }
+        return parameters
+
+    def _get_jpg_derivative_filepaths(self, output_folder):
+        """
+        :return: dict of the filename of each jpg derivative spec to its filepath
+        """
+        return {spec.filename: os.path.join(output_folder, spec.filename) for spec in self.jpg_derivative_specs}
 
-            self.validate_jp2_conversion(normalised_tiff_filepath, lossless_filepath, check_lossless=check_lossless,
-                                         jpylyzer_output_filepath=jpylyzer_output_filepath)
-            generated_files.append(lossless_filepath)
+    def _get_tool_versions(self):
+        """
+        The versions of exiftool and kakadu, looked up the first time they're needed
 
-            self.log.debug("Successfully generated derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+        :return: tuple of the exiftool and kakadu versions
+        """
+        if self._tool_versions is None:
+            self._tool_versions = (self.converter.exiftool_version(), self.kakadu.version())
+        return self._tool_versions
 
-            return generated_files
+    def _find_stale_derivatives(self, source_filepath, output_folder, roles, output_filepaths, derivative_parameters):
+        """
+        If incremental is set, load the manifest from the output folder and find the derivatives which need to be
+        generated again. Otherwise, all of them do.
+        A stale jp2 also makes its jpylyzer output stale, as the jp2 is validated as it is generated
 
-    def generate_jp2_from_tiff(self, tiff_file, jp2_filepath):
+        :return: tuple of the manifest (None if incremental isn't set), and the set of roles to generate
+        """
+        if not self.incremental:
+            return None, set(roles)
+        manifest = DerivativeManifest(os.path.join(output_folder, self._get_filename(
+            DEFAULT_MANIFEST_FILENAME, os.path.basename(source_filepath))))
+        stale_roles = set(role for role in roles
+                          if not manifest.is_up_to_date(source_filepath, role, output_filepaths[role],
+                                                        derivative_parameters[role]))
+        if DEFAULT_LOSSLESS_JP2_FILENAME in stale_roles and DEFAULT_JPYLYZER_XML_FILENAME in roles:
+            stale_roles.add(DEFAULT_JPYLYZER_XML_FILENAME)
+        if stale_roles:
+            self.log.info('Regenerating {0} for {1}'.format(', '.join(sorted(stale_roles)), source_filepath))
+        return manifest, stale_roles
+
+    def _update_manifest(self, manifest, source_filepath, generated_roles, output_filepaths, derivative_parameters):
+        manifest.record_source(source_filepath)
+        for role in generated_roles:
+            manifest.record(role, output_filepaths[role], derivative_parameters[role])
+        manifest.save()
+
+    def generate_jp2_from_tiff(self, tiff_file, jp2_filepath, image_context=None):
         """
         Creates lossless JPEG2000 at jp2_filepath
 
 
         :param tiff_file: The source TIFF file.
         :param jp2_filepath: The output filepath
+        :param image_context: if not None, a :class:`~image_processing.validation.ImageContext` for tiff_file,
+            used instead of opening it again
         """
-        kakadu_options = list(self.kakadu_compress_options)
-
-        with Image.open(tiff_file) as tiff_pil:
-            if tiff_pil.mode == 'RGBA':
-                if kakadu.ALPHA_OPTION not in kakadu_options:
-                    kakadu_options += [kakadu.ALPHA_OPTION]
-            elif tiff_pil.mode == 'RGBX':
-                self.log.warning('Input tiff has colour mode RGBX. It will be converted to RGBA')
-                if kakadu.ALPHA_OPTION not in kakadu_options:
-                    kakadu_options += [kakadu.ALPHA_OPTION]
-
+        if image_context is not None:
+            colour_mode = image_context.mode
+        else:
+            with Image.open(tiff_file) as tiff_pil:
+                colour_mode = tiff_pil.mode
 
-        self.kakadu.kdu_compress(tiff_file, jp2_filepath, kakadu_options=kakadu_options)
+        self.kakadu.kdu_compress(tiff_file, jp2_filepath, kakadu_options=self._get_kakadu_compress_options(colour_mode))
         self.log.debug('Lossless jp2 file {0} generated'.format(jp2_filepath))
         # as of v7.10.4, kakadu doesn't copy over a lot of the technical metadata, so we do that separately
-        self.converter.copy_over_embedded_metadata(tiff_file, jp2_filepath, write_only_xmp=True)
+        if self.append_jp2_xmp:
+            self.converter.copy_over_xmp_to_jp2(tiff_file, jp2_filepath)
+        else:
+            self.converter.copy_over_embedded_metadata(tiff_file, jp2_filepath, write_only_xmp=True)
 
-    def validate_jp2_conversion(self, tiff_file, jp2_filepath, check_lossless=True, jpylyzer_output_filepath=None):
+    def _get_kakadu_compress_options(self, colour_mode):
+        """
+        The kdu_compress options for a source image with the given colour mode
+        """
+        kakadu_options = list(self.kakadu_compress_options)
+        if colour_mode == 'RGBA':
+            if kakadu.ALPHA_OPTION not in kakadu_options:
+                kakadu_options += [kakadu.ALPHA_OPTION]
+        elif colour_mode == 'RGBX':
+            self.log.warning('Input tiff has colour mode RGBX. It will be converted to RGBA')
+            if kakadu.ALPHA_OPTION not in kakadu_options:
+                kakadu_options += [kakadu.ALPHA_OPTION]
+        return kakadu_options
+
+    def validate_jp2_conversion(self, tiff_file, jp2_filepath, check_lossless=True, jpylyzer_output_filepath=None,
+                                image_context=None, source_pixel_checksum=None):
         """
         Validate the jp2 file using jpylyzer, and check that the conversion from tif to jp2 was lossless
         Raises a :class:`~image_processing.exceptions.ValidationError` if either check fails.
@@ -236,29 +744,99 @@ class DerivativeFilesGenerator(object):
         :param jp2_filepath:
         :param check_lossless: if false, don't check the conversion from tif to jp2 was lossless
         :param jpylyzer_output_filepath: write the jpylyzer xml output to this file if given
+        :param image_context: if not None, a :class:`~image_processing.validation.ImageContext` for tiff_file,
+            used instead of opening it again
+        :param source_pixel_checksum: if not None, the pixel checksum of tiff_file, generated using
+            :func:`~image_processing.validation.generate_pixel_checksum`
         """
         validation.validate_jp2(jp2_filepath, jpylyzer_output_filepath)
         if check_lossless:
-            self.check_conversion_was_lossless(tiff_file, jp2_filepath)
+            self.check_conversion_was_lossless(tiff_file, jp2_filepath, image_context=image_context,
+                                               source_pixel_checksum=source_pixel_checksum)
 
-    def check_conversion_was_lossless(self, source_file, lossless_jpg_2000_file):
+    def check_conversion_was_lossless(self, source_file, lossless_jpg_2000_file, image_context=None,
+                                      source_pixel_checksum=None):
         """
         Visually compare the source file to the TIFF generated by expanding the lossless JPEG2000,
         and raise a :class:`~image_processing.exceptions.ValidationError` if they do not match.
         Does not check technical metadata beyond colour profile and mode.
 
+        If neither image_context nor source_pixel_checksum are given, the source checksum is generated on another
+        thread while kdu_expand runs.
+        If stream_lossless_check is set and the source is 8 bit RGB or greyscale, the expanded pixels are read
+        straight from kdu_expand instead of from a temporary TIFF (see :func:`check_expanded_stream_was_lossless`)
+
         :param source_file: Must be TIFF - cannot convert losslessly from JPEG to TIFF
         :param lossless_jpg_2000_file: The JPEG2000 file to compare.
+        :param image_context: if not None, a :class:`~image_processing.validation.ImageContext` for source_file,
+            whose cached pixel checksum is used instead of reading the source pixels again
+        :param source_pixel_checksum: if not None, the pixel checksum of source_file, generated using
+            :func:`~image_processing.validation.generate_pixel_checksum`
         """
         self.log.debug('Checking conversion from source file {0} to jp2 file {1} was lossless'
                        .format(source_file, lossless_jpg_2000_file))
-        with tempfile.NamedTemporaryFile(prefix='jp2_reconvert_', suffix='.tif') as reconverted_tiff_file_obj:
-            reconverted_tiff_filepath = reconverted_tiff_file_obj.name
-            self.kakadu.kdu_expand(lossless_jpg_2000_file, reconverted_tiff_filepath, kakadu_options=['-fussy'])
-            validation.check_visually_identical(source_file, reconverted_tiff_filepath)
+        owns_image_context = image_context is None
+        if owns_image_context:
+            image_context = validation.ImageContext(source_file, checksum_options=self.pixel_checksum_options,
+                                                    memory_budget=self.memory_budget)
+        try:
+            if self.stream_lossless_check and image_context.mode in validation.PNM_EXTENSIONS:
+                self.check_expanded_stream_was_lossless(source_file, lossless_jpg_2000_file,
+                                                        image_context=image_context,
+                                                        source_pixel_checksum=source_pixel_checksum)
+            else:
+                with futures.ThreadPoolExecutor(max_workers=1) as checksum_executor, \
+                        tempfile.NamedTemporaryFile(prefix='jp2_reconvert_',
+                                                    suffix='.tif') as reconverted_tiff_file_obj:
+                    checksum_future = None
+                    if owns_image_context and source_pixel_checksum is None:
+                        # generated while kdu_expand runs
+                        checksum_future = checksum_executor.submit(metrics.bind_recorder(_get_pixel_checksum),
+                                                                   image_context)
+                    reconverted_tiff_filepath = reconverted_tiff_file_obj.name
+                    self.kakadu.kdu_expand(lossless_jpg_2000_file, reconverted_tiff_filepath,
+                                           kakadu_options=['-fussy'])
+                    if checksum_future is not None:
+                        source_pixel_checksum = checksum_future.result()
+                    validation.check_visually_identical(source_file, reconverted_tiff_filepath,
+                                                        source_pixel_checksum=source_pixel_checksum,
+                                                        source_image_context=image_context)
+        finally:
+            if owns_image_context:
+                image_context.close()
         self.log.info('Conversion from source file {0} to jp2 file {1} was lossless'
                       .format(source_file, lossless_jpg_2000_file))
 
+    def check_expanded_stream_was_lossless(self, source_file, lossless_jpg_2000_file, image_context=None,
+                                           source_pixel_checksum=None):
+        """
+        Compare the source file to the pixels kdu_expand decodes from the lossless JPEG2000, streaming them through
+        a named pipe so no full size intermediate file is written.
+        Only supports 8 bit RGB and greyscale sources, which kakadu can expand to PPM and PGM.
+        Raises a :class:`~image_processing.exceptions.ValidationError` if they do not match.
+
+        :param source_file:
+        :param lossless_jpg_2000_file: The JPEG2000 file to compare.
+        :param image_context: if not None, a :class:`~image_processing.validation.ImageContext` for source_file
+        :param source_pixel_checksum: if not None, the pixel checksum of source_file
+        """
+        if image_context is None:
+            with validation.ImageContext(source_file, checksum_options=self.pixel_checksum_options,
+                                         memory_budget=self.memory_budget) as image_context:
+                return self.check_expanded_stream_was_lossless(source_file, lossless_jpg_2000_file,
+                                                               image_context=image_context,
+                                                               source_pixel_checksum=source_pixel_checksum)
+        if image_context.mode not in validation.PNM_EXTENSIONS:
+            raise ValueError('Cannot stream the lossless check for {0}: unsupported colour mode {1}'
+                             .format(source_file, image_context.mode))
+
+        converted_icc_profile = jp2.get_icc_profile(lossless_jpg_2000_file)
+        with self.kakadu.kdu_expand_to_stream(lossless_jpg_2000_file, validation.PNM_EXTENSIONS[image_context.mode],
+                                              kakadu_options=['-fussy']) as expanded_stream:
+            validation.check_pnm_stream_visually_identical(source_file, expanded_stream, converted_icc_profile,
+                                                           source_pixel_checksum=source_pixel_checksum,
+                                                           source_image_context=image_context)
+
     def _get_filename(self, default_filename, source_file_name):
         """
         Get a filename for the derivative file specified by default_filename
@@ -282,6 +860,61 @@ class DerivativeFilesGenerator(object):
             return "{0}.jp2".format(orig_filename_base)
         elif default_filename == DEFAULT_JPYLYZER_XML_FILENAME:
             return "{0}.jp2.jpylyzer.xml".format(orig_filename_base)
+        elif default_filename == DEFAULT_MANIFEST_FILENAME:
+            return "{0}.manifest.json".format(orig_filename_base)
+
+
+def _check_jpg_derivative_filenames(jpg_derivative_specs):
+    """
+    Raise a ValueError if jpg derivatives would overwrite each other or the default derivatives
+    """
+    filenames = [spec.filename for spec in jpg_derivative_specs]
+    default_filenames = [DEFAULT_TIFF_FILENAME, DEFAULT_EMBEDDED_METADATA_FILENAME, DEFAULT_JPG_FILENAME,
+                         DEFAULT_LOSSLESS_JP2_FILENAME, DEFAULT_JPYLYZER_XML_FILENAME, DEFAULT_MANIFEST_FILENAME]
+    for filename in filenames:
+        if filenames.count(filename) > 1 or filename in default_filenames:
+            raise ValueError('Jpg derivative filename {0} is used for more than one derivative'.format(filename))
+
+
+def _copy_tiff(tiff_filepath, output_filepath):
+    with metrics.record_stage('tiff_copy', input_filepaths=tiff_filepath, output_filepaths=output_filepath):
+        shutil.copy(tiff_filepath, output_filepath)
+
+
+def _use_pixels_and_close(image_context, convert_to_jpgs=None, generate_checksum=False):
+    """
+    Make the jpgs and/or the pixel checksum from the decoded pixels of an
+    :class:`~image_processing.validation.ImageContext`, then free its pixels
+
+    :param image_context:
+    :param convert_to_jpgs: if not None, a function which makes the jpgs from the image context
+    :param generate_checksum: generate the pixel checksum
+    :return: the pixel checksum, or None if not generated
+    """
+    try:
+        if convert_to_jpgs is not None:
+            convert_to_jpgs()
+        if generate_checksum:
+            return image_context.pixel_checksum
+    finally:
+        image_context.close()
+
+
+def _get_pixel_checksum(image_context):
+    return image_context.pixel_checksum
+
+
+def generate_checksum_and_close(image_context):
+    """
+    Generate the pixel checksum of an :class:`~image_processing.validation.ImageContext`, then free its pixels
+
+    :param image_context:
+    :return: the pixel checksum
+    """
+    try:
+        return image_context.pixel_checksum
+    finally:
+        image_context.close()
 
 
 def _make_dirs_if_exist(path):
@@ -1,6 +1,10 @@
 import argparse
+import json
 import os
+import sys
 
+from image_processing import batch, metrics, preflight
+from image_processing.cache import DerivativeCache
 from image_processing.conversion import Converter
 from image_processing.derivative_files_generator import DerivativeFilesGenerator
 
@@ -27,6 +31,150 @@ def generate_derivatives_from_tiff():
     print('Files created at {0}'.format(output_folder))
 
 
+def generate_derivatives_from_tiffs():
+    """
+    A command line script that runs :func:`~image_processing.batch.BatchDerivativeFilesGenerator.generate_derivatives_from_tiffs`
+    over a folder of TIFFs, or the TIFFs listed in a manifest file
+    """
+    parser = argparse.ArgumentParser(description="Generate JP2s and thumbnails for many TIFFs in parallel. "
+                                                 "Each TIFF gets its own subfolder of the output folder")
+    parser.add_argument('source', help='Folder of tiffs to convert, or a manifest file listing one tiff per line '
+                                       '(optionally followed by a comma and an output folder)')
+    parser.add_argument('-o', '--output_folder', help='Folder to create derivatives in', required=True)
+    parser.add_argument('-k', '--kakadu_path', help='Base path to kakadu executables', required=False, default='/opt/kakadu')
+    parser.add_argument('-w', '--workers', help='Number of worker processes. Defaults to the number of CPUs',
+                        type=int, required=False, default=None)
+    parser.add_argument('-s', '--summary_file', help='Write a JSON summary of the batch to this file',
+                        required=False, default=None)
+    parser.add_argument('-c', '--cache_folder', help='Reuse derivatives of unchanged TIFFs from this cache folder, '
+                                                     'and add new ones to it', required=False, default=None)
+    parser.add_argument('--cache_max_size', help='Maximum size of the cache in MB. Least recently used derivatives '
+                                                 'are removed above this', type=int, required=False, default=None)
+    parser.add_argument('-i', '--incremental', help='Only regenerate derivatives which are missing or out of date, '
+                                                    'using a manifest written to each output folder',
+                        action='store_true')
+    parser.add_argument('--kakadu_threads', help='Threads for each kakadu process, or 0 for single threaded. '
+                                                 'Defaults to sharing the CPUs between the workers',
+                        type=int, required=False, default=None)
+    parser.add_argument('--kakadu_double_buffering', help='Kakadu -double_buffering stripe height in rows',
+                        type=int, required=False, default=None)
+    parser.add_argument('--kakadu_report_cpu', help="Record kakadu's -cpu timings in the summary file",
+                        action='store_true')
+    parser.add_argument('--metrics_file', help='Append the time, CPU, memory and bytes of each stage for each TIFF '
+                                               'to this JSON lines file', required=False, default=None)
+    parser.add_argument('--prometheus_file', help='Write the totals for each stage to this Prometheus text file, '
+                                                  'e.g. for the node exporter textfile collector',
+                        required=False, default=None)
+    parser.add_argument('--memory_budget', help='Most memory in MB for the decoded pixels of each TIFF. Larger '
+                                                'uncompressed TIFFs are processed in strips, and others fail',
+                        type=int, required=False, default=None)
+    parser.add_argument('--exiftool_pool_size', help='Long-running exiftool processes in each worker, or 0 to start '
+                                                     'exiftool for each command. Each worker only converts one TIFF '
+                                                     'at a time, so more than 1 rarely helps',
+                        type=int, required=False, default=1)
+    args = parser.parse_args()
+    output_folder = os.path.abspath(args.output_folder)
+    if os.path.isdir(args.source):
+        jobs = batch.jobs_from_folder(args.source, output_folder)
+    else:
+        jobs = batch.jobs_from_manifest(args.source, output_folder)
+
+    cache = None
+    if args.cache_folder:
+        cache = DerivativeCache(args.cache_folder, max_size_bytes=args.cache_max_size * 1024 * 1024
+                                if args.cache_max_size else None)
+
+    metrics_sinks = []
+    if args.metrics_file:
+        metrics_sinks.append(metrics.JsonLinesSink(args.metrics_file))
+    if args.prometheus_file:
+        metrics_sinks.append(metrics.PrometheusTextFileSink(args.prometheus_file))
+
+    generator_options = {}
+    if args.kakadu_threads is not None:
+        generator_options['kakadu_num_threads'] = args.kakadu_threads
+    if args.memory_budget is not None:
+        generator_options['memory_budget_bytes'] = args.memory_budget * 1024 * 1024
+    batch_generator = batch.BatchDerivativeFilesGenerator(max_workers=args.workers,
+                                                          metrics_sinks=metrics_sinks,
+                                                          require_icc_profile_for_colour=False,
+                                                          require_icc_profile_for_greyscale=False,
+                                                          use_default_filenames=False,
+                                                          kakadu_base_path=args.kakadu_path,
+                                                          exiftool_pool_size=args.exiftool_pool_size,
+                                                          cache=cache,
+                                                          incremental=args.incremental,
+                                                          kakadu_double_buffering=args.kakadu_double_buffering,
+                                                          kakadu_report_cpu=args.kakadu_report_cpu,
+                                                          **generator_options)
+    summary = batch_generator.run(jobs, result_callback=_print_batch_result, include_tiff=False,
+                                  save_jpylyzer_output=True)
+    print(summary)
+    if args.summary_file:
+        with open(args.summary_file, 'w') as f:
+            json.dump(summary.as_dict(), f, indent=2)
+    if summary.failures:
+        sys.exit(1)
+
+
+def _print_batch_result(result):
+    if result.success:
+        print('{0}: files created at {1} ({2:.1f}s)'.format(result.source_filepath, result.output_folder,
+                                                            result.duration))
+    else:
+        print('{0}: FAILED {1}'.format(result.source_filepath, result.error))
+
+
+def preflight_tiffs():
+    """
+    A command line script that runs :func:`~image_processing.preflight.check_source_files` over a folder of TIFFs,
+    or the TIFFs listed in a manifest file, before converting them with convert_tiffs_to_jp2
+    """
+    parser = argparse.ArgumentParser(description="Check which TIFFs in a folder or manifest are suitable for JP2 "
+                                                 "conversion, reading only their headers, and estimate how long "
+                                                 "converting them will take")
+    parser.add_argument('source', help='Folder of tiffs to check, or a manifest file listing one tiff per line '
+                                       '(optionally followed by a comma and an output folder)')
+    parser.add_argument('-r', '--report_file', help='Write a report of every file to this file, as CSV if it ends '
+                                                    'with .csv, otherwise as JSON', required=False, default=None)
+    parser.add_argument('-w', '--workers', help='Number of worker processes. Defaults to the number of CPUs',
+                        type=int, required=False, default=None)
+    parser.add_argument('--require_icc_profile_for_colour', help='Colour TIFFs without an ICC profile are unsuitable',
+                        action='store_true')
+    parser.add_argument('--require_icc_profile_for_greyscale', help='Greyscale TIFFs without an ICC profile are '
+                                                                    'unsuitable', action='store_true')
+    parser.add_argument('--batch_workers', help='Number of workers the conversion will run with, for the time '
+                                                'estimate. Defaults to the number of CPUs',
+                        type=int, required=False, default=None)
+    parser.add_argument('--seconds_per_megabyte', help='Processing time for each MB of TIFF, for the time estimate. '
+                                                       'Defaults to {0}'.format(preflight.DEFAULT_SECONDS_PER_MEGABYTE),
+                        type=float, required=False, default=None)
+    parser.add_argument('--previous_summary_file', help='Measure the processing time for each MB from the summary '
+                                                        'file of a previous convert_tiffs_to_jp2 run',
+                        required=False, default=None)
+    args = parser.parse_args()
+    # only the source files are needed, so manifest lines don't need an output folder
+    if os.path.isdir(args.source):
+        source_filepaths = [source_filepath for source_filepath, _ in batch.jobs_from_folder(args.source, '')]
+    else:
+        source_filepaths = [source_filepath for source_filepath, _ in batch.read_manifest(args.source)]
+
+    seconds_per_megabyte = args.seconds_per_megabyte
+    if seconds_per_megabyte is None and args.previous_summary_file:
+        seconds_per_megabyte = preflight.seconds_per_megabyte_from_batch_summary(args.previous_summary_file)
+    report = preflight.PreflightReport(seconds_per_megabyte=seconds_per_megabyte or
+                                       preflight.DEFAULT_SECONDS_PER_MEGABYTE, workers=args.batch_workers)
+    for result in preflight.check_source_files(source_filepaths, max_workers=args.workers,
+                                               require_icc_profile_for_colour=args.require_icc_profile_for_colour,
+                                               require_icc_profile_for_greyscale=args.require_icc_profile_for_greyscale):
+        report.add(result)
+    print(report)
+    if args.report_file:
+        report.write(args.report_file)
+    if report.unsuitable:
+        sys.exit(1)
+
+
 def convert_icc_profile():
     """
     A basic command line script that runs :func:`~image_processing.conversion.Converter.convert_icc_profile`"
@@ -13,3 +13,7 @@ class KakaduError(ImageProcessingError):
 
 class ValidationError(ImageProcessingError):
     pass
+
+
+class MemoryBudgetError(ImageProcessingError):
+    pass
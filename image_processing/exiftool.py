@@ -0,0 +1,217 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import itertools
+import logging
+import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from image_processing.exceptions import ImageProcessingError
+
+
+class ExifToolProcess(object):
+    """
+    A long-running exiftool process, which reads commands from stdin using ``-stay_open True -@ -``.
+    This avoids the Perl start-up cost of running a separate exiftool process for each command.
+
+    Each command is ended with ``-executeNUM``, which makes exiftool print ``{readyNUM}`` to stdout when the
+    command has finished. ``-echo4`` is used to write the command's exit status to stderr afterwards.
+    stderr is read on a separate thread, so commands with lots of error output can't fill its pipe and block exiftool.
+    Thread-safe: commands from different threads are run one at a time.
+    """
+
+    def __init__(self, exiftool_path='exiftool'):
+        """
+        :param exiftool_path: path to the exiftool executable
+        """
+        self.exiftool_path = exiftool_path
+        self.logger = logging.getLogger(__name__)
+        self._process = None
+        self._stderr_lines = None
+        self._stderr_thread = None
+        self._lock = threading.Lock()
+        self._command_ids = itertools.count(1)
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """
+        Start the exiftool process, if it isn't already running
+        """
+        with self._lock:
+            self._start()
+
+    def stop(self):
+        """
+        Ask exiftool to exit, killing it if it doesn't
+        """
+        with self._lock:
+            self._stop()
+
+    def execute(self, command_options):
+        """
+        Run an exiftool command, restarting the process first if it has died.
+
+        :param command_options: exiftool command line arguments, not including the executable
+        :return: the stdout output of the command
+        :raises subprocess.CalledProcessError: if exiftool reports a non-zero exit status
+        :raises ~image_processing.exceptions.ImageProcessingError: if exiftool keeps exiting unexpectedly
+        """
+        with self._lock:
+            if not self.running:
+                self._start()
+            try:
+                return self._execute(command_options)
+            except (IOError, OSError, EOFError) as e:
+                # the process crashed or was killed mid-command. Restart it and try once more
+                self.logger.warning('exiftool process %s failed (%s). Restarting it', self._pid(), e)
+                self._stop()
+                self._start()
+                try:
+                    return self._execute(command_options)
+                except (IOError, OSError, EOFError) as e:
+                    self._stop()
+                    raise ImageProcessingError('exiftool at {0} failed to run command {1}: {2}'
+                                               .format(self.exiftool_path, ' '.join(command_options), e))
+
+    def _pid(self):
+        return self._process.pid if self._process else None
+
+    def _start(self):
+        if self.running:
+            return
+        self._process = subprocess.Popen([self.exiftool_path, '-stay_open', 'True', '-@', '-'],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stderr_lines = queue.Queue()
+        self._stderr_thread = threading.Thread(target=_drain_lines, args=(self._process.stderr, self._stderr_lines))
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+        self.logger.debug('Started exiftool process %s', self._process.pid)
+
+    def _stop(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write(b'-stay_open\nFalse\n')
+                self._process.stdin.flush()
+                self._process.wait(timeout=5)
+            except (IOError, OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+        # the thread reaches the end of stderr now the process has exited
+        self._stderr_thread.join(timeout=5)
+        for stream in [self._process.stdin, self._process.stdout, self._process.stderr]:
+            stream.close()
+        self._process = None
+        self._stderr_lines = None
+        self._stderr_thread = None
+
+    def _execute(self, command_options):
+        command_id = next(self._command_ids)
+        ready_sentinel = '{{ready{0}}}'.format(command_id).encode('utf-8')
+        status_sentinel = '=post{0}'.format(command_id).encode('utf-8')
+
+        # one argument per line. ${status} is replaced by exiftool with the command's exit status
+        args = list(command_options) + ['-echo4', '=${{status}}=post{0}'.format(command_id),
+                                        '-execute{0}'.format(command_id)]
+        self._process.stdin.write(''.join(arg + '\n' for arg in args).encode('utf-8'))
+        self._process.stdin.flush()
+
+        output, _ = self._read_until(self._process.stdout.readline, ready_sentinel)
+        error_output, status_line = self._read_until(self._stderr_lines.get, status_sentinel)
+
+        try:
+            status = int(status_line.split(b'=')[1])
+        except ValueError:
+            # exiftool versions before 12.10 don't support ${status}, so fall back to looking for errors
+            status = 1 if any(line.startswith(b'Error') for line in error_output) else 0
+
+        output = b''.join(output + error_output).decode('utf-8', 'replace')
+        if status != 0:
+            raise subprocess.CalledProcessError(status, [self.exiftool_path] + list(command_options), output)
+        return output
+
+    @staticmethod
+    def _read_until(read_line, sentinel):
+        """
+        Read lines until one ends with the sentinel
+
+        :param read_line: function returning the next line, or an empty value at the end of the stream
+        :return: the lines before the sentinel, and the sentinel line itself
+        """
+        lines = []
+        while True:
+            line = read_line()
+            if not line:
+                raise EOFError('exiftool exited unexpectedly')
+            stripped_line = line.rstrip()
+            if stripped_line.endswith(sentinel):
+                return lines, stripped_line
+            lines.append(line)
+
+
+def _drain_lines(stream, lines_queue):
+    """
+    Put each line read from the stream on the queue, followed by None at the end of the stream
+    """
+    try:
+        for line in iter(stream.readline, b''):
+            lines_queue.put(line)
+    except (IOError, OSError, ValueError):
+        # the stream was closed
+        pass
+    lines_queue.put(None)
+
+
+class ExifToolPool(object):
+    """
+    A fixed-size pool of :class:`ExifToolProcess`, so several threads can run exiftool commands at once.
+    Processes are started the first time they are needed.
+    """
+
+    def __init__(self, exiftool_path='exiftool', size=1):
+        """
+        :param exiftool_path: path to the exiftool executable
+        :param size: maximum number of exiftool processes
+        """
+        self.exiftool_path = exiftool_path
+        self.size = size
+        self._processes = [ExifToolProcess(exiftool_path) for _ in range(size)]
+        self._available = queue.Queue()
+        for process in self._processes:
+            self._available.put(process)
+
+    def execute(self, command_options):
+        """
+        Run an exiftool command on the next free process. See :func:`ExifToolProcess.execute`
+
+        :param command_options: exiftool command line arguments, not including the executable
+        :return: the stdout output of the command
+        """
+        process = self._available.get()
+        try:
+            return process.execute(command_options)
+        finally:
+            self._available.put(process)
+
+    def close(self):
+        """
+        Stop all the exiftool processes. They will be restarted if the pool is used again
+        """
+        for process in self._processes:
+            process.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import struct
+
+from PIL import Image
+
+# TIFF tags, see PIL.TiffTags.TAGS_V2
+_BITS_PER_SAMPLE = 258
+
+_TIFF_BYTE_ORDERS = {b'II': '<', b'MM': '>'}
+# for classic TIFF (42) and BigTIFF (43): (offset of the first IFD offset, format of an offset, format of the
+# entry count, size of each entry)
+_TIFF_LAYOUTS = {
+    42: (4, 'L', 'H', 12),
+    43: (8, 'Q', 'Q', 20)
+}
+
+
+class ImageInfo(object):
+    """
+    Properties of an image read from its headers only, without decoding or reading through its pixel data.
+    Has the same mode, size, bit_depths, icc_profile and frame_count attributes as
+    :class:`~image_processing.validation.ImageContext`, so can be used for the suitability checks
+    """
+
+    def __init__(self, filepath, format, mode, size, bit_depths=None, icc_profile=None, frame_count=1,
+                 compression=None, file_size=None):
+        """
+        :param filepath:
+        :param format: Pillow format name, e.g. 'TIFF' or 'JPEG'
+        :param mode: Pillow colour mode of the first frame, e.g. 'RGB'
+        :param size: (width, height) tuple
+        :param bit_depths: bits per sample of each channel, or None if unknown
+        :param icc_profile: embedded ICC profile as bytes, or None
+        :param frame_count: number of frames (layers) in the image
+        :param compression: Pillow's name for the compression, e.g. 'raw' or 'tiff_lzw', or None if unknown
+        :param file_size: size of the file in bytes
+        """
+        self.filepath = filepath
+        self.format = format
+        self.mode = mode
+        self.size = size
+        self.bit_depths = bit_depths
+        self.icc_profile = icc_profile
+        self.frame_count = frame_count
+        self.compression = compression
+        self.file_size = file_size
+
+    @property
+    def has_icc_profile(self):
+        return self.icc_profile is not None
+
+    def as_dict(self):
+        return {
+            'filepath': self.filepath,
+            'format': self.format,
+            'mode': self.mode,
+            'width': self.size[0],
+            'height': self.size[1],
+            'bit_depths': list(self.bit_depths) if self.bit_depths is not None else None,
+            'has_icc_profile': self.has_icc_profile,
+            'frame_count': self.frame_count,
+            'compression': self.compression,
+            'file_size': self.file_size
+        }
+
+
+def inspect_image(image_filepath):
+    """
+    Read the properties of an image from its headers. Only the first frame's header is parsed, and other frames
+    are counted by following the chain of TIFF image directories, so this stays quick for large and multi-layer
+    files
+
+    :param image_filepath:
+    :return: an :class:`ImageInfo`
+    """
+    # Pillow only reads the header when opening an image. The pixels are decoded on load, which isn't called
+    with Image.open(image_filepath) as pil_image:
+        if pil_image.format == 'TIFF':
+            bit_depths = pil_image.tag_v2.get(_BITS_PER_SAMPLE)
+            with open(image_filepath, 'rb') as tiff_file:
+                frame_count = count_tiff_frames(tiff_file)
+        else:
+            bits = getattr(pil_image, 'bits', None)
+            bit_depths = (bits,) * len(pil_image.getbands()) if bits else None
+            frame_count = getattr(pil_image, 'n_frames', 1)
+        return ImageInfo(image_filepath, pil_image.format, pil_image.mode, pil_image.size,
+                         bit_depths=tuple(bit_depths) if bit_depths is not None else None,
+                         icc_profile=pil_image.info.get('icc_profile'), frame_count=frame_count,
+                         compression=pil_image.info.get('compression'), file_size=os.path.getsize(image_filepath))
+
+
+def count_frames(image_filepath):
+    """
+    Count the frames (layers) in an image without reading their pixels. See :func:`count_tiff_frames`
+    """
+    with open(image_filepath, 'rb') as image_file:
+        if image_file.read(2) in _TIFF_BYTE_ORDERS:
+            return count_tiff_frames(image_file)
+        image_file.seek(0)
+        with Image.open(image_file) as pil_image:
+            return getattr(pil_image, 'n_frames', 1)
+
+
+def count_tiff_frames(tiff_file):
+    """
+    Count the image file directories (frames) of a classic TIFF or BigTIFF, reading only each directory's entry count
+    and the offset of the next one. Stops at a truncated directory or a loop in the chain
+
+    :param tiff_file: binary file object. Its position is changed
+    :return: number of frames
+    """
+    tiff_file.seek(0)
+    header = tiff_file.read(16)
+    byte_order = _TIFF_BYTE_ORDERS.get(header[:2])
+    if byte_order is None:
+        raise ValueError('Not a TIFF file')
+    version = struct.unpack(byte_order + 'H', header[2:4])[0]
+    if version not in _TIFF_LAYOUTS:
+        raise ValueError('Unsupported TIFF version {0}'.format(version))
+    first_offset_position, offset_format, count_format, entry_size = _TIFF_LAYOUTS[version]
+    offset_struct = struct.Struct(byte_order + offset_format)
+    count_struct = struct.Struct(byte_order + count_format)
+
+    offset = offset_struct.unpack_from(header, first_offset_position)[0]
+    visited_offsets = set()
+    frame_count = 0
+    while offset and offset not in visited_offsets:
+        visited_offsets.add(offset)
+        tiff_file.seek(offset)
+        count_data = tiff_file.read(count_struct.size)
+        if len(count_data) < count_struct.size:
+            break
+        tiff_file.seek(offset + count_struct.size + count_struct.unpack(count_data)[0] * entry_size)
+        frame_count += 1
+        offset_data = tiff_file.read(offset_struct.size)
+        if len(offset_data) < offset_struct.size:
+            break
+        offset = offset_struct.unpack(offset_data)[0]
+    return frame_count
@@ -0,0 +1,247 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import shutil
+import struct
+import tempfile
+
+from image_processing.exceptions import ImageProcessingError
+
+JP2_HEADER_BOX = b'jp2h'
+IMAGE_HEADER_BOX = b'ihdr'
+COLOUR_SPECIFICATION_BOX = b'colr'
+CODESTREAM_BOX = b'jp2c'
+UUID_BOX = b'uuid'
+# the UUID of a box containing an XMP packet, as written by exiftool and Adobe software
+XMP_UUID = b'\xbe\x7a\xcf\xcb\x97\xa9\x42\xe8\x9c\x71\x99\x94\x91\xe3\xaf\xac'
+# codestream markers. See ISO/IEC 15444-1 Annex A
+START_OF_CODESTREAM_MARKER = b'\xff\x4f'
+CODING_STYLE_DEFAULT_MARKER = b'\xff\x52'
+START_OF_TILE_MARKER = b'\xff\x90'
+# colour specification methods which are followed by an embedded ICC profile
+ICC_COLOUR_METHODS = [2, 3]
+
+
+def iter_boxes(file_obj, end_offset=None):
+    """
+    Iterate over the JP2 boxes in a file, starting at the file object's current position.
+    See ISO/IEC 15444-1 Annex I for the box structure.
+
+    :param file_obj: binary file object, positioned at the start of a box
+    :param end_offset: stop at this offset. If None, continue to the end of the file
+    :return: generator of (box type, offset of the box contents, length of the box contents) tuples.
+        The length is None if the box extends to the end of the file
+    """
+    offset = file_obj.tell()
+    while end_offset is None or offset < end_offset:
+        file_obj.seek(offset)
+        header = file_obj.read(8)
+        if len(header) == 0:
+            return
+        if len(header) < 8:
+            raise ImageProcessingError('Truncated JP2 box header at offset {0}'.format(offset))
+        box_length, box_type = struct.unpack('>I4s', header)
+        header_length = 8
+        if box_length == 1:
+            # the real length is in the 8 bytes after the box type
+            box_length = struct.unpack('>Q', file_obj.read(8))[0]
+            header_length = 16
+        if box_length == 0:
+            yield box_type, offset + header_length, None
+            return
+        if box_length < header_length:
+            raise ImageProcessingError('Invalid JP2 box length {0} at offset {1}'.format(box_length, offset))
+        yield box_type, offset + header_length, box_length - header_length
+        offset += box_length
+
+
+def _read_jp2_header_box(jp2_filepath, sub_box_type):
+    """
+    Read the contents of a box inside the JP2 header box
+
+    :return: the box contents, or None if there is no such box
+    """
+    with open(jp2_filepath, 'rb') as jp2_file:
+        for box_type, contents_offset, contents_length in iter_boxes(jp2_file):
+            if box_type != JP2_HEADER_BOX:
+                continue
+            end_offset = contents_offset + contents_length if contents_length is not None else None
+            jp2_file.seek(contents_offset)
+            for found_box_type, sub_contents_offset, sub_contents_length in iter_boxes(jp2_file, end_offset):
+                if found_box_type == sub_box_type:
+                    jp2_file.seek(sub_contents_offset)
+                    return jp2_file.read(sub_contents_length) if sub_contents_length is not None else jp2_file.read()
+            return None
+    raise ImageProcessingError('{0} has no JP2 header box'.format(jp2_filepath))
+
+
+def get_image_header(jp2_filepath):
+    """
+    Read the image size, number of components and bit depth from the image header box of a JP2 file, without
+    decoding the image
+
+    :param jp2_filepath:
+    :return: tuple of ((width, height), number of components, bits per component). Bits per component is None if it
+        varies between components
+    """
+    contents = _read_jp2_header_box(jp2_filepath, IMAGE_HEADER_BOX)
+    if contents is None or len(contents) < 14:
+        raise ImageProcessingError('{0} has no valid image header box'.format(jp2_filepath))
+    height, width, components, bits_per_component = struct.unpack('>IIHB', contents[:11])
+    # 255 means the bit depths are in a separate box. Otherwise, the low 7 bits are the bit depth minus one,
+    # and the high bit is set for signed values
+    bit_depth = None if bits_per_component == 255 else (bits_per_component & 0x7f) + 1
+    return (width, height), components, bit_depth
+
+
+def get_icc_profile(jp2_filepath):
+    """
+    Read the ICC profile from the colour specification box of a JP2 file, without decoding the image
+
+    :param jp2_filepath:
+    :return: the ICC profile bytes, or None if the colour space is specified by an enumerated value instead
+    """
+    contents = _read_jp2_header_box(jp2_filepath, COLOUR_SPECIFICATION_BOX)
+    # METH, PREC and APPROX fields are one byte each, followed by the profile if METH is 2 or 3
+    if contents and contents[0] in ICC_COLOUR_METHODS:
+        return contents[3:]
+    return None
+
+
+def get_decomposition_levels(jp2_filepath):
+    """
+    Read the number of wavelet decomposition levels from the main header of a JP2 file's codestream.
+    kdu_expand can reduce the image by any power of two up to 2^levels without decoding the full resolution
+
+    :param jp2_filepath:
+    """
+    with open(jp2_filepath, 'rb') as jp2_file:
+        for box_type, contents_offset, _ in iter_boxes(jp2_file):
+            if box_type != CODESTREAM_BOX:
+                continue
+            jp2_file.seek(contents_offset)
+            if jp2_file.read(2) != START_OF_CODESTREAM_MARKER:
+                raise ImageProcessingError('{0} has an invalid codestream'.format(jp2_filepath))
+            # each marker segment in the main header is the marker, then its length (including the length field)
+            marker = jp2_file.read(2)
+            while len(marker) == 2 and marker != START_OF_TILE_MARKER:
+                segment_length = struct.unpack('>H', jp2_file.read(2))[0]
+                segment = jp2_file.read(segment_length - 2)
+                if marker == CODING_STYLE_DEFAULT_MARKER:
+                    # Scod (1 byte), progression order (1), layers (2), multiple component transform (1), then levels
+                    return segment[5]
+                marker = jp2_file.read(2)
+            break
+    raise ImageProcessingError('Could not find the coding style of {0}'.format(jp2_filepath))
+
+
+def get_xmp_packet(jp2_filepath):
+    """
+    Read the XMP packet from the XMP UUID box of a JP2 file
+
+    :param jp2_filepath:
+    :return: the packet bytes, or None if there is no XMP box
+    """
+    with open(jp2_filepath, 'rb') as jp2_file:
+        for box_type, contents_offset, contents_length in iter_boxes(jp2_file):
+            if box_type != UUID_BOX:
+                continue
+            jp2_file.seek(contents_offset)
+            if jp2_file.read(len(XMP_UUID)) == XMP_UUID:
+                return jp2_file.read(contents_length - len(XMP_UUID)) if contents_length is not None \
+                    else jp2_file.read()
+    return None
+
+
+def append_xmp_box(jp2_filepath, xmp_packet):
+    """
+    Write an XMP packet to a JP2 file as a UUID box after the codestream, without parsing or re-encoding the rest of
+    the file. An XMP box already at the end of the file is replaced. If the codestream box extends to the end of the
+    file (a length of 0), its real length is written into its header.
+    The file is changed in place, and put back as it was if writing fails. If it has other hard links (e.g. from a
+    :class:`~image_processing.cache.DerivativeCache`), the changes are made to a copy which then replaces it, so the
+    linked files keep their contents
+
+    :param jp2_filepath:
+    :param xmp_packet: XMP packet bytes
+    :return: True if the box was written. False if it can't be without rewriting the file: if there is already an
+        XMP box which isn't the last box, or the codestream's box header is too small for its length
+    """
+    with open(jp2_filepath, 'rb') as jp2_file:
+        file_size = jp2_file.seek(0, os.SEEK_END)
+        jp2_file.seek(0)
+        codestream_box = None
+        xmp_box_offset = None
+        box_offset = 0
+        for box_type, contents_offset, contents_length in iter_boxes(jp2_file):
+            if xmp_box_offset is not None:
+                # the existing xmp box isn't at the end of the file
+                return False
+            if box_type == CODESTREAM_BOX:
+                codestream_box = (box_offset, contents_offset, contents_length)
+            elif box_type == UUID_BOX:
+                jp2_file.seek(contents_offset)
+                if jp2_file.read(len(XMP_UUID)) == XMP_UUID:
+                    if codestream_box is None:
+                        return False
+                    xmp_box_offset = box_offset
+            box_offset = file_size if contents_length is None else contents_offset + contents_length
+    if codestream_box is None:
+        raise ImageProcessingError('{0} has no codestream box'.format(jp2_filepath))
+
+    codestream_box_offset, codestream_contents_offset, codestream_contents_length = codestream_box
+    codestream_box_length = None
+    if codestream_contents_length is None:
+        codestream_box_length = file_size - codestream_box_offset
+        # a length of 0 only fits in the 4 byte length of a standard box header
+        if codestream_contents_offset - codestream_box_offset != 8 or codestream_box_length > 0xffffffff:
+            return False
+    xmp_box_offset = file_size if xmp_box_offset is None else xmp_box_offset
+
+    if os.stat(jp2_filepath).st_nlink == 1:
+        with open(jp2_filepath, 'r+b') as jp2_file:
+            # only the existing xmp box is overwritten, so it is all that's needed to undo the changes
+            jp2_file.seek(xmp_box_offset)
+            original_end = jp2_file.read()
+            try:
+                _write_xmp_box(jp2_file, xmp_packet, xmp_box_offset, codestream_box_offset, codestream_box_length)
+            except BaseException:
+                jp2_file.truncate(xmp_box_offset)
+                jp2_file.seek(xmp_box_offset)
+                jp2_file.write(original_end)
+                if codestream_box_length is not None:
+                    jp2_file.seek(codestream_box_offset)
+                    jp2_file.write(struct.pack('>I', 0))
+                raise
+        return True
+
+    temp_fd, temp_filepath = tempfile.mkstemp(prefix='image-processing_', suffix='.jp2',
+                                              dir=os.path.dirname(os.path.abspath(jp2_filepath)))
+    os.close(temp_fd)
+    try:
+        shutil.copy(jp2_filepath, temp_filepath)
+        with open(temp_filepath, 'r+b') as temp_file:
+            _write_xmp_box(temp_file, xmp_packet, xmp_box_offset, codestream_box_offset, codestream_box_length)
+        os.replace(temp_filepath, jp2_filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+    return True
+
+
+def _write_xmp_box(jp2_file, xmp_packet, xmp_box_offset, codestream_box_offset, codestream_box_length):
+    """
+    Write the XMP box at xmp_box_offset, and the codestream box length if it isn't None
+    """
+    if codestream_box_length is not None:
+        jp2_file.seek(codestream_box_offset)
+        jp2_file.write(struct.pack('>I', codestream_box_length))
+    jp2_file.seek(xmp_box_offset)
+    jp2_file.write(struct.pack('>I4s', 8 + len(XMP_UUID) + len(xmp_packet), UUID_BOX))
+    jp2_file.write(XMP_UUID)
+    jp2_file.write(xmp_packet)
+    jp2_file.truncate()
+    jp2_file.flush()
@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import struct
+
+from image_processing.exceptions import ImageProcessingError
+
+# JPEG markers. See ITU-T T.81 Annex B
+START_OF_IMAGE_MARKER = b'\xff\xd8'
+COMMENT_MARKER = b'\xff\xfe'
+# APP0 to APP15 hold the metadata: JFIF, EXIF and XMP (APP1), ICC profiles (APP2), IPTC (APP13) etc.
+APPLICATION_MARKERS = [bytes([0xff, 0xe0 + n]) for n in range(16)]
+
+
+def iter_segments(data):
+    """
+    Iterate over the marker segments at the start of a JPEG, up to the first one which isn't metadata (usually the
+    quantisation tables).
+
+    :param data: the JPEG, or at least its header, as bytes or a memoryview
+    :return: generator of (marker, offset of the segment, length of the segment including its marker) tuples
+    """
+    if bytes(data[:2]) != START_OF_IMAGE_MARKER:
+        raise ImageProcessingError('Not a JPEG file')
+    offset = 2
+    while True:
+        marker = bytes(data[offset:offset + 2])
+        if marker not in APPLICATION_MARKERS and marker != COMMENT_MARKER:
+            return
+        if offset + 4 > len(data):
+            raise ImageProcessingError('Truncated JPEG segment at offset {0}'.format(offset))
+        # the length includes the length field, but not the marker
+        segment_length = struct.unpack('>H', data[offset + 2:offset + 4])[0] + 2
+        yield marker, offset, segment_length
+        offset += segment_length
+
+
+def get_metadata_length(data):
+    """
+    The length of the start of image marker and the metadata segments at the start of a JPEG, i.e. the offset of the
+    first segment which isn't metadata
+    """
+    end_offset = 2
+    for _, offset, segment_length in iter_segments(data):
+        end_offset = offset + segment_length
+    return end_offset
+
+
+def get_metadata_segments(data):
+    """
+    Read the metadata segments at the start of a JPEG, so they can be transplanted to another JPEG with
+    :func:`write_with_metadata_segments`
+
+    :param data: the JPEG as bytes or a memoryview
+    :return: the segments as bytes, without the start of image marker
+    """
+    return bytes(data[2:get_metadata_length(data)])
+
+
+def write_with_metadata_segments(file_obj, data, metadata_segments):
+    """
+    Write a JPEG, replacing the metadata segments at its start
+
+    :param file_obj: binary file object to write to
+    :param data: the JPEG as bytes or a memoryview
+    :param metadata_segments: from :func:`get_metadata_segments`
+    """
+    file_obj.write(START_OF_IMAGE_MARKER)
+    file_obj.write(metadata_segments)
+    file_obj.write(data[get_metadata_length(data):])
+
+
+class MetadataSegmentsWriter(object):
+    """
+    A binary file-like object for Pillow to save a JPEG to, which writes it to another file with the metadata
+    segments at its start replaced, like :func:`write_with_metadata_segments`. Only the start of the JPEG, up to the
+    end of the metadata segments Pillow writes, is held in memory. The rest is passed straight through
+    """
+
+    def __init__(self, file_obj, metadata_segments):
+        """
+        :param file_obj: binary file object to write to
+        :param metadata_segments: from :func:`get_metadata_segments`
+        """
+        self.file_obj = file_obj
+        self.metadata_segments = metadata_segments
+        self._header = bytearray()
+
+    def write(self, data):
+        if self._header is None:
+            return self.file_obj.write(data)
+        self._header += data
+        metadata_length = _find_metadata_length(self._header)
+        if metadata_length is not None:
+            self.file_obj.write(START_OF_IMAGE_MARKER)
+            self.file_obj.write(self.metadata_segments)
+            self.file_obj.write(self._header[metadata_length:])
+            self._header = None
+        return len(data)
+
+    def flush(self):
+        self.file_obj.flush()
+
+    def finish(self):
+        """
+        Raise an error if the JPEG ended before its metadata segments did
+        """
+        if self._header is not None:
+            raise ImageProcessingError('Truncated JPEG: only {0} bytes were written'.format(len(self._header)))
+
+
+def _find_metadata_length(data):
+    """
+    Like :func:`get_metadata_length`, for the start of a JPEG which may be incomplete
+
+    :return: the length, or None if more of the JPEG is needed to find it
+    """
+    if len(data) < 2:
+        return None
+    if bytes(data[:2]) != START_OF_IMAGE_MARKER:
+        raise ImageProcessingError('Not a JPEG file')
+    offset = 2
+    while True:
+        if offset + 2 > len(data):
+            return None
+        marker = bytes(data[offset:offset + 2])
+        if marker not in APPLICATION_MARKERS and marker != COMMENT_MARKER:
+            return offset
+        if offset + 4 > len(data):
+            return None
+        offset += struct.unpack('>H', bytes(data[offset + 2:offset + 4]))[0] + 2
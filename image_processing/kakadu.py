@@ -2,11 +2,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import math
 import os
+import re
+import shutil
 import subprocess
 import logging
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from image_processing.exceptions import KakaduError
-from image_processing import utils
+from image_processing import metrics, utils
 
 DEFAULT_COMPRESS_OPTIONS = [
     'Clevels=6',
@@ -36,18 +43,147 @@ LOSSY_OPTIONS = ["-rate", '3']
 ALPHA_OPTION = '-jp2_alpha'
 """:func:`~image_processing.kakadu.Kakadu.kdu_compress` command line option for images with alpha channels"""
 
+DEFAULT_RESOLUTION_LEVELS = 5
+"""Number of wavelet decomposition levels kdu_compress uses if Clevels isn't given"""
+
+NUM_THREADS_OPTION = '-num_threads'
+DOUBLE_BUFFERING_OPTION = '-double_buffering'
+CPU_OPTION = '-cpu'
+
+# lines kakadu prints with -cpu, e.g. "Processing time = 1.234 s; i.e., 0.0567 us/sample"
+_CPU_TIME_PATTERN = re.compile(r'(?:processing|end-to-end(?: cpu)?) time\s*=\s*([0-9.]+)\s*s', re.IGNORECASE)
+_SAMPLE_TIME_PATTERN = re.compile(r'([0-9.]+)\s*us/sample')
+_THREADS_PATTERN = re.compile(r'(\d+) parallel threads')
+
+
+def get_resolution_levels(kakadu_options):
+    """
+    Find the number of wavelet decomposition levels set by kdu_compress options. A JP2 with n levels can be expanded
+    at full size, or reduced by any power of two up to 2^n
+
+    :param kakadu_options: kdu_compress command line arguments
+    """
+    for option in kakadu_options:
+        if option.startswith('Clevels='):
+            return int(option.split('=', 1)[1])
+    return DEFAULT_RESOLUTION_LEVELS
+
+
+def get_reduced_size(image_size, reduce_level):
+    """
+    The size of an image expanded with ``-reduce reduce_level``
+
+    :param image_size: (width, height) of the full image
+    :param reduce_level:
+    """
+    return tuple(int(math.ceil(dimension / 2 ** reduce_level)) for dimension in image_size)
+
+
+def get_reduce_level(image_size, target_size, resolution_levels):
+    """
+    Find the largest ``-reduce`` level for kdu_expand which still gives an image at least as big as the target size,
+    so it only needs to be shrunk, never enlarged
+
+    :param image_size: (width, height) of the full image
+    :param target_size: (width, height) needed
+    :param resolution_levels: number of resolution levels in the JP2. See :func:`get_resolution_levels`
+    """
+    reduce_level = 0
+    while reduce_level < resolution_levels and all(
+            reduced >= target for reduced, target in zip(get_reduced_size(image_size, reduce_level + 1), target_size)):
+        reduce_level += 1
+    return reduce_level
+
+
+def get_default_num_threads(concurrent_processes=1):
+    """
+    A thread count for each kakadu process, so that this many of them running at once don't use more threads than
+    there are CPUs. Kakadu's own default is one thread per CPU for every process
+
+    :param concurrent_processes: number of kakadu processes that may run at once, e.g. the number of batch workers
+    :return: number of threads, or 0 for kakadu's single threaded mode if there is only one CPU per process,
+        which avoids the overhead of its multi-threading
+    """
+    num_threads = (os.cpu_count() or 1) // max(concurrent_processes, 1)
+    return num_threads if num_threads > 1 else 0
+
+
+class KakaduMetrics(object):
+    """
+    Timings of one kakadu command, from the output of its ``-cpu`` option
+    """
+
+    def __init__(self, command, input_option, output_filepath, wall_time, cpu_time=None,
+                 microseconds_per_sample=None, num_threads=None):
+        """
+        :param command: kdu_compress or kdu_expand
+        :param input_option: the -i argument
+        :param output_filepath:
+        :param wall_time: seconds the command took, including starting it
+        :param cpu_time: processing time kakadu reported, in seconds. None if it wasn't reported
+        :param microseconds_per_sample: processing time per image sample kakadu reported
+        :param num_threads: number of threads kakadu reported using. None if it was single threaded
+        """
+        self.command = command
+        self.input_option = input_option
+        self.output_filepath = output_filepath
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.microseconds_per_sample = microseconds_per_sample
+        self.num_threads = num_threads
+
+    @classmethod
+    def from_output(cls, command, input_option, output_filepath, wall_time, output):
+        """
+        Parse the ``-cpu`` report from kakadu's output
+
+        :param output: the text kakadu printed
+        """
+        cpu_time_match = _CPU_TIME_PATTERN.search(output)
+        sample_time_match = _SAMPLE_TIME_PATTERN.search(output)
+        threads_match = _THREADS_PATTERN.search(output)
+        return cls(command, input_option, output_filepath, wall_time,
+                   cpu_time=float(cpu_time_match.group(1)) if cpu_time_match else None,
+                   microseconds_per_sample=float(sample_time_match.group(1)) if sample_time_match else None,
+                   num_threads=int(threads_match.group(1)) if threads_match else None)
+
+    def as_dict(self):
+        return {
+            'command': self.command,
+            'input': self.input_option,
+            'output': self.output_filepath,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'microseconds_per_sample': self.microseconds_per_sample,
+            'num_threads': self.num_threads
+        }
+
 
 class Kakadu(object):
     """
     Python wrapper for jp2 compression and expansion functions in Kakadu (http://kakadusoftware.com/)
     """
 
-    def __init__(self, kakadu_base_path):
+    def __init__(self, kakadu_base_path, num_threads=None, double_buffering=None, report_cpu=False):
         """
         :param kakadu_base_path: The location of the kdu_compress and kdu_expand executables
+        :param num_threads: ``-num_threads`` for every command: the number of threads each kakadu process uses,
+            or 0 to run single threaded. None uses kakadu's default of one thread per CPU.
+            See :func:`get_default_num_threads` when running several kakadu processes at once
+        :param double_buffering: ``-double_buffering`` for every command: the height in rows of the image stripes
+            that are processed while the previous ones are read or written. Only used with multiple threads.
+            None uses kakadu's default
+        :param report_cpu: run every command with ``-cpu 0``, and record its timings as a :class:`KakaduMetrics`.
+            See :func:`pop_metrics`
         """
         self.kakadu_base_path = kakadu_base_path
+        self.num_threads = num_threads
+        self.double_buffering = double_buffering
+        self.report_cpu = report_cpu
         self.log = logging.getLogger(__name__)
+        self._version = None
+        self._metrics = []
+        self._metrics_lock = threading.Lock()
         if not utils.cmd_is_executable(self._command_path('kdu_compress')):
             raise OSError("Could not find executable {0}. Check kakadu is installed and kdu_compress exists at the configured path"
                           .format(self._command_path('kdu_compress')))
@@ -59,6 +195,46 @@ class Kakadu(object):
     def _command_path(self, command):
         return os.path.join(self.kakadu_base_path, command)
 
+    def version(self):
+        """
+        The version information printed by ``kdu_compress -version``, e.g. to tell whether outputs were generated by
+        the same kakadu build. Only run once per instance.
+
+        :return: the version output, stripped of surrounding whitespace
+        """
+        if self._version is None:
+            try:
+                output = subprocess.check_output([self._command_path('kdu_compress'), '-version'],
+                                                 stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                # some kakadu versions exit with an error after printing the version
+                output = e.output
+            self._version = output.decode('utf-8', 'replace').strip()
+        return self._version
+
+    def pop_metrics(self):
+        """
+        The metrics recorded since this was last called, if report_cpu is set
+
+        :return: list of :class:`KakaduMetrics`, in the order the commands finished
+        """
+        with self._metrics_lock:
+            metrics, self._metrics = self._metrics, []
+        return metrics
+
+    def _get_performance_options(self, kakadu_options):
+        """
+        Command line options for the thread, buffering and cpu settings, unless they are already in kakadu_options
+        """
+        options = []
+        if self.num_threads is not None and NUM_THREADS_OPTION not in kakadu_options:
+            options += [NUM_THREADS_OPTION, str(self.num_threads)]
+        if self.double_buffering is not None and DOUBLE_BUFFERING_OPTION not in kakadu_options:
+            options += [DOUBLE_BUFFERING_OPTION, str(self.double_buffering)]
+        if self.report_cpu and CPU_OPTION not in kakadu_options:
+            options += [CPU_OPTION, '0']
+        return options
+
     def kdu_compress(self, input_filepaths, output_filepath, kakadu_options):
         """
         Converts an image file supported by kakadu to jpeg2000
@@ -81,7 +257,77 @@ class Kakadu(object):
         """
         self.run_command('kdu_expand', input_filepath, output_filepath, kakadu_options)
 
+    @contextmanager
+    def kdu_expand_to_stream(self, input_filepath, output_extension, kakadu_options):
+        """
+        Run kdu_expand with its output going to a named pipe instead of a file, so the expanded image can be read
+        as it is decoded without being written to disk.
+        Only use formats kakadu writes sequentially, like .ppm and .pgm - formats like TIFF may need to seek.
+
+        Use as a context manager, which yields a binary file object to read the output from.
+        Raises a :class:`~image_processing.exceptions.KakaduError` on exit if kdu_expand failed
+
+        :param input_filepath:
+        :param output_extension: file extension kakadu uses to choose the output format, e.g. '.ppm'
+        :param kakadu_options: command line arguments
+        """
+        pipe_folder = tempfile.mkdtemp(prefix='kdu_expand_')
+        pipe_filepath = os.path.join(pipe_folder, 'expanded' + output_extension)
+        os.mkfifo(pipe_filepath)
+        # Hold a write end open until kdu_expand has exited. Without it the reader would see an end of file before
+        # kdu_expand opens the pipe, or wait forever if kdu_expand fails before opening it
+        read_fd = os.open(pipe_filepath, os.O_RDONLY | os.O_NONBLOCK)
+        placeholder_write_fd = os.open(pipe_filepath, os.O_WRONLY)
+        os.set_blocking(read_fd, True)
+        errors = []
+
+        def expand():
+            try:
+                self.kdu_expand(input_filepath, pipe_filepath, kakadu_options)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                os.close(placeholder_write_fd)
+
+        expand_thread = threading.Thread(target=metrics.bind_recorder(expand))
+        expand_thread.start()
+        try:
+            with os.fdopen(read_fd, 'rb') as output_stream:
+                try:
+                    yield output_stream
+                finally:
+                    # read whatever the caller didn't, so kdu_expand can finish writing and exit
+                    while output_stream.read(1048576):
+                        pass
+        finally:
+            expand_thread.join()
+            shutil.rmtree(pipe_folder)
+            if errors:
+                # kdu_expand failing is the underlying cause of any error reading its output
+                raise errors[0]
+
     def run_command(self, command, input_files, output_file, kakadu_options):
+        command_options, input_option = self.get_command(command, input_files, output_file, kakadu_options)
+
+        start_time = time.perf_counter()
+        try:
+            with metrics.record_stage(command, input_filepaths=input_files, output_filepaths=output_file):
+                if self.report_cpu:
+                    # the output is captured to read the timings from
+                    output = subprocess.check_output(command_options, stderr=subprocess.STDOUT)
+                else:
+                    output = None
+                    subprocess.check_call(command_options, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            self.raise_command_error(command, input_option, command_options, e)
+        self.record_output(command, input_option, output_file, time.perf_counter() - start_time, output)
+
+    def get_command(self, command, input_files, output_file, kakadu_options):
+        """
+        Check the files can be accessed, and build the command line for a kakadu command
+
+        :return: tuple of the command line arguments, including the executable, and the -i argument
+        """
         if not isinstance(input_files, list):
             input_files = [input_files]
 
@@ -96,11 +342,35 @@ class Kakadu(object):
         input_option = ",".join(["{0}".format(item) for item in input_files])
 
         command_options = [self._command_path(command), '-i', input_option, '-o', output_file] + kakadu_options
+        command_options += self._get_performance_options(kakadu_options)
 
         self.log.debug(' '.join(['"{0}"'.format(c) if ('{' in c or ' ' in c) else c for c in command_options]))
+        return command_options, input_option
 
-        try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise KakaduError('Kakadu {0} failed on {1}. Command: {2}, Error: {3}'.
-                              format(command, input_option, ' '.join(command_options), e))
+    def raise_command_error(self, command, input_option, command_options, error):
+        """
+        Raise a :class:`~image_processing.exceptions.KakaduError` for a failed command
+
+        :param error: the :class:`subprocess.CalledProcessError`
+        """
+        if error.output:
+            # the output was captured, so wouldn't otherwise be seen
+            self.log.error(error.output.decode('utf-8', 'replace').strip())
+        raise KakaduError('Kakadu {0} failed on {1}. Command: {2}, Error: {3}'.
+                          format(command, input_option, ' '.join(command_options), error))
+
+    def record_output(self, command, input_option, output_file, wall_time, output):
+        """
+        Log the output of a successful command, and record its metrics if report_cpu is set
+
+        :param output: bytes the command printed, or None if it wasn't captured
+        """
+        if output is None:
+            return
+        output = output.decode('utf-8', 'replace')
+        if output.strip():
+            self.log.debug(output.strip())
+        if self.report_cpu:
+            metrics = KakaduMetrics.from_output(command, input_option, output_file, wall_time, output)
+            with self._metrics_lock:
+                self._metrics.append(metrics)
@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import json
+import logging
+import os
+import tempfile
+
+from image_processing.cache import hash_file
+
+MANIFEST_FORMAT_VERSION = 1
+
+
+class DerivativeManifest(object):
+    """
+    A record of the derivatives generated from a source file, stored as JSON alongside them.
+
+    For the source file, it records the modification time, size and sha256 checksum. For each derivative, it records
+    the parameters it was generated with and the size, modification time and sha256 checksum of the file.
+    This is used to tell which derivatives are still up to date on a re-run, so only missing or stale ones need to be
+    generated again.
+    """
+
+    def __init__(self, manifest_filepath):
+        """
+        Load the manifest if it exists, or start an empty one
+
+        :param manifest_filepath:
+        """
+        self.filepath = manifest_filepath
+        self.output_folder = os.path.dirname(manifest_filepath)
+        self.log = logging.getLogger(__name__)
+        self.source = None
+        self.derivatives = {}
+        self._source_is_current = None
+        if os.path.isfile(manifest_filepath):
+            try:
+                with open(manifest_filepath) as f:
+                    contents = json.load(f)
+                if contents.get('version') == MANIFEST_FORMAT_VERSION:
+                    self.source = contents['source']
+                    self.derivatives = contents['derivatives']
+                else:
+                    self.log.warning('Ignoring manifest {0} with unsupported version {1}'
+                                     .format(manifest_filepath, contents.get('version')))
+            except (ValueError, KeyError) as e:
+                self.log.warning('Ignoring unreadable manifest {0}: {1}'.format(manifest_filepath, e))
+
+    def source_is_current(self, source_filepath):
+        """
+        Check whether the source file is the same one the recorded derivatives were generated from.
+        The checksum is only compared if the modification time or size have changed.
+
+        :param source_filepath:
+        """
+        if self._source_is_current is None:
+            self._source_is_current = self.source is not None and _file_matches(source_filepath, self.source)
+        return self._source_is_current
+
+    def is_up_to_date(self, source_filepath, role, derivative_filepath, parameters):
+        """
+        Check whether a derivative can be reused: it must have been generated from the current source file with the
+        same parameters, and not have been changed since
+
+        :param source_filepath:
+        :param role: name of the derivative, e.g. its default filename
+        :param derivative_filepath:
+        :param parameters: JSON serialisable dict of the parameters the derivative would be generated with
+        """
+        record = self.derivatives.get(role)
+        if record is None or not self.source_is_current(source_filepath):
+            return False
+        return record['filename'] == os.path.basename(derivative_filepath) \
+            and record['parameters'] == _normalise(parameters) \
+            and _file_matches(derivative_filepath, record)
+
+    def record_source(self, source_filepath):
+        """
+        Record the source file the derivatives are generated from. Clears the derivatives recorded for any
+        previous version of the source file
+
+        :param source_filepath:
+        """
+        if not self.source_is_current(source_filepath):
+            self.derivatives = {}
+        self.source = _describe_file(source_filepath)
+        self.source['filepath'] = os.path.abspath(source_filepath)
+        self._source_is_current = True
+
+    def record(self, role, derivative_filepath, parameters):
+        """
+        Record a derivative which has just been generated
+
+        :param role: name of the derivative, e.g. its default filename
+        :param derivative_filepath:
+        :param parameters: JSON serialisable dict of the parameters the derivative was generated with
+        """
+        record = _describe_file(derivative_filepath)
+        record['filename'] = os.path.basename(derivative_filepath)
+        record['parameters'] = _normalise(parameters)
+        self.derivatives[role] = record
+
+    def save(self):
+        """
+        Write the manifest, replacing the previous one atomically
+        """
+        file_descriptor, temp_filepath = tempfile.mkstemp(prefix='.manifest_', dir=self.output_folder)
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump({'version': MANIFEST_FORMAT_VERSION, 'source': self.source, 'derivatives': self.derivatives},
+                          f, indent=2, sort_keys=True)
+            os.replace(temp_filepath, self.filepath)
+        except Exception:
+            os.remove(temp_filepath)
+            raise
+
+
+def _describe_file(filepath):
+    stat = os.stat(filepath)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': hash_file(filepath)}
+
+
+def _file_matches(filepath, record):
+    """
+    Check a file against its recorded size and checksum. If the modification time and size are unchanged, the
+    checksum isn't checked, so files aren't read again unless they look like they've changed
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return False
+    if stat.st_size != record['size']:
+        return False
+    if stat.st_mtime == record['mtime']:
+        return True
+    return hash_file(filepath) == record['sha256']
+
+
+def _normalise(parameters):
+    # round trip through JSON, so e.g. tuples compare equal to the lists they're loaded as
+    return json.loads(json.dumps(parameters, sort_keys=True))
@@ -0,0 +1,369 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import logging
+import math
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+from PIL import Image, TiffImagePlugin, TiffTags
+
+from image_processing import exceptions
+
+_PIXEL_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2}
+"""Bytes Pillow uses to hold each pixel of a decoded image, for modes which don't use 4"""
+
+_FILTER_SUPPORT = {
+    Image.Resampling.NEAREST: 0.5,
+    Image.Resampling.BOX: 0.5,
+    Image.Resampling.BILINEAR: 1.0,
+    Image.Resampling.HAMMING: 1.0,
+    Image.Resampling.BICUBIC: 2.0,
+    Image.Resampling.LANCZOS: 3.0
+}
+"""Radius in source pixels of each resampling filter, when not shrinking"""
+
+_MAX_TIFF_SIZE = 2 ** 32 - 1
+
+# TIFF tags, see PIL.TiffTags.TAGS_V2
+_BITS_PER_SAMPLE = 258
+_ORIENTATION = 274
+_SAMPLES_PER_PIXEL = 277
+_PLANAR_CONFIGURATION = 284
+
+
+def decoded_size(colour_mode, size):
+    """
+    Memory in bytes Pillow needs to hold the decoded pixels of an image
+
+    :param colour_mode: Pillow colour mode, e.g. 'RGB'
+    :param size: (width, height) tuple
+    """
+    return size[0] * size[1] * _PIXEL_BYTES.get(colour_mode, 4)
+
+
+def can_read_in_strips(pil_image):
+    """
+    Check whether :class:`StripReader` can read an image: an uncompressed TIFF, stored in strips or tiles with the
+    colour channels interleaved, and without an orientation that Pillow would rotate it by
+
+    :param pil_image: opened :class:`PIL.Image`, whose pixels don't need to be loaded
+    """
+    if pil_image.format != 'TIFF' or not pil_image.tile or getattr(pil_image, 'use_load_libtiff', True):
+        return False
+    if pil_image.tag_v2.get(_PLANAR_CONFIGURATION, 1) != 1 or pil_image.tag_v2.get(_ORIENTATION, 1) != 1:
+        return False
+    return all(codec == 'raw' and args[2] == 1 for codec, _, _, args in pil_image.tile)
+
+
+class MemoryBudget(object):
+    """
+    A limit on the memory used to hold the decoded pixels of an image. Images which would go over it are read in
+    strips instead (see :class:`StripReader`), and work which can't be done in strips, e.g. decoding a compressed
+    TIFF or making a full size JPEG, raises a :class:`~image_processing.exceptions.MemoryBudgetError` rather than
+    using more.
+
+    The budget is for pixel data, which is most of the memory used by large images. It doesn't include the Python
+    interpreter, or kakadu and exiftool, which run as separate processes.
+    """
+
+    def __init__(self, max_bytes, strip_bytes=None):
+        """
+        :param max_bytes: most memory to use for the decoded pixels of an image
+        :param strip_bytes: most memory to use for the pixels of each strip. Defaults to an eighth of max_bytes, as a
+            strip, copies of it and the output (e.g. a thumbnail) may be held at the same time
+        """
+        if max_bytes < 1:
+            raise ValueError('Invalid memory budget {0}'.format(max_bytes))
+        self.max_bytes = max_bytes
+        self.strip_bytes = strip_bytes or max(max_bytes // 8, 1)
+
+    def __repr__(self):
+        return 'MemoryBudget(max_bytes={0!r}, strip_bytes={1!r})'.format(self.max_bytes, self.strip_bytes)
+
+    def fits(self, colour_mode, size):
+        """
+        :return: True if an image of this colour mode and size can be decoded all at once
+        """
+        return decoded_size(colour_mode, size) <= self.max_bytes
+
+    def check(self, colour_mode, size, description):
+        """
+        Raise a :class:`~image_processing.exceptions.MemoryBudgetError` if an image of this colour mode and size
+        can't be decoded all at once
+
+        :param description: what needs the image, for the error message
+        """
+        if not self.fits(colour_mode, size):
+            raise exceptions.MemoryBudgetError(
+                '{0} needs {1:.1f} MB for a {2} {3}x{4} image, over the memory budget of {5:.1f} MB'
+                .format(description, decoded_size(colour_mode, size) / 1024 ** 2, colour_mode, size[0], size[1],
+                        self.max_bytes / 1024 ** 2))
+
+    def needs_strips(self, image_filepath, pil_image=None):
+        """
+        Check whether an image has to be read in strips to stay within the budget.
+        Raises a :class:`~image_processing.exceptions.MemoryBudgetError` if it is over the budget, but can't be read
+        in strips
+
+        :param image_filepath:
+        :param pil_image: if not None, the image already opened, whose pixels don't need to be loaded
+        :return: True if the image is over the budget, False if it can be decoded all at once
+        """
+        if pil_image is None:
+            with Image.open(image_filepath) as pil_image:
+                return self.needs_strips(image_filepath, pil_image)
+        if self.fits(pil_image.mode, pil_image.size):
+            return False
+        if not can_read_in_strips(pil_image):
+            self.check(pil_image.mode, pil_image.size,
+                       '{0} is not an uncompressed TIFF, so decoding it'.format(image_filepath))
+        return True
+
+    def strip_height(self, colour_mode, width):
+        """
+        Number of rows in each strip of an image of this colour mode and width
+        """
+        return max(self.strip_bytes // decoded_size(colour_mode, (width, 1)), 1)
+
+
+class StripReader(object):
+    """
+    Reads horizontal strips of an uncompressed TIFF, decoding only the rows asked for.
+    Check the image is supported with :func:`can_read_in_strips` first.
+    """
+
+    def __init__(self, image_filepath):
+        self.filepath = image_filepath
+        with Image.open(image_filepath) as pil_image:
+            if not can_read_in_strips(pil_image):
+                raise ValueError('{0} is not an uncompressed TIFF, so cannot be read in strips'.format(image_filepath))
+            self.mode = pil_image.mode
+            self.size = pil_image.size
+            self.info = dict(pil_image.info)
+            self._tiles = list(pil_image.tile)
+            self._palette = pil_image.getpalette() if pil_image.mode == 'P' else None
+            bits = pil_image.tag_v2.get(_BITS_PER_SAMPLE, (1,))
+            samples = pil_image.tag_v2.get(_SAMPLES_PER_PIXEL, 1)
+            if len(bits) == 1 and samples > 1:
+                bits = bits * samples
+            self._bits_per_pixel = sum(bits)
+
+    def read_rows(self, upper, lower):
+        """
+        Decode the rows from upper up to (but not including) lower
+
+        :return: a loaded :class:`PIL.Image` of the rows
+        """
+        if upper < 0 or lower > self.size[1] or upper >= lower:
+            raise ValueError('Rows {0} to {1} are outside {2}'.format(upper, lower, self.filepath))
+        strip = Image.new(self.mode, (self.size[0], lower - upper))
+        with open(self.filepath, 'rb') as image_file:
+            for codec, (left, tile_upper, right, tile_lower), offset, (rawmode, stride, orientation) in self._tiles:
+                if tile_lower <= upper or tile_upper >= lower:
+                    continue
+                # the rows of a strip or tile are stored one after another, so only the rows needed are read.
+                # A stride of 0 means the rows are the width of the tile
+                row_bytes = stride or ((right - left) * self._bits_per_pixel + 7) // 8
+                first_row = max(tile_upper, upper)
+                last_row = min(tile_lower, lower)
+                image_file.seek(offset + (first_row - tile_upper) * row_bytes)
+                tile_pil = Image.frombytes(self.mode, (right - left, last_row - first_row),
+                                           image_file.read((last_row - first_row) * row_bytes), codec, rawmode,
+                                           stride, orientation)
+                strip.paste(tile_pil, (left, first_row - upper))
+        if self._palette is not None:
+            strip.putpalette(self._palette)
+        return strip
+
+    def iter_strips(self, strip_height):
+        """
+        Decode the image from top to bottom, strip_height rows at a time
+
+        :return: iterator of (upper row, :class:`PIL.Image` of the strip) tuples
+        """
+        for upper in range(0, self.size[1], strip_height):
+            yield upper, self.read_rows(upper, min(upper + strip_height, self.size[1]))
+
+
+def raw_row_length(colour_mode, width):
+    """
+    Number of bytes in each row of pixels in the layout of Pillow's raw encoder, i.e. of
+    :func:`PIL.Image.Image.tobytes`
+    """
+    return len(Image.new(colour_mode, (width, 1)).tobytes())
+
+
+def find_contiguous_pixel_data(pil_image):
+    """
+    Find where the pixel data of an uncompressed TIFF is, if its strips are stored one after another in the same
+    layout as Pillow's raw encoder, so the bytes in the file are the same as :func:`PIL.Image.Image.tobytes`
+
+    :param pil_image: opened :class:`PIL.Image`, whose pixels haven't been loaded
+    :return: (offset, length) tuple of the pixel data in the file, or None if it isn't stored that way
+    """
+    if not can_read_in_strips(pil_image):
+        return None
+    width, height = pil_image.size
+    row_length = raw_row_length(pil_image.mode, width)
+    start = pil_image.tile[0][2]
+    next_upper, next_offset = 0, start
+    for _, (left, upper, right, lower), offset, (rawmode, stride, _) in pil_image.tile:
+        if rawmode != pil_image.mode or stride not in (0, row_length) or (left, right) != (0, width) \
+                or upper != next_upper or offset != next_offset:
+            return None
+        next_upper = lower
+        next_offset = offset + (lower - upper) * row_length
+    if next_upper != height:
+        return None
+    return start, height * row_length
+
+
+@contextmanager
+def map_pixel_data(image_filepath, pil_image=None):
+    """
+    Memory-map the pixel data of an uncompressed TIFF, without decoding or copying it.
+    Only works for TIFFs found by :func:`find_contiguous_pixel_data`, which covers most uncompressed TIFFs. For
+    anything else, this gives None, so the caller can fall back to decoding the image with Pillow.
+
+    Slices of the memoryview must not be kept after the context exits.
+
+    :param image_filepath:
+    :param pil_image: if not None, the image already opened. Its pixels may have been loaded
+    :return: context manager giving a read-only memoryview of the pixel data, or None
+    """
+    if pil_image is None or not pil_image.tile:
+        # the strip layout isn't kept once the pixels are loaded, so the header is read again
+        with Image.open(image_filepath) as header_image:
+            pixel_data_location = find_contiguous_pixel_data(header_image)
+    else:
+        pixel_data_location = find_contiguous_pixel_data(pil_image)
+    if pixel_data_location is None:
+        yield None
+        return
+    offset, length = pixel_data_location
+    with open(image_filepath, 'rb') as image_file:
+        if length == 0 or os.fstat(image_file.fileno()).st_size < offset + length:
+            # truncated files are left for Pillow to report
+            yield None
+            return
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            pixel_data = memoryview(mapped_file)[offset:offset + length]
+            try:
+                yield pixel_data
+            finally:
+                pixel_data.release()
+
+
+def resize_in_strips(strip_reader, size, resample, reducing_gap=None, strip_height=256, colour_mode=None):
+    """
+    Resize an image read in strips, so only a strip and the output are held in memory at once.
+    Matches :func:`PIL.Image.Image.resize` of the whole image with the same options, apart from rare rounding
+    differences.
+
+    :param strip_reader: :class:`StripReader` for the image
+    :param size: (width, height) of the output
+    :param resample: Pillow resampling filter
+    :param reducing_gap: see :func:`PIL.Image.Image.resize`
+    :param strip_height: number of source rows to decode at a time
+    :param colour_mode: if not None, convert each strip to this colour mode before resizing it
+    :return: the resized :class:`PIL.Image`
+    """
+    width, height = strip_reader.size
+    output_mode = colour_mode or strip_reader.mode
+
+    def read_rows(upper, lower):
+        strip = strip_reader.read_rows(upper, lower)
+        return strip.convert(colour_mode) if colour_mode and strip.mode != colour_mode else strip
+
+    if output_mode in ['1', 'P']:
+        # as in Pillow's resize
+        resample = Image.Resampling.NEAREST
+
+    if reducing_gap is not None and resample != Image.Resampling.NEAREST:
+        factor_x = int(width / size[0] / reducing_gap) or 1
+        factor_y = int(height / size[1] / reducing_gap) or 1
+        if factor_x > 1 or factor_y > 1:
+            # box reduce each strip, then resample the reduced image, like Pillow's resize does for the whole image.
+            # Strips are a whole number of reduction boxes high, so the reduced strips are the same
+            reduced_image = Image.new(output_mode, (int(math.ceil(width / factor_x)),
+                                                    int(math.ceil(height / factor_y))))
+            reduce_height = max(strip_height // factor_y, 1) * factor_y
+            for upper in range(0, height, reduce_height):
+                strip = read_rows(upper, min(upper + reduce_height, height))
+                reduced_image.paste(strip.reduce((factor_x, factor_y)), (0, upper // factor_y))
+            return reduced_image.resize(size, resample, box=(0, 0, width / factor_x, height / factor_y))
+
+    # each strip of output rows is resampled from the source rows within the filter's reach
+    output_image = Image.new(output_mode, size)
+    scale = height / size[1]
+    support = _FILTER_SUPPORT[resample] * max(scale, 1.0)
+    output_strip_height = max(int(strip_height / scale), 1)
+    for output_upper in range(0, size[1], output_strip_height):
+        output_lower = min(output_upper + output_strip_height, size[1])
+        box_upper = output_upper * scale
+        box_lower = output_lower * scale
+        upper = max(int(box_upper - support) - 1, 0)
+        lower = min(int(math.ceil(box_lower + support)) + 1, height)
+        strip = read_rows(upper, lower)
+        output_image.paste(strip.resize((size[0], output_lower - output_upper), resample,
+                                        box=(0, box_upper - upper, width, box_lower - upper)), (0, output_upper))
+    return output_image
+
+
+def write_tiff_in_strips(output_filepath, colour_mode, size, strips, icc_profile=None):
+    """
+    Write an uncompressed TIFF a strip of rows at a time, so the whole image never has to be in memory.
+    The rows are stored as a single TIFF strip, which :class:`StripReader` can still read in strips
+
+    :param output_filepath:
+    :param colour_mode: Pillow colour mode of the strips
+    :param size: (width, height) of the whole image
+    :param strips: iterable of :class:`PIL.Image` strips of rows, from top to bottom
+    :param icc_profile: ICC profile to embed, as bytes
+    """
+    if colour_mode not in TiffImagePlugin.SAVE_INFO:
+        raise ValueError('Cannot write a {0} TIFF'.format(colour_mode))
+    rawmode, prefix, photometric, sample_format, bits, extra_samples = TiffImagePlugin.SAVE_INFO[colour_mode]
+    width, height = size
+    data_size = len(bits) * ((width * bits[0] + 7) // 8) * height
+
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=prefix)
+    ifd[256] = width
+    ifd[257] = height
+    ifd[258] = bits if len(bits) > 1 else bits[0]
+    ifd[259] = 1  # no compression
+    ifd[262] = photometric
+    # relative to the end of the image directory, where the pixel data is written
+    ifd[273] = 0
+    ifd[277] = len(bits)
+    ifd[278] = height
+    ifd[279] = data_size
+    ifd[284] = 1  # contiguous
+    if sample_format != 1:
+        ifd[339] = sample_format
+    if extra_samples is not None:
+        ifd[338] = extra_samples
+    if icc_profile:
+        ifd[34675] = icc_profile
+    for tag in [273, 278, 279]:
+        ifd.tagtype[tag] = TiffTags.LONG
+    header = prefix + struct.pack('<HL' if prefix == TiffImagePlugin.II else '>HL', 42, 8) + ifd.tobytes(8)
+    if len(header) + data_size > _MAX_TIFF_SIZE:
+        raise ValueError('{0} would be over 4GB, which is too big for a TIFF'.format(output_filepath))
+
+    rows_written = 0
+    with open(output_filepath, 'wb') as output_file:
+        output_file.write(header)
+        for strip in strips:
+            if strip.mode != colour_mode or strip.size[0] != width:
+                raise ValueError('Strip of {0} {1} does not match the {2} {3} image'
+                                 .format(strip.mode, strip.size, colour_mode, size))
+            output_file.write(strip.tobytes('raw', rawmode))
+            rows_written += strip.size[1]
+    if rows_written != height:
+        raise ValueError('Strips have {0} rows, not the {1} of the image'.format(rows_written, height))
+    logging.getLogger(__name__).debug('Wrote {0} a strip at a time'.format(output_filepath))
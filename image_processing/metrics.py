@@ -0,0 +1,315 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import abc
+import contextvars
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: peak memory and the CPU time of commands aren't recorded
+    resource = None
+
+STAGES = ['validate', 'jpg', 'xmp', 'tiff_copy', 'kdu_compress', 'metadata_copy', 'jpylyzer', 'kdu_expand',
+          'checksum']
+"""Names of the stages recorded while generating derivatives"""
+
+_current_recorder = contextvars.ContextVar('image_processing_metrics_recorder', default=None)
+
+
+class StageMetrics(object):
+    """
+    Resource use of one stage of generating derivatives, e.g. one kdu_compress command
+    """
+
+    def __init__(self, stage, wall_time, cpu_time, peak_rss_bytes=None, peak_child_rss_bytes=None, bytes_read=0,
+                 bytes_written=0, succeeded=True):
+        """
+        :param stage: name of the stage, from :data:`STAGES`
+        :param wall_time: elapsed time in seconds
+        :param cpu_time: CPU time in seconds used by the thread running the stage, plus any commands it ran.
+            When stages run concurrently, commands finishing during the stage are counted even if another stage
+            started them
+        :param peak_rss_bytes: highest resident memory of this process so far, or None if unknown
+        :param peak_child_rss_bytes: highest resident memory of any command run so far, or None if unknown
+        :param bytes_read: total size of the stage's input files
+        :param bytes_written: total size of the stage's output files
+        :param succeeded: false if the stage raised an error
+        """
+        self.stage = stage
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss_bytes = peak_rss_bytes
+        self.peak_child_rss_bytes = peak_child_rss_bytes
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.succeeded = succeeded
+
+    @classmethod
+    def from_dict(cls, metrics_dict):
+        """
+        :param metrics_dict: output of :func:`as_dict`
+        """
+        return cls(**metrics_dict)
+
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'peak_child_rss_bytes': self.peak_child_rss_bytes,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'succeeded': self.succeeded
+        }
+
+
+class MetricsRecorder(object):
+    """
+    Collects the :class:`StageMetrics` of the stages run while it is the current recorder (see :func:`recording`).
+    Thread-safe.
+    """
+
+    def __init__(self, parent=None):
+        """
+        :param parent: if not None, a recorder which also records every stage recorded by this one
+        """
+        self.parent = parent
+        self._stages = []
+        self._lock = threading.Lock()
+
+    @property
+    def stages(self):
+        """
+        List of the :class:`StageMetrics` recorded, in the order the stages finished
+        """
+        with self._lock:
+            return list(self._stages)
+
+    def record(self, stage_metrics):
+        with self._lock:
+            self._stages.append(stage_metrics)
+        if self.parent is not None:
+            self.parent.record(stage_metrics)
+
+
+@contextmanager
+def recording():
+    """
+    Context manager which records the stages run inside it, including on threads started with functions wrapped by
+    :func:`bind_recorder`. Yields the :class:`MetricsRecorder`. Stages are also recorded by any enclosing recording
+    """
+    recorder = MetricsRecorder(parent=_current_recorder.get())
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+
+
+def bind_recorder(function):
+    """
+    Wrap a function to be run on another thread, so the stages it runs are recorded by the current recorder
+
+    :param function:
+    :return: the wrapped function, or function itself if nothing is being recorded
+    """
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return function
+
+    def bound_function(*args, **kwargs):
+        token = _current_recorder.set(recorder)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current_recorder.reset(token)
+    return bound_function
+
+
+@contextmanager
+def record_stage(stage, input_filepaths=None, output_filepaths=None):
+    """
+    Context manager which records the resource use of the code inside it as a :class:`StageMetrics`, if there is a
+    current recorder. Does nothing otherwise.
+
+    :param stage: name of the stage, from :data:`STAGES`
+    :param input_filepaths: filepath or list of filepaths the stage reads, used for bytes_read
+    :param output_filepaths: filepath or list of filepaths the stage writes, used for bytes_written
+    """
+    recorder = _current_recorder.get()
+    if recorder is None:
+        yield
+        return
+
+    start_wall_time = time.perf_counter()
+    start_cpu_time = _get_cpu_time()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        peak_rss_bytes, peak_child_rss_bytes = _get_peak_rss()
+        recorder.record(StageMetrics(stage, wall_time=time.perf_counter() - start_wall_time,
+                                     cpu_time=_get_cpu_time() - start_cpu_time, peak_rss_bytes=peak_rss_bytes,
+                                     peak_child_rss_bytes=peak_child_rss_bytes,
+                                     bytes_read=_get_total_size(input_filepaths),
+                                     bytes_written=_get_total_size(output_filepaths), succeeded=succeeded))
+
+
+def summarise(stage_metrics):
+    """
+    Totals for each stage
+
+    :param stage_metrics: list of :class:`StageMetrics`
+    :return: dict of stage name to a dict of count, failures, wall_time, cpu_time, bytes_read, bytes_written and
+        peak_rss_bytes (the highest of peak_rss_bytes and peak_child_rss_bytes)
+    """
+    totals = {}
+    for metrics in stage_metrics:
+        stage_totals = totals.setdefault(metrics.stage, {'count': 0, 'failures': 0, 'wall_time': 0.0,
+                                                         'cpu_time': 0.0, 'bytes_read': 0, 'bytes_written': 0,
+                                                         'peak_rss_bytes': 0})
+        stage_totals['count'] += 1
+        stage_totals['failures'] += 0 if metrics.succeeded else 1
+        stage_totals['wall_time'] += metrics.wall_time
+        stage_totals['cpu_time'] += metrics.cpu_time
+        stage_totals['bytes_read'] += metrics.bytes_read
+        stage_totals['bytes_written'] += metrics.bytes_written
+        stage_totals['peak_rss_bytes'] = max([stage_totals['peak_rss_bytes'], metrics.peak_rss_bytes or 0,
+                                              metrics.peak_child_rss_bytes or 0])
+    return totals
+
+
+class MetricsSink(abc.ABC):
+    """
+    Somewhere to export :class:`StageMetrics` to. Subclasses implement :func:`write`
+    """
+
+    @abc.abstractmethod
+    def write(self, stage_metrics, source_filepath=None):
+        """
+        :param stage_metrics: list of :class:`StageMetrics` for one source file
+        :param source_filepath: the source file the derivatives were generated from
+        """
+
+
+class JsonLinesSink(MetricsSink):
+    """
+    Appends each :class:`StageMetrics` to a file as a line of JSON, with the source filepath
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+
+    def write(self, stage_metrics, source_filepath=None):
+        lines = []
+        for metrics in stage_metrics:
+            metrics_dict = metrics.as_dict()
+            metrics_dict['source_filepath'] = source_filepath
+            lines.append(json.dumps(metrics_dict, sort_keys=True) + '\n')
+        with self._lock, open(self.filepath, 'a') as output_file:
+            # one write per source file, so lines from processes appending to the same file don't interleave
+            output_file.write(''.join(lines))
+
+
+class PrometheusTextFileSink(MetricsSink):
+    """
+    Keeps running totals for each stage, and rewrites them to a file in the Prometheus text format after every write,
+    e.g. for the node exporter's textfile collector. The totals are for this instance, so each process should write
+    to its own file
+    """
+
+    def __init__(self, filepath, prefix='image_processing'):
+        """
+        :param filepath: should end with .prom for the node exporter to read it
+        :param prefix: prefix of the metric names
+        """
+        self.filepath = filepath
+        self.prefix = prefix
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def write(self, stage_metrics, source_filepath=None):
+        with self._lock:
+            for stage, stage_totals in summarise(stage_metrics).items():
+                running_totals = self._totals.setdefault(stage, dict.fromkeys(stage_totals, 0))
+                for key, value in stage_totals.items():
+                    if key == 'peak_rss_bytes':
+                        running_totals[key] = max(running_totals[key], value)
+                    else:
+                        running_totals[key] += value
+            self._write_file(self._totals)
+
+    def _write_file(self, totals):
+        lines = []
+        for name, metric_type, key, help_text in [
+                ('stage_runs_total', 'counter', 'count', 'Number of times the stage ran'),
+                ('stage_failures_total', 'counter', 'failures', 'Number of times the stage raised an error'),
+                ('stage_wall_seconds_total', 'counter', 'wall_time', 'Elapsed time spent in the stage'),
+                ('stage_cpu_seconds_total', 'counter', 'cpu_time', 'CPU time used by the stage and its commands'),
+                ('stage_read_bytes_total', 'counter', 'bytes_read', 'Size of the files the stage read'),
+                ('stage_written_bytes_total', 'counter', 'bytes_written', 'Size of the files the stage wrote'),
+                ('stage_peak_rss_bytes', 'gauge', 'peak_rss_bytes', 'Highest resident memory seen by the stage')]:
+            metric_name = '{0}_{1}'.format(self.prefix, name)
+            lines.append('# HELP {0} {1}'.format(metric_name, help_text))
+            lines.append('# TYPE {0} {1}'.format(metric_name, metric_type))
+            for stage in sorted(totals):
+                lines.append('{0}{{stage="{1}"}} {2}'.format(metric_name, stage, totals[stage][key]))
+
+        # written to a temporary file and renamed, so the file is never read half written
+        output_folder = os.path.dirname(os.path.abspath(self.filepath))
+        file_descriptor, temp_filepath = tempfile.mkstemp(dir=output_folder, prefix='.metrics_', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as output_file:
+                output_file.write('\n'.join(lines) + '\n')
+            os.replace(temp_filepath, self.filepath)
+        except Exception:
+            os.remove(temp_filepath)
+            raise
+
+
+def _get_cpu_time():
+    """
+    CPU time of the current thread, plus all the child processes which have finished
+    """
+    cpu_time = time.thread_time()
+    if resource is not None:
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time += child_usage.ru_utime + child_usage.ru_stime
+    return cpu_time
+
+
+def _get_peak_rss():
+    """
+    :return: tuple of the peak resident memory in bytes of this process and of its largest child process,
+        or (None, None) if unknown
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def _get_total_size(filepaths):
+    if filepaths is None:
+        return 0
+    if not isinstance(filepaths, (list, tuple)):
+        filepaths = [filepaths]
+    total_size = 0
+    for filepath in filepaths:
+        if os.path.isfile(filepath):
+            total_size += os.path.getsize(filepath)
+    return total_size
@@ -0,0 +1,241 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import csv
+import json
+import logging
+import os
+from concurrent import futures
+
+from image_processing import inspection, validation
+
+DEFAULT_SECONDS_PER_MEGABYTE = 0.1
+"""Rough time to generate the derivatives of each MB of source TIFF on one CPU, including kakadu and the lossless
+check. Use :func:`seconds_per_megabyte_from_batch_summary` to measure it for your own collection and machines"""
+
+_CSV_FIELDS = ['source_filepath', 'suitable', 'error', 'warnings', 'format', 'mode', 'width', 'height', 'bit_depths',
+               'has_icc_profile', 'frame_count', 'compression', 'file_size']
+
+
+class PreflightResult(object):
+    """
+    The outcome of checking one source file before generating its derivatives
+    """
+
+    def __init__(self, source_filepath, file_size=0, image_info=None, warnings=None, error=None):
+        """
+        :param source_filepath:
+        :param file_size: size of the source file in bytes
+        :param image_info: :class:`~image_processing.inspection.ImageInfo` dict for the file, if it could be read
+        :param warnings: warnings from the suitability check
+        :param error: description of why the file is unsuitable, if it is
+        """
+        self.source_filepath = source_filepath
+        self.file_size = file_size
+        self.image_info = image_info
+        self.warnings = warnings or []
+        self.error = error
+
+    @property
+    def suitable(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            'source_filepath': self.source_filepath,
+            'file_size': self.file_size,
+            'image_info': self.image_info,
+            'warnings': self.warnings,
+            'error': self.error
+        }
+
+
+class PreflightReport(object):
+    """
+    Collects :class:`PreflightResult` instances, and estimates how long generating the derivatives of the suitable
+    files will take
+    """
+
+    def __init__(self, seconds_per_megabyte=DEFAULT_SECONDS_PER_MEGABYTE, workers=None):
+        """
+        :param seconds_per_megabyte: processing time for each MB of source file, used for the estimates
+        :param workers: number of worker processes the batch will run with. Defaults to the number of CPUs
+        """
+        self.results = []
+        self.seconds_per_megabyte = seconds_per_megabyte
+        self.workers = workers or os.cpu_count() or 1
+
+    def add(self, result):
+        self.results.append(result)
+
+    @property
+    def suitable(self):
+        return [result for result in self.results if result.suitable]
+
+    @property
+    def unsuitable(self):
+        return [result for result in self.results if not result.suitable]
+
+    @property
+    def with_warnings(self):
+        return [result for result in self.results if result.suitable and result.warnings]
+
+    @property
+    def total_bytes(self):
+        """
+        Total size of the suitable files
+        """
+        return sum(result.file_size for result in self.suitable)
+
+    @property
+    def estimated_processing_time(self):
+        """
+        Estimated sum of the time spent on each suitable file, in seconds
+        """
+        return self.total_bytes / 1024 ** 2 * self.seconds_per_megabyte
+
+    @property
+    def estimated_wall_time(self):
+        """
+        Estimated time for the batch to run with the given number of workers, in seconds
+        """
+        return self.estimated_processing_time / self.workers
+
+    def as_dict(self):
+        return {
+            'total': len(self.results),
+            'suitable': len(self.suitable),
+            'unsuitable': len(self.unsuitable),
+            'with_warnings': len(self.with_warnings),
+            'total_bytes': self.total_bytes,
+            'seconds_per_megabyte': self.seconds_per_megabyte,
+            'workers': self.workers,
+            'estimated_processing_time': self.estimated_processing_time,
+            'estimated_wall_time': self.estimated_wall_time,
+            'results': [result.as_dict() for result in self.results]
+        }
+
+    def write_json(self, report_filepath):
+        with open(report_filepath, 'w') as report_file:
+            json.dump(self.as_dict(), report_file, indent=2)
+
+    def write_csv(self, report_filepath):
+        """
+        Write a row for each file, with its image properties
+        """
+        with open(report_filepath, 'w', newline='') as report_file:
+            writer = csv.DictWriter(report_file, fieldnames=_CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for result in self.results:
+                row = dict(result.image_info or {})
+                row.update({
+                    'source_filepath': result.source_filepath,
+                    'suitable': result.suitable,
+                    'error': result.error or '',
+                    'warnings': '; '.join(result.warnings),
+                    'file_size': result.file_size
+                })
+                if row.get('bit_depths') is not None:
+                    row['bit_depths'] = ' '.join(str(bit_depth) for bit_depth in row['bit_depths'])
+                writer.writerow(row)
+
+    def write(self, report_filepath):
+        """
+        Write the report as CSV if the filepath ends with .csv, otherwise as JSON
+        """
+        if os.path.splitext(report_filepath)[1].lower() == '.csv':
+            self.write_csv(report_filepath)
+        else:
+            self.write_json(report_filepath)
+
+    def __str__(self):
+        lines = ['Checked {0} files: {1} suitable ({2} with warnings), {3} unsuitable'
+                 .format(len(self.results), len(self.suitable), len(self.with_warnings), len(self.unsuitable)),
+                 'Estimated processing time for {0:.1f} MB: {1:.0f}s in total, {2:.0f}s with {3} worker(s)'
+                 .format(self.total_bytes / 1024 ** 2, self.estimated_processing_time, self.estimated_wall_time,
+                         self.workers)]
+        lines += ['  UNSUITABLE {0}: {1}'.format(result.source_filepath, result.error) for result in self.unsuitable]
+        return '\n'.join(lines)
+
+
+def check_source_file(source_filepath, require_icc_profile_for_greyscale=False, require_icc_profile_for_colour=True):
+    """
+    Run the suitability checks of :func:`~image_processing.validation.check_image_suitable_for_jp2_conversion` on a
+    source file, reading only its headers. Errors are recorded on the result rather than raised
+
+    :return: a :class:`PreflightResult`
+    """
+    image_info = None
+    try:
+        image_info = inspection.inspect_image(source_filepath)
+        warnings = validation.check_image_suitable_for_jp2_conversion(
+            source_filepath, require_icc_profile_for_greyscale=require_icc_profile_for_greyscale,
+            require_icc_profile_for_colour=require_icc_profile_for_colour, image_context=image_info)
+    except Exception as e:
+        # the exception is recorded as a string, as not all exceptions can be pickled back to the parent process
+        return PreflightResult(source_filepath, file_size=_get_file_size(source_filepath),
+                               image_info=image_info.as_dict() if image_info is not None else None,
+                               error='{0}: {1}'.format(type(e).__name__, e))
+    return PreflightResult(source_filepath, file_size=image_info.file_size, image_info=image_info.as_dict(),
+                           warnings=warnings)
+
+
+def check_source_files(source_filepaths, max_workers=None, **check_options):
+    """
+    Run :func:`check_source_file` over many files on a pool of worker processes
+
+    :param source_filepaths: iterable of filepaths
+    :param max_workers: number of worker processes. Defaults to the number of CPUs. With 1, the files are checked in
+        this process
+    :param check_options: keyword arguments for :func:`check_source_file`
+    :return: iterator of :class:`PreflightResult`, in the same order as source_filepaths
+    """
+    source_filepaths = list(source_filepaths)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(source_filepaths))
+    if max_workers <= 1:
+        for source_filepath in source_filepaths:
+            yield check_source_file(source_filepath, **check_options)
+        return
+    # only the headers are read, so each task is quick. Send many files to a worker at a time
+    chunk_size = max(len(source_filepaths) // (max_workers * 4), 1)
+    with futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_initialise_worker) as executor:
+        for result in executor.map(_check_source_file, source_filepaths, [check_options] * len(source_filepaths),
+                                   chunksize=chunk_size):
+            yield result
+
+
+def seconds_per_megabyte_from_batch_summary(summary_filepath):
+    """
+    Measure the processing time for each MB of source file from a previous batch, using the summary file written by
+    ``convert_tiffs_to_jp2 --summary_file``. Only successful files which still exist are counted
+
+    :return: seconds per MB, or None if the summary has no usable results
+    """
+    with open(summary_filepath) as summary_file:
+        summary = json.load(summary_file)
+    total_duration = 0.0
+    total_bytes = 0
+    for result in summary['results']:
+        if result['error'] is None and os.path.isfile(result['source_filepath']):
+            total_duration += result['duration']
+            total_bytes += os.path.getsize(result['source_filepath'])
+    if not total_bytes:
+        return None
+    return total_duration / (total_bytes / 1024 ** 2)
+
+
+def _initialise_worker():
+    # the warnings are collected in the report, rather than logged by every worker
+    logging.getLogger(validation.__name__).setLevel(logging.ERROR)
+
+
+def _check_source_file(source_filepath, check_options):
+    return check_source_file(source_filepath, **check_options)
+
+
+def _get_file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
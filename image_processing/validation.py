@@ -5,10 +5,24 @@ from __future__ import division
 from jpylyzer.jpylyzer import checkOneFile
 from xml.etree import ElementTree
 from xml.dom import minidom
-from PIL import Image, ImageSequence
-from image_processing import exceptions
+from PIL import Image
+from image_processing import exceptions, inspection, memory, metrics
 import logging
-from hashlib import sha256
+import os
+import threading
+from concurrent import futures
+import hashlib
+import hmac
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 GREYSCALE = 'L'
@@ -16,6 +30,237 @@ BITONAL = '1'
 MONOTONE_COLOUR_MODES = [GREYSCALE, BITONAL]
 ACCEPTED_COLOUR_MODES = ['RGB', 'RGBA', 'RGBX', 'I;16', GREYSCALE, BITONAL]
 
+DEFAULT_COMPARISON_STRIP_HEIGHT = 256
+"""Number of rows in each strip compared by :func:`find_pixel_difference`"""
+
+PNM_EXTENSIONS = {'RGB': '.ppm', GREYSCALE: '.pgm'}
+"""Colour modes which can be streamed as binary PPM or PGM files, and the file extension for each"""
+_PNM_MAGIC_NUMBERS = {b'P6': 'RGB', b'P5': GREYSCALE}
+_PNM_BANDS = {'RGB': 3, GREYSCALE: 1}
+
+CHECKSUM_ALGORITHMS = {'sha256': hashlib.sha256, 'blake2b': hashlib.blake2b}
+"""Hash algorithms available for pixel checksums. blake3 and xxh3_128 are added if their packages are installed"""
+if blake3 is not None:
+    CHECKSUM_ALGORITHMS['blake3'] = blake3.blake3
+if xxhash is not None:
+    CHECKSUM_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+
+DEFAULT_CHECKSUM_ALGORITHM = 'sha256'
+DEFAULT_CHECKSUM_BUFFER_SIZE = 65536
+DEFAULT_CHECKSUM_STRIP_HEIGHT = 256
+"""Number of rows in each strip hashed separately by a parallel pixel checksum"""
+PIXEL_CHECKSUM_VERSION = 1
+"""Version of the pixel checksum format. Checksums are only comparable if they have the same version.
+Serial sha256 checksums are plain hex digests, to stay comparable with checksums stored before the format
+was versioned"""
+
+
+class ImageContext(object):
+    """
+    Opens a source image once and caches the properties the validation and conversion stages need, so each stage
+    doesn't have to open and decode the file again. Pixels are only decoded when first needed, by
+    :attr:`image` or :attr:`pixel_checksum`.
+
+    Use as a context manager, or call :func:`close` to free the decoded pixels. Cached properties, including the
+    pixel checksum if it has been generated, are still available after closing.
+    Decoding, checksumming and closing are thread-safe, so the checksum can be generated on another thread.
+
+    With a memory budget, images too big to decode all at once are read in strips instead (see :attr:`in_strips`).
+    The pixel checksum of an uncompressed TIFF is generated from its memory-mapped pixel data, without decoding it
+    """
+
+    def __init__(self, image_filepath, checksum_options=None, memory_budget=None):
+        """
+        :param image_filepath:
+        :param checksum_options: keyword arguments for :func:`generate_pixel_checksum_from_pil_image`, used to
+            generate :attr:`pixel_checksum`
+        :param memory_budget: if not None, a :class:`~image_processing.memory.MemoryBudget` for the decoded pixels
+        """
+        self.filepath = image_filepath
+        self.checksum_options = checksum_options or {}
+        self.memory_budget = memory_budget
+        self._image = Image.open(image_filepath)
+        self._pixel_checksum = None
+        self._in_strips = None
+        self._lock = threading.RLock()
+
+        self.format = self._image.format
+        self.mode = self._image.mode
+        self.size = self._image.size
+        self.icc_profile = self._image.info.get('icc_profile')
+        # BitsPerSample is 258 (see PIL.TiffTags.TAGS_V2)
+        self.bit_depths = self._image.tag_v2.get(258) if hasattr(self._image, 'tag_v2') else None
+        self._frame_count = None
+
+    @property
+    def frame_count(self):
+        """
+        Number of frames (layers) in the image
+        """
+        if self._frame_count is None:
+            # counted from the headers on a separate file handle, as seeking through the frames would unload the
+            # shared image
+            self._frame_count = inspection.count_frames(self.filepath)
+        return self._frame_count
+
+    @property
+    def in_strips(self):
+        """
+        True if the image is over the memory budget, so its pixels are read in strips rather than decoded all at
+        once. Raises a :class:`~image_processing.exceptions.MemoryBudgetError` if it is over the budget, but can't
+        be read in strips
+        """
+        with self._lock:
+            if self._in_strips is None:
+                if self.memory_budget is None:
+                    self._in_strips = False
+                elif self._image is None:
+                    raise ValueError('Image context for {0} has been closed'.format(self.filepath))
+                else:
+                    self._in_strips = self.memory_budget.needs_strips(self.filepath, self._image)
+            return self._in_strips
+
+    @property
+    def image(self):
+        """
+        The first frame of the image as a :class:`PIL.Image`, with its pixels loaded.
+        This is shared between stages, so must not be modified in place.
+        Raises a :class:`~image_processing.exceptions.MemoryBudgetError` if the image is over the memory budget
+        """
+        with self._lock:
+            if self._image is None:
+                raise ValueError('Image context for {0} has been closed'.format(self.filepath))
+            if self.in_strips:
+                self.memory_budget.check(self.mode, self.size, 'Decoding all of {0}'.format(self.filepath))
+            self._image.load()
+            return self._image
+
+    @property
+    def pixel_checksum(self):
+        """
+        Checksum of the image's pixels, generated using :func:`generate_pixel_checksum_from_pil_image`, or from
+        the memory-mapped pixel data or strips of the image if possible
+        """
+        with self._lock:
+            if self._pixel_checksum is None:
+                if self._image is None:
+                    raise ValueError('Image context for {0} has been closed'.format(self.filepath))
+                with metrics.record_stage('checksum', input_filepaths=self.filepath), \
+                        memory.map_pixel_data(self.filepath, self._image) as pixel_data:
+                    if pixel_data is not None:
+                        self._pixel_checksum = _generate_pixel_checksum_from_pixel_data(
+                            pixel_data, self.size[1], **self.checksum_options)
+                    elif self.in_strips:
+                        self._pixel_checksum = _generate_pixel_checksum_in_strips(
+                            self.filepath, self.memory_budget, **self.checksum_options)
+                    else:
+                        self._pixel_checksum = generate_pixel_checksum_from_pil_image(self.image,
+                                                                                      **self.checksum_options)
+            return self._pixel_checksum
+
+    def close(self):
+        with self._lock:
+            if self._image is not None:
+                self._image.close()
+                self._image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_JP2_PROPERTIES = [
+    ('file_size', 'fileInfo/fileSizeInBytes', int),
+    ('width', 'properties/jp2HeaderBox/imageHeaderBox/width', int),
+    ('height', 'properties/jp2HeaderBox/imageHeaderBox/height', int),
+    ('num_components', 'properties/jp2HeaderBox/imageHeaderBox/nC', int),
+    ('bit_depth', 'properties/jp2HeaderBox/imageHeaderBox/bPCDepth', int),
+    ('colour_method', 'properties/jp2HeaderBox/colourSpecificationBox/meth', str),
+    ('icc_description', 'properties/jp2HeaderBox/colourSpecificationBox/icc/description', str),
+    ('num_tiles', 'properties/contiguousCodestreamBox/siz/numberOfTiles', int),
+    ('transformation', 'properties/contiguousCodestreamBox/cod/transformation', str),
+    ('levels', 'properties/contiguousCodestreamBox/cod/levels', int),
+    ('layers', 'properties/contiguousCodestreamBox/cod/layers', int),
+    ('progression_order', 'properties/contiguousCodestreamBox/cod/order', str)
+]
+"""Key properties of a JP2 read from the jpylyzer output: (name, path in the output, type)"""
+
+
+class Jp2ValidationResult(object):
+    """
+    The outcome of validating a JP2 file with jpylyzer, with its key properties.
+    The jpylyzer output is only serialised to XML when :func:`to_xml` is called
+    """
+
+    def __init__(self, filepath, is_valid, properties=None, failed_tests=None, jpylyzer_element=None):
+        """
+        :param filepath:
+        :param is_valid:
+        :param properties: dict of the properties in :data:`_JP2_PROPERTIES`, None if jpylyzer didn't report them
+        :param failed_tests: paths of the jpylyzer tests which failed, e.g. ``contiguousCodestreamBox/foundEOCMarker``
+        :param jpylyzer_element: the jpylyzer output, as an :class:`xml.etree.ElementTree.Element`. Not kept by
+            :func:`validate_jp2_many`
+        """
+        self.filepath = filepath
+        self.is_valid = is_valid
+        self.properties = properties or {}
+        self.failed_tests = failed_tests or []
+        self.jpylyzer_element = jpylyzer_element
+        self._xml = None
+
+    @classmethod
+    def from_jpylyzer_element(cls, filepath, jp2_element):
+        is_valid_element = jp2_element.find('isValid')
+        # elements are falsey if they have no children, so we explicitly check `is None`
+        if is_valid_element is None:
+            # isValid is only in post-2.0.0 jyplyzer output. legacy output has isValidJP2 instead
+            is_valid_element = jp2_element.find('isValidJP2')
+        is_valid = is_valid_element is not None and is_valid_element.text == 'True'
+
+        properties = {}
+        for name, path, property_type in _JP2_PROPERTIES:
+            element = jp2_element.find(path)
+            properties[name] = property_type(element.text) if element is not None and element.text else None
+
+        failed_tests = []
+        tests_element = jp2_element.find('tests')
+        if tests_element is not None:
+            failed_tests = _find_failed_jpylyzer_tests(tests_element)
+        return cls(filepath, is_valid, properties=properties, failed_tests=failed_tests,
+                   jpylyzer_element=jp2_element)
+
+    def to_xml(self):
+        """
+        The jpylyzer output, pretty printed as UTF-8 encoded XML. Serialised the first time it is asked for
+        """
+        if self._xml is None:
+            if self.jpylyzer_element is None:
+                raise ValueError('The jpylyzer output for {0} was not kept'.format(self.filepath))
+            self._xml = minidom.parseString(ElementTree.tostring(self.jpylyzer_element)).toprettyxml(encoding='utf-8')
+        return self._xml
+
+    def as_dict(self):
+        return {
+            'filepath': self.filepath,
+            'is_valid': self.is_valid,
+            'properties': self.properties,
+            'failed_tests': self.failed_tests
+        }
+
+
+def _find_failed_jpylyzer_tests(tests_element, path=''):
+    failed_tests = []
+    for element in tests_element:
+        element_path = path + element.tag
+        if len(element):
+            failed_tests.extend(test for test in _find_failed_jpylyzer_tests(element, element_path + '/')
+                                if test not in failed_tests)
+        elif element.text == 'False' and element_path not in failed_tests:
+            failed_tests.append(element_path)
+    return failed_tests
+
 
 def validate_jp2(image_file, output_file=None):
     """
@@ -23,25 +268,66 @@ def validate_jp2(image_file, output_file=None):
     Raises a :class:`~image_processing.exceptions.ValidationError` if it is invalid
 
     :param image_file:
-    :param output_file: if not None, write the jpylyzer xml output to this file
+    :param output_file: if not None, write the jpylyzer xml output to this file. The output is only serialised to
+        XML if this is given
     :type image_file: str
+    :return: a :class:`Jp2ValidationResult`
     """
     logger = logging.getLogger(__name__)
-    jp2_element = checkOneFile(image_file)
-    is_valid_element = jp2_element.find('isValid')
-    # elements are falsey if they have no children, so we explicitly check `is None`
-    if is_valid_element is None:
-        # isValid is only in post-2.0.0 jyplyzer output. legacy output has isValidJP2 instead
-        is_valid_element = jp2_element.find('isValidJP2')
-    success = is_valid_element is not None and is_valid_element.text == 'True'
-    output_string = minidom.parseString(ElementTree.tostring(jp2_element)).toprettyxml(encoding='utf-8')
-    if output_file:
-        with open(output_file, 'wb') as f:
-            f.write(output_string)
-    if not success:
+    result = _run_jpylyzer(image_file, output_file)
+    if not result.is_valid:
         logger.error('{0} failed jypylzer validation'.format(image_file))
         raise exceptions.ValidationError('{0} failed jypylzer validation'.format(image_file))
     logger.debug('{0} is a valid jp2 file'.format(image_file))
+    return result
+
+
+def _run_jpylyzer(image_file, output_file=None):
+    with metrics.record_stage('jpylyzer', input_filepaths=image_file, output_filepaths=output_file):
+        result = Jp2ValidationResult.from_jpylyzer_element(image_file, checkOneFile(image_file))
+        if output_file:
+            with open(output_file, 'wb') as f:
+                f.write(result.to_xml())
+        return result
+
+
+def validate_jp2_many(image_files, output_files=None, max_workers=None):
+    """
+    Validate many jp2 files with jpylyzer, on a pool of worker processes, as jpylyzer is pure Python and holds the
+    GIL. Unlike :func:`validate_jp2`, invalid files don't raise an error: check
+    :attr:`Jp2ValidationResult.is_valid` instead. The results don't keep the jpylyzer output, so write it to
+    output files if it is needed.
+
+    :param image_files: list of jp2 filepaths
+    :param output_files: if not None, a list of the same length of filepaths to write the jpylyzer xml output to.
+        Entries may be None to not write the output for that file
+    :param max_workers: number of worker processes. Defaults to the number of CPUs. With 1, the files are validated
+        in this process
+    :return: list of :class:`Jp2ValidationResult`, in the same order as image_files
+    """
+    image_files = list(image_files)
+    output_files = list(output_files) if output_files is not None else [None] * len(image_files)
+    if len(output_files) != len(image_files):
+        raise ValueError('Got {0} output files for {1} jp2 files'.format(len(output_files), len(image_files)))
+    max_workers = min(max_workers or os.cpu_count() or 1, len(image_files))
+    if max_workers <= 1:
+        return [_validate_jp2_without_output(image_file, output_file)
+                for image_file, output_file in zip(image_files, output_files)]
+    # send several files to a worker at a time, as jpylyzer is quick on small files
+    chunk_size = max(len(image_files) // (max_workers * 4), 1)
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_validate_jp2_without_output, image_files, output_files, chunksize=chunk_size))
+
+
+def _validate_jp2_without_output(image_file, output_file=None):
+    """
+    Validate a jp2 file without keeping the jpylyzer output, so the result is small to send between processes
+    """
+    result = _run_jpylyzer(image_file, output_file)
+    if not result.is_valid:
+        logging.getLogger(__name__).error('{0} failed jypylzer validation'.format(image_file))
+    return Jp2ValidationResult(result.filepath, result.is_valid, properties=result.properties,
+                               failed_tests=result.failed_tests)
 
 
 def _to_bytes_generator(pil_image, min_buffer_size=65536):
@@ -71,32 +357,222 @@ def _to_bytes_generator(pil_image, min_buffer_size=65536):
         raise RuntimeError("encoder error {0} in tobytes when reading image pixel data".format(signal))
 
 
-def generate_pixel_checksum(image_filepath):
+def generate_pixel_checksum(image_filepath, algorithm=DEFAULT_CHECKSUM_ALGORITHM, parallel=False,
+                            strip_height=DEFAULT_CHECKSUM_STRIP_HEIGHT, buffer_size=DEFAULT_CHECKSUM_BUFFER_SIZE,
+                            max_workers=None, memory_budget=None, colour_mode=None):
     """
     Generate a format-independent checksum based on the image's pixel values.
+    See :func:`generate_pixel_checksum_from_pil_image` for the options.
+    Uncompressed TIFFs are hashed from their memory-mapped pixel data (see
+    :func:`~image_processing.memory.map_pixel_data`), without decoding them
 
     :param image_filepath:
+    :param memory_budget: if not None, a :class:`~image_processing.memory.MemoryBudget`. Images over it are read
+        and hashed in strips, giving the same checksum
+    :param colour_mode: if not None, convert the pixels to this colour mode before hashing them
     """
-    with Image.open(image_filepath) as pil_image:
-        return generate_pixel_checksum_from_pil_image(pil_image)
+    with metrics.record_stage('checksum', input_filepaths=image_filepath), Image.open(image_filepath) as pil_image:
+        if colour_mode is None or colour_mode == pil_image.mode:
+            with memory.map_pixel_data(image_filepath, pil_image) as pixel_data:
+                if pixel_data is not None:
+                    return _generate_pixel_checksum_from_pixel_data(pixel_data, pil_image.size[1],
+                                                                    algorithm=algorithm, parallel=parallel,
+                                                                    strip_height=strip_height, max_workers=max_workers)
+        if memory_budget is not None and memory_budget.needs_strips(image_filepath, pil_image):
+            return _generate_pixel_checksum_in_strips(image_filepath, memory_budget, algorithm=algorithm,
+                                                      parallel=parallel, strip_height=strip_height,
+                                                      buffer_size=buffer_size, colour_mode=colour_mode)
+        if colour_mode is not None and pil_image.mode != colour_mode:
+            with pil_image.convert(colour_mode) as converted_image:
+                return generate_pixel_checksum_from_pil_image(converted_image, algorithm=algorithm,
+                                                              parallel=parallel, strip_height=strip_height,
+                                                              buffer_size=buffer_size, max_workers=max_workers)
+        return generate_pixel_checksum_from_pil_image(pil_image, algorithm=algorithm, parallel=parallel,
+                                                      strip_height=strip_height, buffer_size=buffer_size,
+                                                      max_workers=max_workers)
+
+
+def _generate_pixel_checksum_in_strips(image_filepath, memory_budget, algorithm=DEFAULT_CHECKSUM_ALGORITHM,
+                                       parallel=False, strip_height=DEFAULT_CHECKSUM_STRIP_HEIGHT,
+                                       buffer_size=DEFAULT_CHECKSUM_BUFFER_SIZE, max_workers=None, colour_mode=None):
+    """
+    Generate the same checksum as :func:`generate_pixel_checksum`, decoding a strip of the image at a time.
+    Parallel checksums hash the strips one after another, so max_workers is unused
+    """
+    strip_reader = memory.StripReader(image_filepath)
+    colour_mode = colour_mode or strip_reader.mode
+    logger = logging.getLogger(__name__)
+    logger.debug('{0} is over the memory budget, so generating its pixel checksum in strips'.format(image_filepath))
+
+    def pixel_data():
+        for _, strip in strip_reader.iter_strips(memory_budget.strip_height(strip_reader.mode,
+                                                                            strip_reader.size[0])):
+            if strip.mode != colour_mode:
+                strip = strip.convert(colour_mode)
+            for data in _to_bytes_generator(strip, min_buffer_size=buffer_size):
+                yield data
+
+    row_length = memory.raw_row_length(colour_mode, strip_reader.size[0])
+    return _hash_pixel_data(pixel_data(), algorithm, parallel, strip_height, row_length)
+
+
+def _generate_pixel_checksum_from_pixel_data(pixel_data, height, algorithm=DEFAULT_CHECKSUM_ALGORITHM,
+                                             parallel=False, strip_height=DEFAULT_CHECKSUM_STRIP_HEIGHT,
+                                             buffer_size=None, max_workers=None):
+    """
+    Generate the same checksum as :func:`generate_pixel_checksum_from_pil_image` from the raw pixel data of a whole
+    image, e.g. a memoryview from :func:`~image_processing.memory.map_pixel_data`, without copying it.
+    The hash functions read the data directly, so buffer_size is unused
+
+    :param pixel_data: bytes-like object
+    :param height: number of rows of pixels in the data
+    """
+    if not parallel:
+        hash_alg = _new_hash(algorithm)
+        hash_alg.update(pixel_data)
+        return _format_pixel_checksum(hash_alg.hexdigest(), algorithm)
+
+    strip_length = len(pixel_data) // height * strip_height
+
+    def hash_strip(start):
+        hash_alg = _new_hash(algorithm)
+        hash_alg.update(pixel_data[start:start + strip_length])
+        return hash_alg.digest()
 
+    with futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        hexdigest = _combine_strip_digests(executor.map(hash_strip, range(0, len(pixel_data), strip_length)),
+                                           algorithm)
+    return _format_pixel_checksum(hexdigest, algorithm, strip_height)
 
-def generate_pixel_checksum_from_pil_image(pil_image):
+
+def _hash_pixel_data(chunks, algorithm, parallel, strip_height, row_length):
+    """
+    Checksum raw pixel data in the layout of Pillow's raw encoder, given in chunks of any size
+
+    :param chunks: iterable of bytes
+    :param row_length: number of bytes in each row of pixels. Only used if parallel
     """
-    Generate a format-independent checksum based on this image's pixel values
+    if not parallel:
+        hash_alg = _new_hash(algorithm)
+        for data in chunks:
+            hash_alg.update(data)
+        return _format_pixel_checksum(hash_alg.hexdigest(), algorithm)
+
+    strip_length = row_length * strip_height
+    strip_digests = []
+    hash_alg = _new_hash(algorithm)
+    strip_remaining = strip_length
+    for data in chunks:
+        data = memoryview(data)
+        while data:
+            hash_alg.update(data[:strip_remaining])
+            data_length = min(len(data), strip_remaining)
+            data = data[data_length:]
+            strip_remaining -= data_length
+            if not strip_remaining:
+                strip_digests.append(hash_alg.digest())
+                hash_alg = _new_hash(algorithm)
+                strip_remaining = strip_length
+    if strip_remaining < strip_length:
+        strip_digests.append(hash_alg.digest())
+    return _format_pixel_checksum(_combine_strip_digests(strip_digests, algorithm), algorithm, strip_height)
+
+
+def generate_pixel_checksum_from_pil_image(pil_image, algorithm=DEFAULT_CHECKSUM_ALGORITHM, parallel=False,
+                                           strip_height=DEFAULT_CHECKSUM_STRIP_HEIGHT,
+                                           buffer_size=DEFAULT_CHECKSUM_BUFFER_SIZE, max_workers=None):
+    """
+    Generate a format-independent checksum based on this image's pixel values.
+
+    Serial sha256 checksums are plain hex digests. Other checksums are prefixed with the scheme and format version,
+    e.g. ``blake2b:1:<hex digest>``, or ``blake2b-tree256:1:<hex digest>`` for a parallel checksum of 256 row strips.
+    Checksums generated with different options never match, so use :func:`pixel_checksum_options` to find the
+    options to generate a comparable checksum.
 
     :param pil_image: :class:`PIL.Image` instance
+    :param algorithm: one of :data:`CHECKSUM_ALGORITHMS`
+    :param parallel: if true, hash horizontal strips of the image on a thread pool, then hash the strip digests
+        together. Faster on multi-core machines, but gives a different checksum from the serial mode
+    :param strip_height: number of rows in each strip, if parallel
+    :param buffer_size: size of the chunks of pixel data passed to the hash function, if not parallel
+    :param max_workers: number of threads to hash strips on, if parallel. Defaults to the number of CPUs
     """
     logger = logging.getLogger(__name__)
     logger.debug('Loading pixels of image into memory. If this crashes, the machine probably needs more memory')
 
-    hash_alg = sha256()
-    for data in _to_bytes_generator(pil_image):
-        hash_alg.update(data)
+    if parallel:
+        hexdigest = _generate_strip_tree_digest(pil_image, algorithm, strip_height, max_workers)
+    else:
+        hash_alg = _new_hash(algorithm)
+        for data in _to_bytes_generator(pil_image, min_buffer_size=buffer_size):
+            hash_alg.update(data)
+        hexdigest = hash_alg.hexdigest()
+    return _format_pixel_checksum(hexdigest, algorithm, strip_height if parallel else None)
+
+
+def pixel_checksum_options(pixel_checksum):
+    """
+    Find the options a pixel checksum was generated with, so a comparable checksum can be generated for another image
+
+    :param pixel_checksum: a checksum from :func:`generate_pixel_checksum`
+    :return: dict of algorithm, parallel and strip_height keyword arguments for :func:`generate_pixel_checksum`
+    """
+    parts = pixel_checksum.split(':')
+    if len(parts) == 1:
+        return {'algorithm': DEFAULT_CHECKSUM_ALGORITHM, 'parallel': False}
+    if len(parts) != 3:
+        raise ValueError('Unrecognised pixel checksum format {0}'.format(pixel_checksum))
+    scheme, version, _ = parts
+    if version != str(PIXEL_CHECKSUM_VERSION):
+        raise ValueError('Unsupported pixel checksum version {0}. Expected version {1}'
+                         .format(version, PIXEL_CHECKSUM_VERSION))
+    algorithm, tree_separator, strip_height = scheme.partition('-tree')
+    if not tree_separator:
+        return {'algorithm': algorithm, 'parallel': False}
+    return {'algorithm': algorithm, 'parallel': True, 'strip_height': int(strip_height)}
+
+
+def _new_hash(algorithm):
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError('Unsupported checksum algorithm {0}. Available algorithms are {1}'
+                         .format(algorithm, ', '.join(sorted(CHECKSUM_ALGORITHMS))))
+    return CHECKSUM_ALGORITHMS[algorithm]()
+
+
+def _format_pixel_checksum(hexdigest, algorithm, tree_strip_height=None):
+    if algorithm == DEFAULT_CHECKSUM_ALGORITHM and tree_strip_height is None:
+        return hexdigest
+    scheme = algorithm if tree_strip_height is None else '{0}-tree{1}'.format(algorithm, tree_strip_height)
+    return '{0}:{1}:{2}'.format(scheme, PIXEL_CHECKSUM_VERSION, hexdigest)
+
+
+def _combine_strip_digests(strip_digests, algorithm):
+    hash_alg = _new_hash(algorithm)
+    for strip_digest in strip_digests:
+        hash_alg.update(strip_digest)
     return hash_alg.hexdigest()
 
 
-def check_visually_identical(source_filepath, converted_filepath, source_pixel_checksum=None):
+def _generate_strip_tree_digest(pil_image, algorithm, strip_height, max_workers):
+    """
+    Hash each horizontal strip of the image on a thread pool, then hash the strip digests in order.
+    The hash functions release the GIL on large buffers, so the strips are hashed in parallel
+    """
+    pil_image.load()
+    width, height = pil_image.size
+    strip_boxes = [(0, upper, width, min(upper + strip_height, height)) for upper in range(0, height, strip_height)]
+
+    def hash_strip(strip_box):
+        hash_alg = _new_hash(algorithm)
+        hash_alg.update(pil_image.crop(strip_box).tobytes())
+        return hash_alg.digest()
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        return _combine_strip_digests(executor.map(hash_strip, strip_boxes), algorithm)
+
+
+def check_visually_identical(source_filepath, converted_filepath, source_pixel_checksum=None,
+                             source_image_context=None):
     """
     Visually compare the files (i.e. that the pixel values are identical).
     Raises a :class:`~image_processing.exceptions.ValidationError` if they don't match.
@@ -107,27 +583,41 @@ def check_visually_identical(source_filepath, converted_filepath, source_pixel_c
     :param converted_filepath:
     :param source_pixel_checksum: if not None, uses this to compare against instead of reading out the
         source pixels again. Should be one generated using generate_pixel_checksum
+    :param source_image_context: if not None, an :class:`ImageContext` for the source file, used instead of
+        opening it again. If it has a memory budget, the converted file is checksummed within it too
     """
 
     logger = logging.getLogger(__name__)
     logger.debug("Comparing pixel values and colour profile of {0} and {1}".format(source_filepath, converted_filepath))
 
-    check_colour_profiles_match(source_filepath, converted_filepath)
+    check_colour_profiles_match(source_filepath, converted_filepath, source_image_context=source_image_context)
 
-    with Image.open(source_filepath) as source_image:
+    if not source_pixel_checksum and source_image_context is None:
+        # both images have to be decoded anyway, so compare them directly rather than checksumming both
+        check_pixels_identical(source_filepath, converted_filepath)
+        logger.debug('{0} and {1} are equivalent'.format(source_filepath, converted_filepath))
+        return
+
+    memory_budget = None
+    if source_image_context is not None:
         if not source_pixel_checksum:
-            source_pixel_checksum = generate_pixel_checksum_from_pil_image(source_image)
-        source_is_bitonal = source_image.mode == BITONAL
-
-    if source_is_bitonal:
-        # we need to handle bitonal images differently, as they're converted into 8 bit greyscale.
-        # No information is lost in the conversion, but the tobytes
-        #  method used by the pixel checksum picks up the difference
-        with Image.open(converted_filepath) as converted_image:
-            bitonal_converted_image = converted_image.convert('1')
-            converted_pixel_checksum = generate_pixel_checksum_from_pil_image(bitonal_converted_image)
+            source_pixel_checksum = source_image_context.pixel_checksum
+        source_is_bitonal = source_image_context.mode == BITONAL
+        memory_budget = source_image_context.memory_budget
     else:
-        converted_pixel_checksum = generate_pixel_checksum(converted_filepath)
+        with Image.open(source_filepath) as source_image:
+            if not source_pixel_checksum:
+                source_pixel_checksum = generate_pixel_checksum_from_pil_image(source_image)
+            source_is_bitonal = source_image.mode == BITONAL
+
+    # the converted checksum has to be generated the same way as the source one to be comparable
+    checksum_options = pixel_checksum_options(source_pixel_checksum)
+    # we need to handle bitonal images differently, as they're converted into 8 bit greyscale.
+    # No information is lost in the conversion, but the tobytes
+    #  method used by the pixel checksum picks up the difference
+    converted_pixel_checksum = generate_pixel_checksum(converted_filepath, memory_budget=memory_budget,
+                                                       colour_mode=BITONAL if source_is_bitonal else None,
+                                                       **checksum_options)
 
     if not converted_pixel_checksum == source_pixel_checksum:
         raise exceptions.ValidationError(
@@ -138,7 +628,244 @@ def check_visually_identical(source_filepath, converted_filepath, source_pixel_c
     logger.debug('{0} and {1} are equivalent'.format(source_filepath, converted_filepath))
 
 
-def check_colour_profiles_match(source_filepath, converted_filepath):
+def read_pnm_header(stream):
+    """
+    Read the header of a binary PPM or PGM image, leaving the stream at the start of the pixel data.
+    The pixel data of 8 bit PPM and PGM files is identical to the raw RGB or L data Pillow uses for the pixel checksum
+
+    :param stream: binary file object
+    :return: (colour mode, (width, height)) tuple
+    """
+    colour_mode = _PNM_MAGIC_NUMBERS.get(stream.read(2))
+    if colour_mode is None:
+        raise exceptions.ValidationError('Stream is not a binary PPM or PGM image')
+    width, height, max_value = [int(_read_pnm_header_token(stream)) for _ in range(3)]
+    if max_value != 255:
+        raise exceptions.ValidationError('Only 8 bit PPM and PGM images are supported, not maximum value {0}'
+                                         .format(max_value))
+    return colour_mode, (width, height)
+
+
+def _read_pnm_header_token(stream):
+    """
+    Read one whitespace-separated header field, skipping comments. Consumes the single whitespace character after it
+    """
+    token = b''
+    while True:
+        char = stream.read(1)
+        if not char:
+            raise exceptions.ValidationError('PPM or PGM header ended unexpectedly')
+        if char == b'#' and not token:
+            stream.readline()
+        elif char.isspace():
+            if token:
+                return token
+        else:
+            token += char
+
+
+def generate_pixel_checksum_from_stream(stream, buffer_size=DEFAULT_CHECKSUM_BUFFER_SIZE,
+                                        algorithm=DEFAULT_CHECKSUM_ALGORITHM, parallel=False,
+                                        strip_height=DEFAULT_CHECKSUM_STRIP_HEIGHT, row_length=None):
+    """
+    Generate a pixel checksum from raw pixel data, reading it in chunks.
+    Matches :func:`generate_pixel_checksum` with the same options if the data is in the same layout as Pillow's raw
+    encoder. The stream is read in order, so parallel checksums hash the strips one after another
+
+    :param stream: binary file object, positioned at the start of the pixel data
+    :param buffer_size:
+    :param algorithm: see :func:`generate_pixel_checksum_from_pil_image`
+    :param parallel: see :func:`generate_pixel_checksum_from_pil_image`
+    :param strip_height: see :func:`generate_pixel_checksum_from_pil_image`
+    :param row_length: number of bytes in each row of pixels. Required if parallel
+    """
+    if parallel and not row_length:
+        raise ValueError('The row length is needed to checksum a stream in strips')
+    # parallel checksums read a strip at a time
+    read_size = row_length * strip_height if parallel else buffer_size
+    with metrics.record_stage('checksum'):
+        return _hash_pixel_data(iter(lambda: stream.read(read_size), b''), algorithm, parallel, strip_height,
+                                row_length)
+
+
+def check_pnm_stream_visually_identical(source_filepath, converted_stream, converted_icc_profile,
+                                        source_pixel_checksum=None, source_image_context=None):
+    """
+    Compare a source file to a converted image that is being read from a stream as a binary PPM or PGM, e.g. from
+    :func:`~image_processing.kakadu.Kakadu.kdu_expand_to_stream`. Only reads through the stream once.
+    Raises a :class:`~image_processing.exceptions.ValidationError` if the colour mode, size, colour profile or pixels
+    don't match.
+
+    :param source_filepath:
+    :param converted_stream: binary file object, positioned at the start of the PPM or PGM
+    :param converted_icc_profile: the ICC profile of the converted image, as PPM and PGM files can't embed one
+    :param source_pixel_checksum: if not None, uses this to compare against instead of reading out the
+        source pixels again
+    :param source_image_context: if not None, an :class:`ImageContext` for the source file, used instead of
+        opening it again
+    """
+    if source_image_context is None:
+        with ImageContext(source_filepath) as source_image_context:
+            return check_pnm_stream_visually_identical(source_filepath, converted_stream, converted_icc_profile,
+                                                       source_pixel_checksum=source_pixel_checksum,
+                                                       source_image_context=source_image_context)
+    logger = logging.getLogger(__name__)
+    logger.debug("Comparing pixel values and colour profile of {0} and streamed image".format(source_filepath))
+
+    converted_mode, converted_size = read_pnm_header(converted_stream)
+    if converted_mode != source_image_context.mode or converted_size != source_image_context.size:
+        raise exceptions.ValidationError(
+            'Streamed image ({0}, {1}) has different colour mode or size from {2} ({3}, {4})'
+            .format(converted_mode, converted_size, source_filepath, source_image_context.mode,
+                    source_image_context.size))
+    if converted_icc_profile != source_image_context.icc_profile:
+        raise exceptions.ValidationError('Streamed image has different colour profile from {0}'.format(source_filepath))
+
+    # the source checksum may still be being generated, so work out the options from the image context if needed
+    checksum_options = pixel_checksum_options(source_pixel_checksum) if source_pixel_checksum \
+        else source_image_context.checksum_options
+    converted_pixel_checksum = generate_pixel_checksum_from_stream(
+        converted_stream, algorithm=checksum_options.get('algorithm', DEFAULT_CHECKSUM_ALGORITHM),
+        parallel=checksum_options.get('parallel', False),
+        strip_height=checksum_options.get('strip_height', DEFAULT_CHECKSUM_STRIP_HEIGHT),
+        row_length=converted_size[0] * _PNM_BANDS[converted_mode])
+    if not source_pixel_checksum:
+        source_pixel_checksum = source_image_context.pixel_checksum
+    if converted_pixel_checksum != source_pixel_checksum:
+        raise exceptions.ValidationError('Streamed image does not visually match original {0}'.format(source_filepath))
+
+    logger.debug('{0} and streamed image are equivalent'.format(source_filepath))
+
+
+def check_pixels_identical(source_filepath, converted_filepath, strip_height=DEFAULT_COMPARISON_STRIP_HEIGHT,
+                           max_workers=None):
+    """
+    Compare the pixel values of two image files directly, strip by strip (see :func:`find_pixel_difference`).
+    Raises a :class:`~image_processing.exceptions.ValidationError` saying where they differ if they don't match.
+    Bitonal source images may match greyscale converted images, as that is how kakadu expands bitonal JP2s.
+    If both are uncompressed TIFFs of the same colour mode, their memory-mapped pixel data is compared without
+    decoding either
+
+    :param source_filepath:
+    :param converted_filepath:
+    :param strip_height: number of rows compared at a time
+    :param max_workers: number of threads to compare strips on. Defaults to the number of CPUs
+    """
+    with Image.open(source_filepath) as source_image, Image.open(converted_filepath) as converted_image:
+        if source_image.size != converted_image.size:
+            raise exceptions.ValidationError(
+                'Converted file {0} has different dimensions {1} from original {2} {3}'
+                .format(converted_filepath, converted_image.size, source_filepath, source_image.size))
+        with memory.map_pixel_data(source_filepath, source_image) as source_pixel_data, \
+                memory.map_pixel_data(converted_filepath, converted_image) as converted_pixel_data:
+            if source_image.mode == converted_image.mode and source_pixel_data is not None \
+                    and converted_pixel_data is not None:
+                difference = _find_pixel_data_difference(source_pixel_data, converted_pixel_data, source_image.size,
+                                                         strip_height=strip_height)
+            else:
+                if source_image.mode == BITONAL:
+                    # the bitonal image is converted into 8 bit greyscale by kakadu. No information is lost in the
+                    # conversion, but the raw pixel data is packed differently
+                    converted_image = converted_image.convert(BITONAL)
+                difference = find_pixel_difference(source_image, converted_image, strip_height=strip_height,
+                                                   max_workers=max_workers)
+    if difference is not None:
+        strip_box, first_pixel = difference
+        raise exceptions.ValidationError(
+            'Converted file {0} does not visually match original {1}: first difference is at pixel {2}, in the '
+            'region {3}'.format(converted_filepath, source_filepath, first_pixel, strip_box))
+
+
+def find_pixel_difference(image1, image2, strip_height=DEFAULT_COMPARISON_STRIP_HEIGHT, max_workers=None):
+    """
+    Compare the raw pixel data of two images of the same size in horizontal strips, with the strips compared in
+    parallel on a thread pool. Stops at the first strip that differs.
+
+    :param image1: :class:`PIL.Image` instance
+    :param image2: :class:`PIL.Image` instance, the same size as image1
+    :param strip_height: number of rows compared at a time
+    :param max_workers: number of threads to compare strips on. Defaults to the number of CPUs
+    :return: None if the pixels match. Otherwise a tuple of the (left, upper, right, lower) box of the first strip
+        that differs, and the (x, y) position of the first differing pixel in it
+    """
+    if image1.size != image2.size:
+        raise ValueError('Cannot compare pixels of images with different sizes {0} and {1}'
+                         .format(image1.size, image2.size))
+    image1.load()
+    image2.load()
+    width, height = image1.size
+    strip_boxes = [(0, upper, width, min(upper + strip_height, height)) for upper in range(0, height, strip_height)]
+    max_workers = max_workers or os.cpu_count() or 1
+
+    def compare_strip(strip_box):
+        strip1 = image1.crop(strip_box).tobytes()
+        strip2 = image2.crop(strip_box).tobytes()
+        if strip1 == strip2:
+            return None
+        return strip_box, _first_differing_pixel(strip1, strip2, strip_box)
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # only queue a few strips ahead, so there is little wasted work after a difference is found
+        pending = []
+        strip_iter = iter(strip_boxes)
+        for strip_box in strip_iter:
+            pending.append(executor.submit(compare_strip, strip_box))
+            if len(pending) < max_workers * 2:
+                continue
+            difference = pending.pop(0).result()
+            if difference is not None:
+                for future in pending:
+                    future.cancel()
+                return difference
+        for future in pending:
+            difference = future.result()
+            if difference is not None:
+                return difference
+    return None
+
+
+def _find_pixel_data_difference(pixel_data1, pixel_data2, size, strip_height=DEFAULT_COMPARISON_STRIP_HEIGHT):
+    """
+    Compare the raw pixel data of two images of the same colour mode and size in horizontal strips, without copying
+    it. Stops at the first strip that differs.
+
+    :param pixel_data1: bytes-like object, e.g. a memoryview from :func:`~image_processing.memory.map_pixel_data`
+    :param pixel_data2: bytes-like object of the same length
+    :param size: (width, height) of the images
+    :param strip_height: number of rows compared at a time
+    :return: the same as :func:`find_pixel_difference`
+    """
+    width, height = size
+    if len(pixel_data1) != len(pixel_data2):
+        raise ValueError('Cannot compare pixel data of different lengths {0} and {1}'
+                         .format(len(pixel_data1), len(pixel_data2)))
+    row_length = len(pixel_data1) // height
+    for upper in range(0, height, strip_height):
+        lower = min(upper + strip_height, height)
+        strip1 = pixel_data1[upper * row_length:lower * row_length]
+        strip2 = pixel_data2[upper * row_length:lower * row_length]
+        # compares the buffers directly, where == on memoryviews would compare them an item at a time
+        if not hmac.compare_digest(strip1, strip2):
+            strip_box = (0, upper, width, lower)
+            return strip_box, _first_differing_pixel(strip1, strip2, strip_box)
+    return None
+
+
+def _first_differing_pixel(strip1, strip2, strip_box):
+    """
+    Find the position of the first differing pixel, given the raw data of two strips which differ
+
+    :return: (x, y) tuple
+    """
+    left, upper, right, lower = strip_box
+    offset = next(i for i, (byte1, byte2) in enumerate(zip(strip1, strip2)) if byte1 != byte2) \
+        if len(strip1) == len(strip2) else 0
+    row_length = len(strip1) // (lower - upper)
+    # scale the offset within the row to a pixel position, as bitonal images have several pixels per byte
+    return left + (offset % row_length) * (right - left) // row_length, upper + offset // row_length
+
+
+def check_colour_profiles_match(source_filepath, converted_filepath, source_image_context=None):
     """
     Check the ICC profile and colour mode match.
     Allows greyscale and bitonal images to match, as that is how kakadu expands JP2s which were originally bitonal.
@@ -146,76 +873,99 @@ def check_colour_profiles_match(source_filepath, converted_filepath):
 
     :param source_filepath:
     :param converted_filepath:
+    :param source_image_context: if not None, an :class:`ImageContext` for the source file, used instead of
+        opening it again
     """
     logger = logging.getLogger(__name__)
 
-    with Image.open(source_filepath) as source_image:
-        with Image.open(converted_filepath) as converted_image:
-            if source_image.mode != converted_image.mode:
-                if source_image.mode == BITONAL and converted_image.mode == GREYSCALE:
-                    logger.info('Converted image is greyscale, not bitonal. This is expected')
-                elif source_image.mode == 'RGBX' and converted_image.mode == 'RGBA':
-                    logger.info('Converted image in RGBA space, but was converted from RGBX. This is expected.')
-                else:
-                    raise exceptions.ValidationError(
-                        f'Converted file {converted_filepath} has different colour mode ({converted_image.mode}) from {source_filepath} ({source_image.mode})'
-                    )
-
-            source_icc = source_image.info.get('icc_profile')
-            converted_icc = converted_image.info.get('icc_profile')
-            if source_icc != converted_icc:
+    if source_image_context is None:
+        with ImageContext(source_filepath) as source_image_context:
+            return check_colour_profiles_match(source_filepath, converted_filepath,
+                                               source_image_context=source_image_context)
+
+    source_mode = source_image_context.mode
+    with Image.open(converted_filepath) as converted_image:
+        if source_mode != converted_image.mode:
+            if source_mode == BITONAL and converted_image.mode == GREYSCALE:
+                logger.info('Converted image is greyscale, not bitonal. This is expected')
+            elif source_mode == 'RGBX' and converted_image.mode == 'RGBA':
+                logger.info('Converted image in RGBA space, but was converted from RGBX. This is expected.')
+            else:
                 raise exceptions.ValidationError(
-                    'Converted file {0} has different colour profile from {1}'
-                    .format(converted_filepath, source_filepath))
+                    f'Converted file {converted_filepath} has different colour mode ({converted_image.mode}) from {source_filepath} ({source_mode})'
+                )
+
+        source_icc = source_image_context.icc_profile
+        converted_icc = converted_image.info.get('icc_profile')
+        if source_icc != converted_icc:
+            raise exceptions.ValidationError(
+                'Converted file {0} has different colour profile from {1}'
+                .format(converted_filepath, source_filepath))
 
 
 def check_image_suitable_for_jp2_conversion(image_filepath, require_icc_profile_for_greyscale=False,
-                                            require_icc_profile_for_colour=True):
+                                            require_icc_profile_for_colour=True, image_context=None):
     """
     Check over the image and checks if it is in a supported and tested format for conversion to jp2.
-    Raises :class:`~image_processing.exceptions.ValidationError` if it is not
+    Raises :class:`~image_processing.exceptions.ValidationError` if it is not.
+    Only the image's headers are read (see :func:`~image_processing.inspection.inspect_image`)
 
     :param image_filepath:
     :param require_icc_profile_for_greyscale: raise an error if a greyscale image doesn't have an icc profile.
         Note: bitonal images don't need icc profiles even if this is true
     :param require_icc_profile_for_colour: raise an error if a colour image doesn't have an icc profile
+    :param image_context: if not None, an :class:`ImageContext` or :class:`~image_processing.inspection.ImageInfo`
+        for the image, used instead of opening it again
+    :return: list of warnings about the image, which are also logged
     """
 
+    with metrics.record_stage('validate'):
+        if image_context is None:
+            image_context = inspection.inspect_image(image_filepath)
+        return _check_image_suitable_for_jp2_conversion(image_filepath, require_icc_profile_for_greyscale,
+                                                        require_icc_profile_for_colour, image_context)
+
+
+def _check_image_suitable_for_jp2_conversion(image_filepath, require_icc_profile_for_greyscale,
+                                             require_icc_profile_for_colour, image_context):
     logger = logging.getLogger(__name__)
-    with Image.open(image_filepath) as image_pil:
-
-        colour_mode = image_pil.mode
-
-        if colour_mode not in ACCEPTED_COLOUR_MODES:
-            raise exceptions.ValidationError("Unsupported colour mode {0} for {1}".format(colour_mode, image_filepath))
-
-        if colour_mode == 'RGBX':
-            logger.warning("{0} is RGBX and will convert to a RGBA jp2, preserving the pixel information but losing the colour mode".format(image_filepath))
-
-        if colour_mode in ['RGBA', 'RGBX']:
-            # In some cases alpha channel data is stored in a way that means it would be lost in the conversion back to
-            # tiff from jp2.
-            # "Kakadu Warning:
-            # Alpha channel cannot be identified in a TIFF file since it is of the unassociated
-            # (i.e., not premultiplied) type, and these are not supported by TIFF.
-            # You can save this to a separate output file."
-
-            # As we rarely encounter RGBA files, and mostly ones without any alpha channel data, we just warn here
-            # the visually identical check should pick up any problems
-            logger.warning("You must check the jp2 conversion is lossless. "
-                            "{0} will convert to a RGBA jp2, and may convert back to an RGB tiff "
-                            "if the alpha channel is unassociated."
-                           "The usual visually identical check will detect this if run".format(image_filepath))
-
-        icc_needed = (require_icc_profile_for_greyscale and colour_mode == GREYSCALE) \
-            or (require_icc_profile_for_colour and colour_mode not in MONOTONE_COLOUR_MODES)
-
-        icc = image_pil.info.get('icc_profile')
-        if icc is None:
-            logger.warning('No icc profile embedded in {0}'.format(image_filepath))
-            if icc_needed:
-                raise exceptions.ValidationError('No icc profile embedded in {0}.'.format(image_filepath))
-
-        frames = len(list(ImageSequence.Iterator(image_pil)))
-        if frames > 1:
-            logger.warning('File has multiple layers: only the first one will be converted')
+    colour_mode = image_context.mode
+    warnings = []
+
+    def warn(message):
+        logger.warning(message)
+        warnings.append(message)
+
+    if colour_mode not in ACCEPTED_COLOUR_MODES:
+        raise exceptions.ValidationError("Unsupported colour mode {0} for {1}".format(colour_mode, image_filepath))
+
+    if colour_mode == 'RGBX':
+        warn("{0} is RGBX and will convert to a RGBA jp2, preserving the pixel information but losing the colour mode".format(image_filepath))
+
+    if colour_mode in ['RGBA', 'RGBX']:
+        # In some cases alpha channel data is stored in a way that means it would be lost in the conversion back to
+        # tiff from jp2.
+        # "Kakadu Warning:
+        # Alpha channel cannot be identified in a TIFF file since it is of the unassociated
+        # (i.e., not premultiplied) type, and these are not supported by TIFF.
+        # You can save this to a separate output file."
+
+        # As we rarely encounter RGBA files, and mostly ones without any alpha channel data, we just warn here
+        # the visually identical check should pick up any problems
+        warn("You must check the jp2 conversion is lossless. "
+             "{0} will convert to a RGBA jp2, and may convert back to an RGB tiff "
+             "if the alpha channel is unassociated."
+             "The usual visually identical check will detect this if run".format(image_filepath))
+
+    icc_needed = (require_icc_profile_for_greyscale and colour_mode == GREYSCALE) \
+        or (require_icc_profile_for_colour and colour_mode not in MONOTONE_COLOUR_MODES)
+
+    icc = image_context.icc_profile
+    if icc is None:
+        warn('No icc profile embedded in {0}'.format(image_filepath))
+        if icc_needed:
+            raise exceptions.ValidationError('No icc profile embedded in {0}.'.format(image_filepath))
+
+    if image_context.frame_count > 1:
+        warn('File has multiple layers: only the first one will be converted')
+    return warnings
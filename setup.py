@@ -13,9 +13,12 @@ setup(name='image_processing',
       author_email='mel.mason@bodleian.ox.ac.uk',
       packages=['image_processing'],
       install_requires=['Pillow', 'jpylyzer'],
+      extras_require={'fast_checksums': ['blake3', 'xxhash']},
       entry_points={
             'console_scripts': ['convert_tiff_to_jp2=image_processing.entry_points:generate_derivatives_from_tiff',
-                                'convert_icc=image_processing.entry_points:convert_icc_profile'
+                                'convert_tiffs_to_jp2=image_processing.entry_points:generate_derivatives_from_tiffs',
+                                'convert_icc=image_processing.entry_points:convert_icc_profile',
+                                'preflight_tiffs=image_processing.entry_points:preflight_tiffs'
                                 ]
       }
       )
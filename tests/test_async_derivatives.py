@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+from pytest import mark
+
+from image_processing import async_derivatives, validation
+from image_processing.derivative_files_generator import DerivativeFilesGenerator
+from image_processing.utils import cmd_is_executable
+from .test_utils import temporary_folder, filepaths
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class TestAsyncDerivatives(object):
+
+    def test_run_subprocess_returns_output(self):
+        output = asyncio.run(async_derivatives.run_subprocess([sys.executable, '-c', 'print("done")']))
+        assert output.strip() == b'done'
+
+    def test_run_subprocess_raises_on_failure(self):
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
+            asyncio.run(async_derivatives.run_subprocess([sys.executable, '-c', 'import sys; sys.exit(3)']))
+        assert exc_info.value.returncode == 3
+
+    def test_process_limiter_limits_concurrency(self):
+        limiter = async_derivatives.ProcessLimiter(2)
+        running = []
+        max_running = []
+
+        async def run_limited():
+            async with limiter.semaphore:
+                running.append(1)
+                max_running.append(len(running))
+                await async_derivatives.run_subprocess([sys.executable, '-c', 'import time; time.sleep(0.1)'])
+                running.pop()
+
+        async def run_all():
+            await asyncio.gather(*[run_limited() for _ in range(5)])
+
+        # the limiter can be used again in a new event loop
+        for _ in range(2):
+            del max_running[:]
+            asyncio.run(run_all())
+            assert max(max_running) == 2
+
+    @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
+    def test_generates_same_derivatives_as_blocking_generator(self):
+        with temporary_folder() as output_folder:
+            blocking_files = DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH) \
+                .generate_derivatives_from_tiff(filepaths.STANDARD_TIF, os.path.join(output_folder, 'blocking'))
+
+            async def generate_all(generator):
+                return await asyncio.gather(*[
+                    generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF,
+                                                             os.path.join(output_folder, str(i)))
+                    for i in range(3)])
+
+            with async_derivatives.AsyncDerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                 max_processes=2) as generator:
+                results = asyncio.run(generate_all(generator))
+            for generated_files in results:
+                assert [os.path.basename(f) for f in generated_files] == \
+                       [os.path.basename(f) for f in blocking_files]
+                for blocking_file, generated_file in zip(blocking_files, generated_files):
+                    if generated_file.endswith('.jp2'):
+                        assert validation.generate_pixel_checksum(generated_file) == \
+                               validation.generate_pixel_checksum(blocking_file)
+
+    @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
+    def test_failure_doesnt_affect_other_images(self):
+        with temporary_folder() as output_folder:
+            async def generate_all(generator):
+                return await asyncio.gather(
+                    generator.generate_derivatives_from_tiff(filepaths.INVALID_TIF,
+                                                             os.path.join(output_folder, 'invalid')),
+                    generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF,
+                                                             os.path.join(output_folder, 'standard')),
+                    return_exceptions=True)
+
+            with async_derivatives.AsyncDerivativeFilesGenerator(
+                    kakadu_base_path=filepaths.KAKADU_BASE_PATH) as generator:
+                invalid_result, standard_result = asyncio.run(generate_all(generator))
+            assert isinstance(invalid_result, Exception)
+            assert os.path.isfile(os.path.join(output_folder, 'standard', 'full_lossless.jp2'))
@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+
+from pytest import mark
+
+from image_processing import batch, metrics
+from image_processing.utils import cmd_is_executable
+from .test_utils import temporary_folder, filepaths
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class TestBatch(object):
+
+    def test_jobs_from_folder_mirrors_folder_structure(self):
+        with temporary_folder() as source_folder:
+            os.makedirs(os.path.join(source_folder, 'sub'))
+            shutil.copy(filepaths.SMALL_TIF, os.path.join(source_folder, 'a.tif'))
+            shutil.copy(filepaths.SMALL_TIF, os.path.join(source_folder, 'sub', 'b.TIFF'))
+            shutil.copy(filepaths.STANDARD_JPG, os.path.join(source_folder, 'c.jpg'))
+
+            jobs = batch.jobs_from_folder(source_folder, 'out')
+            assert jobs == [(os.path.join(source_folder, 'a.tif'), os.path.join('out', 'a')),
+                            (os.path.join(source_folder, 'sub', 'b.TIFF'), os.path.join('out', 'sub', 'b'))]
+
+    def test_jobs_from_manifest(self):
+        with temporary_folder() as folder:
+            manifest_filepath = os.path.join(folder, 'manifest.txt')
+            with open(manifest_filepath, 'w') as f:
+                f.write('# comment\n/data/a.tif\n\n/data/b.tif,/elsewhere/b\n')
+            assert batch.jobs_from_manifest(manifest_filepath, 'out') == [('/data/a.tif', os.path.join('out', 'a')),
+                                                                          ('/data/b.tif', '/elsewhere/b')]
+            assert batch.read_manifest(manifest_filepath) == [('/data/a.tif', None), ('/data/b.tif', '/elsewhere/b')]
+
+    def test_summary_counts_successes_and_failures(self):
+        summary = batch.BatchSummary()
+        summary.add(batch.BatchResult('a.tif', 'out/a', generated_files=['out/a/full.jpg'], duration=1.5,
+                                      kakadu_metrics=[{'command': 'kdu_compress', 'cpu_time': 1.25},
+                                                      {'command': 'kdu_expand', 'cpu_time': None}]))
+        summary.add(batch.BatchResult('b.tif', 'out/b', error='ValidationError: invalid', duration=0.5,
+                                      stage_metrics=[metrics.StageMetrics('validate', 0.25, 0.5,
+                                                                          succeeded=False).as_dict()]))
+        assert [r.source_filepath for r in summary.successes] == ['a.tif']
+        assert [r.source_filepath for r in summary.failures] == ['b.tif']
+        assert summary.processing_time == 2.0
+        assert summary.as_dict()['failures'] == 1
+        assert summary.kakadu_cpu_time == 1.25
+        assert summary.stage_totals['validate']['failures'] == 1
+        assert 'FAILED b.tif' in str(summary)
+
+    @mark.skipif(multiprocessing.get_start_method() != 'fork',
+                 reason="the workers only see the replaced functions when they are forked")
+    def test_batch_survives_worker_dying(self, monkeypatch):
+        monkeypatch.setattr(batch, 'DerivativeFilesGenerator', _UnusedGenerator)
+        monkeypatch.setattr(batch, '_generate_derivatives', _generate_derivatives_or_die)
+        jobs = [('{0}.tif'.format(index), 'out') for index in range(12)]
+        jobs[5] = ('die.tif', 'out')
+        for max_workers in [1, 3]:
+            summary = batch.BatchDerivativeFilesGenerator(max_workers=max_workers).run(jobs)
+            assert sorted(r.source_filepath for r in summary.successes) == \
+                sorted(source_filepath for source_filepath, _ in jobs if source_filepath != 'die.tif')
+            assert [r.source_filepath for r in summary.failures] == ['die.tif']
+            assert 'BrokenProcessPool' in summary.failures[0].error
+
+    @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
+    def test_batch_isolates_failures(self):
+        with temporary_folder() as output_folder:
+            jobs = [(filepaths.STANDARD_TIF, os.path.join(output_folder, 'standard')),
+                    (filepaths.INVALID_TIF, os.path.join(output_folder, 'invalid'))]
+            batch_generator = batch.BatchDerivativeFilesGenerator(max_workers=2,
+                                                                  kakadu_base_path=filepaths.KAKADU_BASE_PATH)
+            summary = batch_generator.run(jobs)
+            assert [r.source_filepath for r in summary.successes] == [filepaths.STANDARD_TIF]
+            assert [r.source_filepath for r in summary.failures] == [filepaths.INVALID_TIF]
+            assert os.path.isfile(os.path.join(output_folder, 'standard', 'full_lossless.jp2'))
+
+
+class _UnusedGenerator(object):
+    def __init__(self, **generator_options):
+        pass
+
+
+def _generate_derivatives_or_die(source_filepath, output_folder, derivative_options):
+    if source_filepath == 'die.tif':
+        # like the worker being killed for running out of memory
+        os._exit(137)
+    return batch.BatchResult(source_filepath, output_folder, generated_files=[os.path.join(output_folder, 'full.jpg')])
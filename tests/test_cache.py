@@ -0,0 +1,120 @@
+import logging
+import os
+import sys
+
+from pytest import mark
+
+from image_processing.cache import DerivativeCache, hash_file, unlink_linked_files
+from image_processing.derivative_files_generator import DerivativeFilesGenerator
+from image_processing.utils import cmd_is_executable
+from .test_utils import temporary_folder, filepaths
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+def _write_file(filepath, contents):
+    with open(filepath, 'wb') as f:
+        f.write(contents)
+
+
+class TestDerivativeCache(object):
+
+    def test_key_depends_on_source_contents_and_settings(self):
+        with temporary_folder() as cache_folder:
+            cache = DerivativeCache(cache_folder)
+            key = cache.get_key(filepaths.SMALL_TIF, {'quality': 92})
+            assert key == cache.get_key(filepaths.SMALL_TIF, {'quality': 92})
+            assert key != cache.get_key(filepaths.SMALL_TIF, {'quality': 90})
+            assert key != cache.get_key(filepaths.SMALL_TIF_WITH_CHANGED_PIXELS, {'quality': 92})
+
+    def test_store_and_fetch(self):
+        with temporary_folder() as cache_folder, temporary_folder() as output_folder:
+            cache = DerivativeCache(cache_folder)
+            source_filepath = os.path.join(output_folder, 'full.jpg')
+            _write_file(source_filepath, b'jpg')
+            destination_filepath = os.path.join(output_folder, 'copy.jpg')
+
+            assert not cache.fetch('abcd', {'full.jpg': destination_filepath})
+            cache.store('abcd', {'full.jpg': source_filepath})
+            # the cached file doesn't change with the original
+            _write_file(source_filepath, b'changed')
+            assert cache.fetch('abcd', {'full.jpg': destination_filepath})
+            with open(destination_filepath, 'rb') as f:
+                assert f.read() == b'jpg'
+
+            # an entry without all the requested files is a miss
+            assert not cache.fetch('abcd', {'full.jpg': destination_filepath, 'full.xmp': source_filepath})
+            assert cache.stats == {'hits': 1, 'misses': 2, 'stores': 1, 'evictions': 0, 'hit_rate': 1 / 3}
+
+    def test_evicts_least_recently_used(self):
+        with temporary_folder() as cache_folder, temporary_folder() as output_folder:
+            cache = DerivativeCache(cache_folder, max_size_bytes=250)
+            source_filepath = os.path.join(output_folder, 'full.jp2')
+            _write_file(source_filepath, b'0' * 100)
+            destination_filepath = os.path.join(output_folder, 'copy.jp2')
+
+            cache.store('aaaa', {'full.jp2': source_filepath})
+            cache.store('bbbb', {'full.jp2': source_filepath})
+            os.utime(os.path.join(cache_folder, 'aa', 'aaaa'), (0, 0))
+            os.utime(os.path.join(cache_folder, 'bb', 'bbbb'), (0, 0))
+            assert cache.fetch('aaaa', {'full.jp2': destination_filepath})
+            cache.store('cccc', {'full.jp2': source_filepath})
+
+            assert cache.size_bytes == 200
+            assert cache.evictions == 1
+            assert not cache.fetch('bbbb', {'full.jp2': destination_filepath})
+            assert cache.fetch('aaaa', {'full.jp2': destination_filepath})
+            assert cache.fetch('cccc', {'full.jp2': destination_filepath})
+
+    def test_unlinks_linked_files(self):
+        with temporary_folder() as cache_folder, temporary_folder() as output_folder:
+            cache = DerivativeCache(cache_folder)
+            source_filepath = os.path.join(output_folder, 'full.jpg')
+            _write_file(source_filepath, b'jpg')
+            destination_filepath = os.path.join(output_folder, 'copy.jpg')
+            cache.store('abcd', {'full.jpg': source_filepath})
+            assert cache.fetch('abcd', {'full.jpg': destination_filepath})
+
+            unlink_linked_files([destination_filepath, source_filepath, os.path.join(output_folder, 'missing.jpg')])
+            assert not os.path.exists(destination_filepath)
+            # not linked, so kept
+            assert os.path.exists(source_filepath)
+            _write_file(destination_filepath, b'changed')
+            assert cache.fetch('abcd', {'full.jpg': destination_filepath})
+            with open(destination_filepath, 'rb') as f:
+                assert f.read() == b'jpg'
+
+    @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
+    def test_generator_reuses_cached_derivatives(self):
+        with temporary_folder() as cache_folder, temporary_folder() as output_folder:
+            cache = DerivativeCache(cache_folder)
+            generator = DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH, cache=cache)
+            generated_files = generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF,
+                                                                       os.path.join(output_folder, 'first'))
+            cached_files = generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF,
+                                                                    os.path.join(output_folder, 'second'))
+            assert [os.path.basename(f) for f in cached_files] == [os.path.basename(f) for f in generated_files]
+            assert cache.stats['hits'] == 1
+            assert cache.stats['misses'] == 1
+
+    @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
+    def test_regenerating_into_the_same_folder_leaves_cache_unchanged(self):
+        with temporary_folder() as cache_folder, temporary_folder() as output_folder:
+            cache = DerivativeCache(cache_folder)
+            generator = DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH, cache=cache)
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            # the second run links the cached files into the output folder
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            cached_checksums = _checksum_files(cache_folder)
+
+            other_generator = DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH, cache=cache,
+                                                       jpg_thumbnail_resize_value=0.3)
+            other_generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert cache.stats['misses'] == 2
+            checksums = _checksum_files(cache_folder)
+            assert all(checksums[filepath] == checksum for filepath, checksum in cached_checksums.items())
+
+
+def _checksum_files(folder):
+    return {os.path.join(parent_folder, filename): hash_file(os.path.join(parent_folder, filename))
+            for parent_folder, _, filenames in os.walk(folder) for filename in filenames}
@@ -5,7 +5,7 @@ import sys
 
 from pytest import mark
 
-from image_processing import conversion, derivative_files_generator, validation, exceptions, kakadu
+from image_processing import conversion, derivative_files_generator, validation, exceptions, kakadu, memory, jpeg
 import pytest
 
 from image_processing.utils import cmd_is_executable
@@ -44,6 +44,112 @@ class TestImageFormatConverter(object):
             assert os.path.isfile(output_file)
             assert image_files_match(output_file, filepaths.HIGH_QUALITY_JPG_FROM_STANDARD_TIF)
 
+    def test_embedded_jpeg_metadata_matches_exiftool_copy(self):
+        with temporary_folder() as output_folder:
+            converter = conversion.Converter()
+            embedded_file = os.path.join(output_folder, 'embedded.jpg')
+            copied_file = os.path.join(output_folder, 'copied.jpg')
+            converter.convert_to_jpg(filepaths.STANDARD_TIF, embedded_file, resize=0.5)
+            conversion.Converter(embed_jpg_metadata=False).convert_to_jpg(filepaths.STANDARD_TIF, copied_file,
+                                                                          resize=0.5)
+            assert image_files_match(embedded_file, copied_file)
+            # the metadata segments are reused for more jpegs of the same file
+            converter.convert_to_jpgs(filepaths.STANDARD_TIF, [(os.path.join(output_folder, '150.jpg'), 150, None)])
+            assert len(converter._jpg_metadata_cache) == 1
+
+    def test_writes_jpeg_with_metadata_segments(self):
+        with open(filepaths.STANDARD_JPG, 'rb') as jpg_file:
+            metadata_segments = jpeg.get_metadata_segments(jpg_file.read())
+        encoded_jpg = io.BytesIO()
+        with Image.open(filepaths.SMALL_TIF) as tiff_image:
+            tiff_image.save(encoded_jpg, 'JPEG')
+        output_jpg = io.BytesIO()
+        jpeg.write_with_metadata_segments(output_jpg, encoded_jpg.getvalue(), metadata_segments)
+        output_jpg.seek(0)
+        encoded_jpg.seek(0)
+        with Image.open(output_jpg) as output_image, Image.open(encoded_jpg) as encoded_image, \
+                Image.open(filepaths.STANDARD_JPG) as metadata_image:
+            assert output_image.info['exif'] == metadata_image.info['exif']
+            assert output_image.info['icc_profile'] == metadata_image.info['icc_profile']
+            assert output_image.tobytes() == encoded_image.tobytes()
+
+    def test_streams_jpeg_with_metadata_segments(self):
+        with open(filepaths.STANDARD_JPG, 'rb') as jpg_file:
+            metadata_segments = jpeg.get_metadata_segments(jpg_file.read())
+        encoded_jpg = io.BytesIO()
+        with Image.open(filepaths.SMALL_TIF) as tiff_image:
+            tiff_image.save(encoded_jpg, 'JPEG', icc_profile=tiff_image.info['icc_profile'])
+        expected_jpg = io.BytesIO()
+        jpeg.write_with_metadata_segments(expected_jpg, encoded_jpg.getvalue(), metadata_segments)
+        # in small pieces, so the metadata segments are split between writes
+        for chunk_size in [1, 100, len(encoded_jpg.getvalue())]:
+            output_jpg = io.BytesIO()
+            jpg_writer = jpeg.MetadataSegmentsWriter(output_jpg, metadata_segments)
+            for offset in range(0, len(encoded_jpg.getvalue()), chunk_size):
+                jpg_writer.write(encoded_jpg.getvalue()[offset:offset + chunk_size])
+            jpg_writer.finish()
+            assert output_jpg.getvalue() == expected_jpg.getvalue()
+
+        jpg_writer = jpeg.MetadataSegmentsWriter(io.BytesIO(), metadata_segments)
+        jpg_writer.write(encoded_jpg.getvalue()[:10])
+        with pytest.raises(exceptions.ImageProcessingError):
+            jpg_writer.finish()
+
+    def test_thumbnail_resampling_options(self):
+        with temporary_folder() as output_folder:
+            converter = conversion.Converter()
+            default_file = os.path.join(output_folder, 'default.jpg')
+            fast_file = os.path.join(output_folder, 'fast.jpg')
+            converter.convert_to_jpg(filepaths.STANDARD_TIF, default_file, resize=0.1)
+            converter.convert_to_jpg(filepaths.STANDARD_TIF, fast_file, resize=0.1, resampling='bilinear',
+                                     reducing_gap=1.0)
+            with Image.open(default_file) as default_jpg, Image.open(fast_file) as fast_jpg:
+                assert default_jpg.size == fast_jpg.size
+            with pytest.raises(ValueError):
+                converter.convert_to_jpg(filepaths.STANDARD_TIF, fast_file, resize=0.1, resampling='nearest')
+
+    def test_converts_tif_to_jpegs_of_several_sizes(self):
+        with temporary_folder() as output_folder:
+            jpg_outputs = [(os.path.join(output_folder, '{0}.jpg'.format(size)), size, None)
+                           for size in [150, 1200, 600]]
+            jpg_outputs.append((os.path.join(output_folder, 'full.jpg'), None, 92))
+            conversion.Converter().convert_to_jpgs(filepaths.STANDARD_TIF, jpg_outputs)
+            with Image.open(filepaths.STANDARD_TIF) as tiff_image:
+                for output_file, size, _ in jpg_outputs:
+                    with Image.open(output_file) as jpg_image:
+                        expected_size = tiff_image.size if size is None \
+                            else conversion.get_thumbnail_size(tiff_image.size, (size, size))
+                        assert jpg_image.size == expected_size
+                        assert jpg_image.info['icc_profile'] == tiff_image.info['icc_profile']
+
+    def test_converts_tif_to_jpeg_within_memory_budget(self):
+        with temporary_folder() as output_folder:
+            converter = conversion.Converter()
+            memory_budget = memory.MemoryBudget(1350 * 1020)
+            output_file = os.path.join(output_folder, 'output.jpg')
+            converter.convert_to_jpg(filepaths.STANDARD_TIF, output_file, resize=0.1, memory_budget=memory_budget)
+            with Image.open(output_file) as jpg_image, Image.open(filepaths.STANDARD_TIF) as tiff_image:
+                assert jpg_image.size == conversion.get_thumbnail_size(tiff_image.size, (135, 102))
+                assert jpg_image.info['icc_profile'] == tiff_image.info['icc_profile']
+            with pytest.raises(exceptions.MemoryBudgetError):
+                converter.convert_to_jpg(filepaths.STANDARD_TIF, output_file, memory_budget=memory_budget)
+
+    def test_thumbnail_size_matches_pillow(self):
+        for image_size, thumbnail_size in [((1350, 1020), (810, 612)), ((1350, 1020), (150, 150)),
+                                           ((1020, 1350), (135, 102)), ((100, 100), (200, 200))]:
+            pil_image = Image.new('L', image_size)
+            pil_image.thumbnail(thumbnail_size)
+            assert conversion.get_thumbnail_size(image_size, thumbnail_size) == pil_image.size
+
+    def test_kakadu_reduce_level(self):
+        assert kakadu.get_resolution_levels(kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS) == 6
+        assert kakadu.get_resolution_levels(kakadu.LOSSLESS_OPTIONS) == kakadu.DEFAULT_RESOLUTION_LEVELS
+        assert kakadu.get_reduced_size((1350, 1020), 3) == (169, 128)
+        # a 0.6 thumbnail is bigger than the first reduced level, so the full image is needed
+        assert kakadu.get_reduce_level((10000, 8000), (6000, 4800), 6) == 0
+        assert kakadu.get_reduce_level((10000, 8000), (1000, 800), 6) == 3
+        assert kakadu.get_reduce_level((10000, 8000), (10, 8), 6) == 6
+
     def test_converts_depthmap_tif_to_jpeg(self):
         with temporary_folder() as output_folder:
             output_file = os.path.join(output_folder, 'output.jpg')
@@ -69,6 +175,34 @@ class TestImageFormatConverter(object):
             # lossy conversions to jp2 don't seem to produce deterministic results, even if we only look at the pixels
             # validation.check_visually_identical(output_file, filepaths.LOSSY_JP2_FROM_STANDARD_TIF)
 
+    @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
+    def test_kakadu_records_cpu_metrics(self):
+        with temporary_folder() as output_folder:
+            output_file = os.path.join(output_folder, 'output.jp2')
+            kdu = kakadu.Kakadu(kakadu_base_path=filepaths.KAKADU_BASE_PATH, num_threads=2, double_buffering=16,
+                                report_cpu=True)
+            kdu.kdu_compress(filepaths.STANDARD_TIF, output_file, kakadu_options=kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS)
+            metrics = kdu.pop_metrics()
+            assert [m.command for m in metrics] == ['kdu_compress']
+            assert metrics[0].cpu_time is not None
+            assert metrics[0].wall_time > 0
+            assert kdu.pop_metrics() == []
+
+    def test_parses_kakadu_cpu_output(self):
+        output = "Compressed using the multi-threaded environment, with\n" \
+                 "    4 parallel threads of execution (see `-num_threads')\n" \
+                 "Processing time = 0.33 s; i.e., 0.0158 us/sample\n"
+        metrics = kakadu.KakaduMetrics.from_output('kdu_compress', 'input.tif', 'output.jp2', 0.5, output)
+        assert metrics.cpu_time == 0.33
+        assert metrics.microseconds_per_sample == 0.0158
+        assert metrics.num_threads == 4
+        assert kakadu.KakaduMetrics.from_output('kdu_expand', 'input.jp2', 'output.tif', 0.5, '').cpu_time is None
+
+    def test_default_kakadu_threads_share_cpus(self):
+        cpu_count = os.cpu_count() or 1
+        assert kakadu.get_default_num_threads(1) == (cpu_count if cpu_count > 1 else 0)
+        assert kakadu.get_default_num_threads(cpu_count) == 0
+
     @mark.skipif(not cmd_is_executable('/opt/kakadu/kdu_compress'), reason="requires kakadu installed")
     def test_kakadu_errors_are_raised(self):
         with temporary_folder() as output_folder:
@@ -95,6 +229,18 @@ class TestImageFormatConverter(object):
                 prf = ImageCms.ImageCmsProfile(f)
                 assert prf.profile.profile_description == "sRGB v4 ICC preference perceptual intent beta"
 
+    def test_icc_conversion_within_memory_budget(self):
+        with temporary_folder() as output_folder:
+            converter = conversion.Converter()
+            output_file = os.path.join(output_folder, 'output.tif')
+            strips_output_file = os.path.join(output_folder, 'strips_output.tif')
+            converter.convert_icc_profile(filepaths.STANDARD_TIF, output_file, filepaths.SRGB_ICC_PROFILE)
+            converter.convert_icc_profile(filepaths.STANDARD_TIF, strips_output_file, filepaths.SRGB_ICC_PROFILE,
+                                          memory_budget=memory.MemoryBudget(1350 * 1020))
+            with Image.open(output_file) as output_pil, Image.open(strips_output_file) as strips_output_pil:
+                assert strips_output_pil.tobytes() == output_pil.tobytes()
+                assert strips_output_pil.info['icc_profile'] == output_pil.info['icc_profile']
+
     def test_icc_conversion_catches_16_bit_errors(self):
         with temporary_folder() as output_folder:
             output_file = os.path.join(output_folder, 'output.tif')
@@ -6,8 +6,9 @@ import sys
 import pytest
 from pytest import mark
 
-from image_processing import derivative_files_generator, validation, exceptions
+from image_processing import derivative_files_generator, validation, exceptions, metrics
 from image_processing.utils import cmd_is_executable
+from PIL import Image
 from .test_utils import temporary_folder, filepaths, image_files_match, xmp_files_match
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -250,3 +251,151 @@ class TestDerivativeGenerator(object):
             generator.generate_jp2_from_tiff(filepaths.NORMALMAP_TIF, output_file)
             assert os.path.isfile(output_file)
             generator.check_conversion_was_lossless(filepaths.NORMALMAP_TIF, output_file)
+
+    def test_lossless_check_uses_given_source_checksum(self):
+        generator = get_derivatives_generator()
+        generator.check_conversion_was_lossless(
+            filepaths.STANDARD_TIF, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF,
+            source_pixel_checksum=validation.generate_pixel_checksum(filepaths.STANDARD_TIF))
+        with pytest.raises(exceptions.ValidationError):
+            generator.check_conversion_was_lossless(
+                filepaths.STANDARD_TIF, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF,
+                source_pixel_checksum=validation.generate_pixel_checksum(filepaths.SMALL_TIF))
+
+    def test_lossless_check_raises_source_checksum_errors(self):
+        generator = derivative_files_generator.DerivativeFilesGenerator(
+            kakadu_base_path=filepaths.KAKADU_BASE_PATH, pixel_checksum_options={'algorithm': 'not_an_algorithm'})
+        with pytest.raises(ValueError):
+            generator.check_conversion_was_lossless(filepaths.STANDARD_TIF, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+
+    def test_streamed_lossless_check(self):
+        generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                        stream_lossless_check=True)
+        generator.check_conversion_was_lossless(filepaths.STANDARD_TIF, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+        generator.check_conversion_was_lossless(filepaths.GREYSCALE_TIF, filepaths.LOSSLESS_JP2_FROM_GREYSCALE_TIF_XMP)
+        with pytest.raises(exceptions.ValidationError):
+            generator.check_conversion_was_lossless(filepaths.SMALL_TIF, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+
+    def test_incremental_rerun_only_regenerates_stale_derivatives(self):
+        with temporary_folder() as output_folder:
+            generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                            incremental=True)
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            jpg_file = os.path.join(output_folder, 'full.jpg')
+            jp2_file = os.path.join(output_folder, 'full_lossless.jp2')
+            assert os.path.isfile(os.path.join(output_folder, 'full.manifest.json'))
+            jpg_mtime = os.path.getmtime(jpg_file)
+            jp2_mtime = os.path.getmtime(jp2_file)
+
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert os.path.getmtime(jpg_file) == jpg_mtime
+            assert os.path.getmtime(jp2_file) == jp2_mtime
+
+            generator.jpg_thumbnail_resize_value = 0.3
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert os.path.getmtime(jpg_file) != jpg_mtime
+            assert os.path.getmtime(jp2_file) == jp2_mtime
+
+    def test_only_looks_up_tool_versions_when_needed(self):
+        version_lookups = []
+
+        def exiftool_version():
+            version_lookups.append('exiftool')
+            return '12.00'
+
+        with temporary_folder() as output_folder:
+            generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH)
+            generator.converter.exiftool_version = exiftool_version
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert version_lookups == []
+
+            generator.incremental = True
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert version_lookups == ['exiftool']
+
+    def test_creates_jpg_derivative_specs(self):
+        with temporary_folder() as output_folder:
+            specs = [derivative_files_generator.JpgDerivativeSpec(150, '150.jpg'),
+                     derivative_files_generator.JpgDerivativeSpec(600, '600.jpg', quality=80)]
+            generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                            jpg_derivative_specs=specs)
+            generated_files = generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert generated_files[-2:] == [os.path.join(output_folder, '150.jpg'),
+                                            os.path.join(output_folder, '600.jpg')]
+            with Image.open(generated_files[-2]) as small_jpg, Image.open(generated_files[-1]) as large_jpg:
+                assert max(small_jpg.size) == 150
+                assert max(large_jpg.size) == 600
+
+    def test_rejects_invalid_jpg_derivative_specs(self):
+        with pytest.raises(ValueError):
+            derivative_files_generator.JpgDerivativeSpec(0, 'empty.jpg')
+        with pytest.raises(ValueError):
+            derivative_files_generator.JpgDerivativeSpec(150, '150.png')
+
+    def test_creates_thumbnail_from_reduced_jp2(self):
+        with temporary_folder() as output_folder:
+            generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                            jpg_thumbnail_resize_value=0.1,
+                                                                            jpg_from_jp2=True)
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            with Image.open(filepaths.STANDARD_TIF) as tiff_image, \
+                    Image.open(os.path.join(output_folder, 'full.jpg')) as jpg_image:
+                tiff_image.thumbnail(tuple(int(i * 0.1) for i in tiff_image.size))
+                assert jpg_image.size == tiff_image.size
+                assert jpg_image.info['icc_profile'] == tiff_image.info['icc_profile']
+
+    def test_pipelined_stages_create_same_files(self):
+        with temporary_folder() as output_folder:
+            generated_files = {}
+            for pipeline_stages in [True, False]:
+                generator = derivative_files_generator.DerivativeFilesGenerator(
+                    kakadu_base_path=filepaths.KAKADU_BASE_PATH, pipeline_stages=pipeline_stages)
+                generated_files[pipeline_stages] = generator.generate_derivatives_from_tiff(
+                    filepaths.STANDARD_TIF, os.path.join(output_folder, str(pipeline_stages)), include_tiff=True)
+            for pipelined_file, sequential_file in zip(generated_files[True], generated_files[False]):
+                assert os.path.basename(pipelined_file) == os.path.basename(sequential_file)
+                if pipelined_file.endswith('.jp2'):
+                    assert validation.generate_pixel_checksum(pipelined_file) == \
+                           validation.generate_pixel_checksum(sequential_file)
+                else:
+                    assert filecmp.cmp(pipelined_file, sequential_file, shallow=False)
+
+    def test_pipelined_stages_finish_before_raising(self):
+        with temporary_folder() as output_folder:
+            generator = get_derivatives_generator()
+            with pytest.raises(exceptions.ValidationError):
+                generator.generate_derivatives_from_tiff(filepaths.NO_PROFILE_TIF, output_folder,
+                                                         include_tiff=True)
+            # the independent tiff copy still completes
+            assert os.path.isfile(os.path.join(output_folder, 'full.tiff'))
+
+    def test_returns_stage_metrics(self):
+        with temporary_folder() as output_folder:
+            metrics_filepath = os.path.join(output_folder, 'metrics.jsonl')
+            generator = derivative_files_generator.DerivativeFilesGenerator(
+                kakadu_base_path=filepaths.KAKADU_BASE_PATH, metrics_sinks=[metrics.JsonLinesSink(metrics_filepath)])
+            generated_files, stage_metrics = generator.generate_derivatives_from_tiff(
+                filepaths.STANDARD_TIF, os.path.join(output_folder, 'derivatives'), return_metrics=True)
+            assert len(generated_files) == 3
+            assert {m.stage for m in stage_metrics} == {'validate', 'jpg', 'xmp', 'kdu_compress', 'metadata_copy',
+                                                        'jpylyzer', 'kdu_expand', 'checksum'}
+            kdu_compress_metrics = [m for m in stage_metrics if m.stage == 'kdu_compress'][0]
+            assert kdu_compress_metrics.bytes_read == os.path.getsize(filepaths.STANDARD_TIF)
+            assert kdu_compress_metrics.bytes_written > 0
+            with open(metrics_filepath) as metrics_file:
+                assert len(metrics_file.readlines()) == len(stage_metrics)
+
+    def test_generates_derivatives_within_memory_budget(self):
+        with temporary_folder() as output_folder:
+            generator = derivative_files_generator.DerivativeFilesGenerator(
+                kakadu_base_path=filepaths.KAKADU_BASE_PATH, memory_budget_bytes=1350 * 1020 * 2)
+            generated_files = generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+            assert validation.generate_pixel_checksum(generated_files[-1]) == \
+                validation.generate_pixel_checksum(filepaths.STANDARD_TIF)
+            with Image.open(generated_files[0]) as jpg_image:
+                assert jpg_image.size == (810, 612)
+
+            with pytest.raises(exceptions.MemoryBudgetError):
+                generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder,
+                                                         create_jpg_as_thumbnail=False)
@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+
+import pytest
+
+from image_processing import entry_points
+from .test_utils import temporary_folder, filepaths
+
+
+class TestEntryPoints(object):
+
+    def test_preflight_reads_manifest_without_output_folders(self, monkeypatch):
+        with temporary_folder() as folder:
+            manifest_filepath = os.path.join(folder, 'manifest.txt')
+            with open(manifest_filepath, 'w') as f:
+                f.write('{0}\n'.format(filepaths.SMALL_TIF))
+            report_filepath = os.path.join(folder, 'report.json')
+            monkeypatch.setattr(sys, 'argv', ['preflight_tiffs', manifest_filepath, '-r', report_filepath, '-w', '1'])
+            entry_points.preflight_tiffs()
+            with open(report_filepath) as f:
+                report = json.load(f)
+            assert [result['source_filepath'] for result in report['results']] == [filepaths.SMALL_TIF]
+
+    def test_preflight_exits_with_error_for_unsuitable_files(self, monkeypatch):
+        with temporary_folder() as folder:
+            manifest_filepath = os.path.join(folder, 'manifest.txt')
+            with open(manifest_filepath, 'w') as f:
+                f.write('{0}\n{1},{2}\n'.format(filepaths.SMALL_TIF, filepaths.INVALID_TIF, folder))
+            monkeypatch.setattr(sys, 'argv', ['preflight_tiffs', manifest_filepath, '-w', '1'])
+            with pytest.raises(SystemExit) as exit_info:
+                entry_points.preflight_tiffs()
+            assert exit_info.value.code == 1
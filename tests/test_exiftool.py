@@ -0,0 +1,100 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from PIL import Image
+
+from image_processing import conversion, jp2
+from image_processing.exiftool import ExifToolPool, ExifToolProcess
+from .test_utils import temporary_folder, filepaths, xmp_files_match, image_metadata_matches
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class TestExifTool(object):
+
+    def test_runs_several_commands_on_one_process(self):
+        process = ExifToolProcess()
+        try:
+            assert process.execute(['-ver']).strip()
+            pid = process._process.pid
+            assert process.execute(['-ver']).strip()
+            assert process._process.pid == pid
+        finally:
+            process.stop()
+        assert not process.running
+
+    def test_restarts_after_crash(self):
+        process = ExifToolProcess()
+        try:
+            process.start()
+            process._process.kill()
+            process._process.wait()
+            assert process.execute(['-ver']).strip()
+            assert process.running
+        finally:
+            process.stop()
+
+    def test_raises_error_on_failed_command(self):
+        with ExifToolPool() as pool:
+            with pytest.raises(subprocess.CalledProcessError):
+                pool.execute(['-tagsFromFile', 'tests/data/does_not_exist.tif', 'tests/data/also_does_not_exist.tif'])
+            # the process is still usable afterwards
+            assert pool.execute(['-ver']).strip()
+
+    def test_reads_errors_for_many_failing_files(self):
+        # more error output than fits in a pipe, which exiftool writes before it finishes the command
+        missing_files = ['tests/data/does_not_exist_{0}.tif'.format(index) for index in range(5000)]
+        process = ExifToolProcess()
+        try:
+            with pytest.raises(subprocess.CalledProcessError) as error:
+                process.execute(['-tagsFromFile', filepaths.STANDARD_TIF] + missing_files)
+            assert missing_files[-1] in error.value.output
+            assert process.execute(['-ver']).strip()
+        finally:
+            process.stop()
+
+    def test_converter_extracts_xmp_using_pool(self):
+        with temporary_folder() as output_folder:
+            xmp_file = os.path.join(output_folder, 'full.xmp')
+            converter = conversion.Converter(exiftool_pool_size=1)
+            try:
+                converter.extract_xmp_to_sidecar_file(filepaths.STANDARD_TIF, xmp_file)
+            finally:
+                converter.exiftool_pool.close()
+            assert xmp_files_match(xmp_file, filepaths.STANDARD_TIF_XMP)
+
+    def test_converter_extracts_many_xmp_files(self):
+        with temporary_folder() as source_folder, temporary_folder() as output_folder:
+            for filename in ['a.tif', 'b.tif']:
+                shutil.copy(filepaths.STANDARD_TIF, os.path.join(source_folder, filename))
+            xmp_jobs = [(os.path.join(source_folder, 'a.tif'), os.path.join(output_folder, 'a.xmp')),
+                        (os.path.join(source_folder, 'b.tif'), os.path.join(output_folder, 'b.xmp')),
+                        (os.path.join(source_folder, 'a.tif'), os.path.join(output_folder, 'renamed.xmp')),
+                        (os.path.join(source_folder, 'missing.tif'), os.path.join(output_folder, 'missing.xmp'))]
+            results = conversion.Converter().extract_xmp_to_sidecar_files(xmp_jobs, batch_size=1)
+            assert [result.success for result in results] == [True, True, True, False]
+            for _, xmp_file in xmp_jobs[:3]:
+                assert xmp_files_match(xmp_file, filepaths.STANDARD_TIF_XMP)
+            assert not os.path.exists(xmp_jobs[3][1])
+
+    def test_converter_appends_xmp_to_jp2(self):
+        with temporary_folder() as output_folder:
+            appended_jp2_file = os.path.join(output_folder, 'appended.jp2')
+            rewritten_jp2_file = os.path.join(output_folder, 'rewritten.jp2')
+            with Image.open(filepaths.SMALL_TIF) as pil_image:
+                pil_image.save(appended_jp2_file)
+            shutil.copy(appended_jp2_file, rewritten_jp2_file)
+            jp2_size = os.path.getsize(appended_jp2_file)
+
+            converter = conversion.Converter()
+            converter.copy_over_xmp_to_jp2(filepaths.SMALL_TIF, appended_jp2_file)
+            converter.copy_over_embedded_metadata(filepaths.SMALL_TIF, rewritten_jp2_file, write_only_xmp=True)
+            with open(appended_jp2_file, 'rb') as jp2_file:
+                boxes = list(jp2.iter_boxes(jp2_file))
+            assert boxes[-1][0] == jp2.UUID_BOX and boxes[-1][1] > jp2_size
+            assert image_metadata_matches(appended_jp2_file, rewritten_jp2_file)
@@ -0,0 +1,48 @@
+import os
+
+from PIL import Image
+
+from image_processing import inspection, validation
+from .test_utils import temporary_folder, filepaths
+
+
+class TestInspection(object):
+
+    def test_inspects_tiff_headers(self):
+        image_info = inspection.inspect_image(filepaths.STANDARD_TIF)
+        with Image.open(filepaths.STANDARD_TIF) as pil_image:
+            assert image_info.format == 'TIFF'
+            assert image_info.mode == pil_image.mode
+            assert image_info.size == pil_image.size
+            assert image_info.bit_depths == (8, 8, 8)
+            assert image_info.icc_profile == pil_image.info['icc_profile']
+        # the second layer is a thumbnail
+        assert image_info.frame_count == 2
+        assert image_info.compression == 'raw'
+        assert image_info.file_size == os.path.getsize(filepaths.STANDARD_TIF)
+
+    def test_inspects_jpg_headers(self):
+        image_info = inspection.inspect_image(filepaths.STANDARD_JPG)
+        assert image_info.format == 'JPEG'
+        assert image_info.mode == 'RGB'
+        assert image_info.bit_depths == (8, 8, 8)
+        assert image_info.has_icc_profile
+        assert image_info.frame_count == 1
+
+    def test_counts_tiff_frames(self):
+        with temporary_folder() as output_folder:
+            frames = [Image.new('RGB', (20, 10), (frame, 0, 0)) for frame in range(5)]
+            for big_tiff in [False, True]:
+                multi_frame_filepath = os.path.join(output_folder, 'multi_frame.tif')
+                frames[0].save(multi_frame_filepath, save_all=True, append_images=frames[1:], big_tiff=big_tiff)
+                assert inspection.count_frames(multi_frame_filepath) == 5
+                assert inspection.inspect_image(multi_frame_filepath).frame_count == 5
+        assert inspection.count_frames(filepaths.SMALL_TIF) == 1
+
+    def test_image_info_used_for_suitability_check(self):
+        image_info = inspection.inspect_image(filepaths.GREYSCALE_NO_PROFILE_TIF)
+        warnings = validation.check_image_suitable_for_jp2_conversion(filepaths.GREYSCALE_NO_PROFILE_TIF,
+                                                                      image_context=image_info)
+        assert warnings == ['No icc profile embedded in {0}'.format(filepaths.GREYSCALE_NO_PROFILE_TIF),
+                            'File has multiple layers: only the first one will be converted']
+        assert validation.check_image_suitable_for_jp2_conversion(filepaths.SMALL_TIF) == []
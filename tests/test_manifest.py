@@ -0,0 +1,59 @@
+import logging
+import os
+import shutil
+import sys
+
+from image_processing.manifest import DerivativeManifest
+from .test_utils import temporary_folder, filepaths
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+
+class TestDerivativeManifest(object):
+
+    def test_derivative_up_to_date_until_inputs_change(self):
+        with temporary_folder() as output_folder:
+            source_filepath = os.path.join(output_folder, 'source.tif')
+            shutil.copy(filepaths.SMALL_TIF, source_filepath)
+            derivative_filepath = os.path.join(output_folder, 'full.jpg')
+            shutil.copy(filepaths.SMALL_TIF, derivative_filepath)
+            manifest_filepath = os.path.join(output_folder, 'full.manifest.json')
+
+            manifest = DerivativeManifest(manifest_filepath)
+            assert not manifest.is_up_to_date(source_filepath, 'full.jpg', derivative_filepath, {'resize': 0.6})
+            manifest.record_source(source_filepath)
+            manifest.record('full.jpg', derivative_filepath, {'resize': 0.6})
+            manifest.save()
+
+            manifest = DerivativeManifest(manifest_filepath)
+            assert manifest.is_up_to_date(source_filepath, 'full.jpg', derivative_filepath, {'resize': 0.6})
+            assert not manifest.is_up_to_date(source_filepath, 'full.jpg', derivative_filepath, {'resize': 0.5})
+            assert not manifest.is_up_to_date(source_filepath, 'full.xmp', derivative_filepath, {})
+
+            # touching the source without changing it doesn't make the derivatives stale
+            os.utime(source_filepath, (0, 0))
+            assert DerivativeManifest(manifest_filepath).is_up_to_date(source_filepath, 'full.jpg',
+                                                                       derivative_filepath, {'resize': 0.6})
+
+            shutil.copy(filepaths.SMALL_TIF_WITH_CHANGED_PIXELS, source_filepath)
+            assert not DerivativeManifest(manifest_filepath).is_up_to_date(source_filepath, 'full.jpg',
+                                                                           derivative_filepath, {'resize': 0.6})
+
+    def test_changed_derivative_is_stale(self):
+        with temporary_folder() as output_folder:
+            derivative_filepath = os.path.join(output_folder, 'full.jpg')
+            shutil.copy(filepaths.SMALL_TIF, derivative_filepath)
+            manifest = DerivativeManifest(os.path.join(output_folder, 'full.manifest.json'))
+            manifest.record_source(filepaths.SMALL_TIF)
+            manifest.record('full.jpg', derivative_filepath, {})
+            with open(derivative_filepath, 'ab') as f:
+                f.write(b'changed')
+            assert not manifest.is_up_to_date(filepaths.SMALL_TIF, 'full.jpg', derivative_filepath, {})
+
+    def test_ignores_unreadable_manifest(self):
+        with temporary_folder() as output_folder:
+            manifest_filepath = os.path.join(output_folder, 'full.manifest.json')
+            with open(manifest_filepath, 'w') as f:
+                f.write('not json')
+            manifest = DerivativeManifest(manifest_filepath)
+            assert manifest.derivatives == {}
@@ -0,0 +1,163 @@
+import os
+import struct
+
+import pytest
+from PIL import Image, ImageChops
+
+from image_processing import memory, validation, exceptions
+from .test_utils import temporary_folder, filepaths
+
+# a fifth of the size of the decoded standard tif
+SMALL_MEMORY_BUDGET = 1350 * 1020 * 4 // 5
+
+
+class TestMemory(object):
+
+    def test_decoded_size(self):
+        assert memory.decoded_size('RGB', (100, 10)) == 4000
+        assert memory.decoded_size('I;16', (100, 10)) == 2000
+        assert memory.decoded_size('1', (100, 10)) == 1000
+
+    def test_reads_rows_of_strips(self):
+        for image_filepath in [filepaths.STANDARD_TIF, filepaths.BILEVEL_TIF, filepaths.SMALL_TIF]:
+            strip_reader = memory.StripReader(image_filepath)
+            with Image.open(image_filepath) as pil_image:
+                width, height = pil_image.size
+                # crossing the boundaries of the tiff's strips
+                for upper, lower in [(0, 1), (3, 97), (50, height), (height - 1, height)]:
+                    assert strip_reader.read_rows(upper, lower).tobytes() == \
+                        pil_image.crop((0, upper, width, lower)).tobytes()
+
+    def test_reads_rows_of_tiles(self):
+        with temporary_folder() as output_folder:
+            tiled_filepath = os.path.join(output_folder, 'tiled.tif')
+            with Image.open(filepaths.SMALL_TIF) as pil_image:
+                pil_image.load()
+                # tiles which overlap the right and bottom edges
+                _write_tiled_tiff(tiled_filepath, pil_image, 32)
+                strip_reader = memory.StripReader(tiled_filepath)
+                width, height = pil_image.size
+                for upper, lower in [(0, 1), (3, 97), (30, 70), (50, height), (height - 1, height)]:
+                    assert strip_reader.read_rows(upper, lower).tobytes() == \
+                        pil_image.crop((0, upper, width, lower)).tobytes()
+
+    def test_reads_rows_of_palette_and_16_bit_strips(self):
+        with temporary_folder() as output_folder, Image.open(filepaths.SMALL_TIF) as pil_image:
+            for converted_image in [pil_image.convert('P'), pil_image.convert('I').convert('I;16')]:
+                converted_filepath = os.path.join(output_folder, 'converted.tif')
+                converted_image.save(converted_filepath)
+                strip_rows = memory.StripReader(converted_filepath).read_rows(5, 30)
+                expected_rows = converted_image.crop((0, 5, converted_image.size[0], 30))
+                assert strip_rows.mode == expected_rows.mode
+                assert strip_rows.tobytes() == expected_rows.tobytes()
+                assert strip_rows.getpalette() == expected_rows.getpalette()
+
+    def test_needs_strips_over_budget(self):
+        assert not memory.MemoryBudget(10 ** 9).needs_strips(filepaths.STANDARD_TIF)
+        assert memory.MemoryBudget(SMALL_MEMORY_BUDGET).needs_strips(filepaths.STANDARD_TIF)
+
+    def test_rejects_compressed_tiff_over_budget(self):
+        with temporary_folder() as output_folder:
+            compressed_filepath = os.path.join(output_folder, 'compressed.tif')
+            with Image.open(filepaths.SMALL_TIF) as pil_image:
+                Image.frombytes(pil_image.mode, pil_image.size, pil_image.tobytes()) \
+                    .save(compressed_filepath, compression='tiff_lzw')
+            assert not memory.MemoryBudget(10 ** 9).needs_strips(compressed_filepath)
+            with pytest.raises(exceptions.MemoryBudgetError):
+                memory.MemoryBudget(1000).needs_strips(compressed_filepath)
+
+    def test_checksum_in_strips_matches(self):
+        memory_budget = memory.MemoryBudget(SMALL_MEMORY_BUDGET)
+        for image_filepath in [filepaths.STANDARD_TIF, filepaths.BILEVEL_TIF]:
+            for checksum_options in [{}, {'algorithm': 'blake2b', 'parallel': True, 'strip_height': 100}]:
+                assert validation.generate_pixel_checksum(image_filepath, memory_budget=memory_budget,
+                                                          **checksum_options) == \
+                    validation.generate_pixel_checksum(image_filepath, **checksum_options)
+
+    def test_image_context_over_budget(self):
+        memory_budget = memory.MemoryBudget(SMALL_MEMORY_BUDGET)
+        with validation.ImageContext(filepaths.STANDARD_TIF, memory_budget=memory_budget) as image_context:
+            assert image_context.in_strips
+            assert image_context.pixel_checksum == validation.generate_pixel_checksum(filepaths.STANDARD_TIF)
+            with pytest.raises(exceptions.MemoryBudgetError):
+                image_context.image
+
+    def test_resize_in_strips_matches_pillow(self):
+        strip_reader = memory.StripReader(filepaths.STANDARD_TIF)
+        with Image.open(filepaths.STANDARD_TIF) as pil_image:
+            for size, resample, reducing_gap in [((810, 612), Image.Resampling.LANCZOS, 2.0),
+                                                 ((135, 102), Image.Resampling.LANCZOS, 2.0),
+                                                 ((200, 151), Image.Resampling.BICUBIC, None)]:
+                resized_image = memory.resize_in_strips(strip_reader, size, resample, reducing_gap=reducing_gap,
+                                                        strip_height=50)
+                expected_image = pil_image.resize(size, resample, reducing_gap=reducing_gap)
+                assert resized_image.size == size
+                # rounding can differ by one level
+                assert max(high for _, high in ImageChops.difference(resized_image, expected_image).getextrema()) <= 1
+
+    def test_writes_tiff_in_strips(self):
+        with temporary_folder() as output_folder:
+            output_filepath = os.path.join(output_folder, 'output.tif')
+            strip_reader = memory.StripReader(filepaths.STANDARD_TIF)
+            memory.write_tiff_in_strips(output_filepath, strip_reader.mode, strip_reader.size,
+                                        (strip for _, strip in strip_reader.iter_strips(100)),
+                                        icc_profile=strip_reader.info['icc_profile'])
+            with Image.open(output_filepath) as output_image, Image.open(filepaths.STANDARD_TIF) as pil_image:
+                assert output_image.tobytes() == pil_image.tobytes()
+                assert output_image.info['icc_profile'] == pil_image.info['icc_profile']
+
+    def test_maps_pixel_data(self):
+        for image_filepath in [filepaths.STANDARD_TIF, filepaths.BILEVEL_TIF, filepaths.SMALL_TIF]:
+            with memory.map_pixel_data(image_filepath) as pixel_data, Image.open(image_filepath) as pil_image:
+                assert pixel_data.tobytes() == pil_image.tobytes()
+                assert validation.generate_pixel_checksum(image_filepath, parallel=True, strip_height=100) == \
+                    validation.generate_pixel_checksum_from_pil_image(pil_image, parallel=True, strip_height=100)
+
+    def test_doesnt_map_compressed_pixel_data(self):
+        with temporary_folder() as output_folder:
+            compressed_filepath = os.path.join(output_folder, 'compressed.tif')
+            with Image.open(filepaths.SMALL_TIF) as pil_image:
+                Image.frombytes(pil_image.mode, pil_image.size, pil_image.tobytes()) \
+                    .save(compressed_filepath, compression='tiff_lzw')
+            for image_filepath in [compressed_filepath, filepaths.STANDARD_JPG]:
+                with memory.map_pixel_data(image_filepath) as pixel_data:
+                    assert pixel_data is None
+            assert validation.generate_pixel_checksum(compressed_filepath) == \
+                validation.generate_pixel_checksum(filepaths.SMALL_TIF)
+
+
+def _write_tiled_tiff(filepath, pil_image, tile_size):
+    """
+    Write an RGB image as an uncompressed TIFF in tiles, which Pillow can't save
+    """
+    width, height = pil_image.size
+    tile_data = []
+    for tile_upper in range(0, height, tile_size):
+        for tile_left in range(0, width, tile_size):
+            # edge tiles are padded to the full tile size
+            tile = Image.new('RGB', (tile_size, tile_size))
+            tile.paste(pil_image.crop((tile_left, tile_upper, min(tile_left + tile_size, width),
+                                       min(tile_upper + tile_size, height))))
+            tile_data.append(tile.tobytes())
+    bits_offset = 8 + sum(len(data) for data in tile_data)
+    tile_offsets_offset = bits_offset + 6
+    tile_byte_counts_offset = tile_offsets_offset + 4 * len(tile_data)
+    ifd_offset = tile_byte_counts_offset + 4 * len(tile_data)
+    tile_offsets = [8 + sum(len(data) for data in tile_data[:index]) for index in range(len(tile_data))]
+    # (tag, type, count, value): ImageWidth, ImageLength, BitsPerSample, Compression, PhotometricInterpretation,
+    # SamplesPerPixel, PlanarConfiguration, TileWidth, TileLength, TileOffsets and TileByteCounts
+    entries = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 3, bits_offset), (259, 3, 1, 1), (262, 3, 1, 2),
+               (277, 3, 1, 3), (284, 3, 1, 1), (322, 4, 1, tile_size), (323, 4, 1, tile_size),
+               (324, 4, len(tile_data), tile_offsets_offset), (325, 4, len(tile_data), tile_byte_counts_offset)]
+    with open(filepath, 'wb') as tiff_file:
+        tiff_file.write(b'II*\x00' + struct.pack('<I', ifd_offset))
+        for data in tile_data:
+            tiff_file.write(data)
+        tiff_file.write(struct.pack('<3H', 8, 8, 8))
+        tiff_file.write(struct.pack('<{0}I'.format(len(tile_data)), *tile_offsets))
+        tiff_file.write(struct.pack('<{0}I'.format(len(tile_data)), *[len(data) for data in tile_data]))
+        tiff_file.write(struct.pack('<H', len(entries)))
+        for tag, field_type, count, value in entries:
+            value_format = '<HHII' if field_type == 4 or count > 1 else '<HHIHxx'
+            tiff_file.write(struct.pack(value_format, tag, field_type, count, value))
+        tiff_file.write(struct.pack('<I', 0))
@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+
+import pytest
+
+from image_processing import metrics
+from .test_utils import temporary_folder, filepaths
+
+
+class TestMetrics(object):
+
+    def test_records_stages_in_current_recording(self):
+        with metrics.recording() as recorder:
+            with metrics.record_stage('checksum', input_filepaths=filepaths.SMALL_TIF):
+                pass
+        assert [m.stage for m in recorder.stages] == ['checksum']
+        assert recorder.stages[0].bytes_read == os.path.getsize(filepaths.SMALL_TIF)
+        assert recorder.stages[0].wall_time >= 0
+        assert recorder.stages[0].succeeded
+
+    def test_does_nothing_without_recording(self):
+        with metrics.record_stage('checksum'):
+            pass
+        with metrics.recording() as recorder:
+            pass
+        assert recorder.stages == []
+
+    def test_records_failed_stages(self):
+        with metrics.recording() as recorder:
+            with pytest.raises(ValueError):
+                with metrics.record_stage('validate'):
+                    raise ValueError('invalid')
+        assert not recorder.stages[0].succeeded
+
+    def test_nested_recordings_record_in_both(self):
+        with metrics.recording() as outer_recorder:
+            with metrics.record_stage('validate'):
+                pass
+            with metrics.recording() as inner_recorder:
+                with metrics.record_stage('jpg'):
+                    pass
+        assert [m.stage for m in inner_recorder.stages] == ['jpg']
+        assert [m.stage for m in outer_recorder.stages] == ['validate', 'jpg']
+
+    def test_bound_functions_record_on_other_threads(self):
+        def run_stage():
+            with metrics.record_stage('jpg'):
+                pass
+
+        with metrics.recording() as recorder:
+            thread = threading.Thread(target=metrics.bind_recorder(run_stage))
+            thread.start()
+            thread.join()
+            # without binding, the thread doesn't see the recording
+            thread = threading.Thread(target=run_stage)
+            thread.start()
+            thread.join()
+        assert [m.stage for m in recorder.stages] == ['jpg']
+
+    def test_summarises_stages(self):
+        totals = metrics.summarise([metrics.StageMetrics('jpg', 1.0, 0.5, peak_rss_bytes=100, bytes_written=10),
+                                    metrics.StageMetrics('jpg', 2.0, 1.5, peak_child_rss_bytes=200, bytes_written=5,
+                                                         succeeded=False)])
+        assert totals['jpg'] == {'count': 2, 'failures': 1, 'wall_time': 3.0, 'cpu_time': 2.0, 'bytes_read': 0,
+                                 'bytes_written': 15, 'peak_rss_bytes': 200}
+
+    def test_json_lines_sink(self):
+        with temporary_folder() as output_folder:
+            filepath = os.path.join(output_folder, 'metrics.jsonl')
+            sink = metrics.JsonLinesSink(filepath)
+            sink.write([metrics.StageMetrics('jpg', 1.0, 0.5), metrics.StageMetrics('xmp', 0.5, 0.25)],
+                       source_filepath='a.tif')
+            sink.write([metrics.StageMetrics('jpg', 2.0, 1.0)], source_filepath='b.tif')
+            with open(filepath) as metrics_file:
+                lines = [json.loads(line) for line in metrics_file]
+            assert [(line['source_filepath'], line['stage']) for line in lines] == \
+                   [('a.tif', 'jpg'), ('a.tif', 'xmp'), ('b.tif', 'jpg')]
+            assert metrics.StageMetrics.from_dict(
+                {k: v for k, v in lines[0].items() if k != 'source_filepath'}).as_dict() == \
+                metrics.StageMetrics('jpg', 1.0, 0.5).as_dict()
+
+    def test_prometheus_text_file_sink_keeps_running_totals(self):
+        with temporary_folder() as output_folder:
+            filepath = os.path.join(output_folder, 'metrics.prom')
+            sink = metrics.PrometheusTextFileSink(filepath)
+            sink.write([metrics.StageMetrics('kdu_compress', 1.5, 1.0)])
+            sink.write([metrics.StageMetrics('kdu_compress', 2.5, 3.0, succeeded=False)])
+            with open(filepath) as metrics_file:
+                lines = metrics_file.read().splitlines()
+            assert 'image_processing_stage_runs_total{stage="kdu_compress"} 2' in lines
+            assert 'image_processing_stage_failures_total{stage="kdu_compress"} 1' in lines
+            assert 'image_processing_stage_wall_seconds_total{stage="kdu_compress"} 4.0' in lines
+            assert '# TYPE image_processing_stage_cpu_seconds_total counter' in lines
+            assert os.listdir(output_folder) == ['metrics.prom']
+
+    def test_sinks_must_implement_write(self):
+        class IncompleteSink(metrics.MetricsSink):
+            pass
+
+        with pytest.raises(TypeError):
+            IncompleteSink()
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+
+from PIL import Image
+
+from image_processing import preflight
+from .test_utils import temporary_folder, filepaths
+
+
+class TestPreflight(object):
+
+    def test_checks_source_files(self):
+        with temporary_folder() as folder:
+            cmyk_filepath = os.path.join(folder, 'cmyk.tif')
+            Image.new('CMYK', (10, 10)).save(cmyk_filepath)
+            source_filepaths = [filepaths.SMALL_TIF, filepaths.NO_PROFILE_TIF, cmyk_filepath, filepaths.INVALID_TIF]
+            for max_workers in [1, 2]:
+                results = list(preflight.check_source_files(source_filepaths, max_workers=max_workers,
+                                                            require_icc_profile_for_colour=True))
+                assert [result.source_filepath for result in results] == source_filepaths
+                assert [result.suitable for result in results] == [True, False, False, False]
+                assert results[0].image_info['mode'] == 'RGB'
+                assert results[0].file_size == os.path.getsize(filepaths.SMALL_TIF)
+                assert 'Unsupported colour mode CMYK' in results[2].error
+
+    def test_records_warnings(self):
+        result = preflight.check_source_file(filepaths.BILEVEL_TIF)
+        assert result.suitable
+        assert 'File has multiple layers: only the first one will be converted' in result.warnings
+
+    def test_report_estimates_time(self):
+        report = preflight.PreflightReport(seconds_per_megabyte=2.0, workers=4)
+        report.add(preflight.PreflightResult('a.tif', file_size=3 * 1024 ** 2))
+        report.add(preflight.PreflightResult('b.tif', file_size=5 * 1024 ** 2, warnings=['No icc profile']))
+        report.add(preflight.PreflightResult('c.tif', file_size=1024 ** 2, error='ValidationError: bad'))
+        assert len(report.suitable) == 2
+        assert len(report.with_warnings) == 1
+        assert report.estimated_processing_time == 16.0
+        assert report.estimated_wall_time == 4.0
+
+    def test_writes_reports(self):
+        with temporary_folder() as folder:
+            report = preflight.PreflightReport()
+            for source_filepath in [filepaths.SMALL_TIF, filepaths.INVALID_TIF]:
+                report.add(preflight.check_source_file(source_filepath))
+            csv_filepath = os.path.join(folder, 'report.csv')
+            json_filepath = os.path.join(folder, 'report.json')
+            report.write(csv_filepath)
+            report.write(json_filepath)
+            with open(csv_filepath) as f:
+                lines = f.read().splitlines()
+            assert lines[0].startswith('source_filepath,suitable,error')
+            assert lines[1].startswith('{0},True,,'.format(filepaths.SMALL_TIF))
+            with open(json_filepath) as f:
+                assert json.load(f)['unsuitable'] == 1
+
+    def test_seconds_per_megabyte_from_batch_summary(self):
+        with temporary_folder() as folder:
+            source_filepath = os.path.join(folder, 'source.tif')
+            shutil.copy(filepaths.STANDARD_TIF, source_filepath)
+            summary_filepath = os.path.join(folder, 'summary.json')
+            with open(summary_filepath, 'w') as f:
+                json.dump({'results': [{'source_filepath': source_filepath, 'error': None, 'duration': 8.0},
+                                       {'source_filepath': 'missing.tif', 'error': None, 'duration': 100.0}]}, f)
+            assert preflight.seconds_per_megabyte_from_batch_summary(summary_filepath) == \
+                8.0 / (os.path.getsize(source_filepath) / 1024 ** 2)
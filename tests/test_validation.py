@@ -1,5 +1,9 @@
-from image_processing import validation, exceptions
-from .test_utils import filepaths
+import io
+import os
+import shutil
+
+from image_processing import validation, exceptions, jp2
+from .test_utils import filepaths, temporary_folder
 import pytest
 import logging
 import sys
@@ -20,6 +24,32 @@ class TestValidation(object):
         with pytest.raises(exceptions.ValidationError):
             validation.validate_jp2(filepaths.INVALID_JP2)
 
+    def test_jp2_validation_result_has_properties(self):
+        result = validation.validate_jp2(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert result.is_valid
+        assert result.properties['width'] == 1350
+        assert result.properties['height'] == 1020
+        assert result.properties['transformation'] == '5-3 reversible'
+        assert result.to_xml().startswith(b'<?xml')
+
+    def test_validates_many_jp2s(self):
+        with temporary_folder() as output_folder:
+            truncated_filepath = os.path.join(output_folder, 'truncated.jp2')
+            with open(filepaths.LOSSY_JP2_FROM_STANDARD_TIF, 'rb') as jp2_file:
+                jp2_data = jp2_file.read()
+            with open(truncated_filepath, 'wb') as truncated_file:
+                truncated_file.write(jp2_data[:len(jp2_data) // 2])
+            jpylyzer_output_filepath = os.path.join(output_folder, 'jpylyzer.xml')
+            image_files = [filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, truncated_filepath,
+                           filepaths.LOSSY_JP2_FROM_STANDARD_TIF]
+            results = validation.validate_jp2_many(image_files, output_files=[jpylyzer_output_filepath, None, None],
+                                                   max_workers=2)
+            assert [result.filepath for result in results] == image_files
+            assert [result.is_valid for result in results] == [True, False, True]
+            assert 'contiguousCodestreamBox/foundEOCMarker' in results[1].failed_tests
+            assert results[2].properties['transformation'] == '9-7 irreversible'
+            assert os.path.isfile(jpylyzer_output_filepath)
+
     def test_pixel_checksum_matches_visually_identical_files(self):
         tif_checksum = validation.generate_pixel_checksum(filepaths.STANDARD_TIF)
         assert tif_checksum == validation.generate_pixel_checksum(filepaths.STANDARD_TIF)
@@ -49,3 +79,169 @@ class TestValidation(object):
         assert validation.generate_pixel_checksum(filepaths.SMALL_TIF) == SMALL_TIF_CHECKSUM
         with Image.open(filepaths.SMALL_TIF) as pil_image:
             assert validation.generate_pixel_checksum_from_pil_image(pil_image) == SMALL_TIF_CHECKSUM
+
+    def test_pixel_checksum_algorithms(self):
+        for algorithm in validation.CHECKSUM_ALGORITHMS:
+            checksum = validation.generate_pixel_checksum(filepaths.SMALL_TIF, algorithm=algorithm)
+            assert checksum == validation.generate_pixel_checksum(filepaths.SMALL_TIF_WITH_CHANGED_METADATA,
+                                                                  algorithm=algorithm, buffer_size=1024)
+            assert checksum != validation.generate_pixel_checksum(filepaths.SMALL_TIF_WITH_CHANGED_PIXELS,
+                                                                  algorithm=algorithm)
+            if algorithm != validation.DEFAULT_CHECKSUM_ALGORITHM:
+                assert checksum.startswith('{0}:1:'.format(algorithm))
+            assert validation.pixel_checksum_options(checksum) == {'algorithm': algorithm, 'parallel': False}
+        with pytest.raises(ValueError):
+            validation.generate_pixel_checksum(filepaths.SMALL_TIF, algorithm='md4')
+
+    def test_parallel_pixel_checksum(self):
+        checksum = validation.generate_pixel_checksum(filepaths.SMALL_TIF, algorithm='blake2b', parallel=True,
+                                                      strip_height=16, max_workers=3)
+        assert checksum.startswith('blake2b-tree16:1:')
+        assert checksum == validation.generate_pixel_checksum(filepaths.SMALL_TIF_WITH_CHANGED_METADATA,
+                                                              **validation.pixel_checksum_options(checksum))
+        assert checksum != validation.generate_pixel_checksum(filepaths.SMALL_TIF_WITH_CHANGED_PIXELS,
+                                                              **validation.pixel_checksum_options(checksum))
+        assert checksum != validation.generate_pixel_checksum(filepaths.SMALL_TIF, algorithm='blake2b')
+
+        stream = io.BytesIO()
+        with Image.open(filepaths.SMALL_TIF) as pil_image:
+            pil_image.save(stream, 'PPM')
+        stream.seek(0)
+        _, (width, _) = validation.read_pnm_header(stream)
+        assert validation.generate_pixel_checksum_from_stream(stream, algorithm='blake2b', parallel=True,
+                                                              strip_height=16, row_length=width * 3) == checksum
+
+    def test_visually_identical_with_versioned_checksum(self):
+        checksum_options = {'algorithm': 'blake2b', 'parallel': True}
+        with validation.ImageContext(filepaths.SMALL_TIF, checksum_options=checksum_options) as image_context:
+            assert image_context.pixel_checksum.startswith('blake2b-tree')
+            validation.check_visually_identical(filepaths.SMALL_TIF, filepaths.SMALL_TIF_WITH_CHANGED_METADATA,
+                                                source_image_context=image_context)
+            with pytest.raises(exceptions.ValidationError):
+                validation.check_visually_identical(filepaths.SMALL_TIF, filepaths.SMALL_TIF_WITH_CHANGED_PIXELS,
+                                                    source_image_context=image_context)
+        with pytest.raises(ValueError):
+            validation.pixel_checksum_options('blake2b:2:abc')
+
+    def test_image_context_caches_properties_after_close(self):
+        with validation.ImageContext(filepaths.STANDARD_TIF) as image_context:
+            assert image_context.mode == 'RGB'
+            assert image_context.bit_depths == (8, 8, 8)
+            assert image_context.frame_count == 2
+            assert image_context.icc_profile is not None
+            checksum = image_context.pixel_checksum
+        assert checksum == validation.generate_pixel_checksum(filepaths.STANDARD_TIF)
+        assert image_context.pixel_checksum == checksum
+        with pytest.raises(ValueError):
+            image_context.image
+
+    def test_checks_use_image_context(self):
+        with validation.ImageContext(filepaths.NO_PROFILE_TIF) as image_context:
+            with pytest.raises(exceptions.ValidationError):
+                validation.check_image_suitable_for_jp2_conversion(filepaths.NO_PROFILE_TIF,
+                                                                   image_context=image_context)
+        with validation.ImageContext(filepaths.SMALL_TIF) as image_context:
+            validation.check_visually_identical(filepaths.SMALL_TIF, filepaths.SMALL_TIF_WITH_CHANGED_METADATA,
+                                                source_image_context=image_context)
+            with pytest.raises(exceptions.ValidationError):
+                validation.check_visually_identical(filepaths.SMALL_TIF, filepaths.SMALL_TIF_WITH_CHANGED_PIXELS,
+                                                    source_image_context=image_context)
+
+    def test_pnm_stream_checksum_matches_pixel_checksum(self):
+        stream = io.BytesIO()
+        with Image.open(filepaths.SMALL_TIF) as pil_image:
+            pil_image.save(stream, 'PPM')
+        stream.seek(0)
+        assert validation.read_pnm_header(stream) == ('RGB', (135, 102))
+        assert validation.generate_pixel_checksum_from_stream(stream) == \
+            validation.generate_pixel_checksum(filepaths.SMALL_TIF)
+
+    def test_pnm_stream_visually_identical(self):
+        for source_filepath, converted_filepath in [(filepaths.NO_PROFILE_TIF, filepaths.NO_PROFILE_TIF),
+                                                    (filepaths.NO_PROFILE_TIF, filepaths.SMALL_TIF_WITH_CHANGED_PIXELS)]:
+            stream = io.BytesIO()
+            with Image.open(converted_filepath) as pil_image:
+                pil_image.save(stream, 'PPM')
+            stream.seek(0)
+            if source_filepath == converted_filepath:
+                validation.check_pnm_stream_visually_identical(source_filepath, stream, None)
+            else:
+                with pytest.raises(exceptions.ValidationError):
+                    validation.check_pnm_stream_visually_identical(source_filepath, stream, None)
+
+    def test_reads_icc_profile_from_jp2(self):
+        with Image.open(filepaths.STANDARD_TIF) as pil_image:
+            assert jp2.get_icc_profile(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP) == pil_image.info['icc_profile']
+        assert jp2.get_icc_profile(filepaths.LOSSLESS_JP2_FROM_BILEVEL_TIF_XMP) is None
+
+    def test_reads_image_header_and_decomposition_levels_from_jp2(self):
+        assert jp2.get_image_header(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP) == ((1350, 1020), 3, 8)
+        assert jp2.get_image_header(filepaths.LOSSLESS_JP2_FROM_BILEVEL_TIF_XMP) == ((1350, 1020), 1, 1)
+        assert jp2.get_decomposition_levels(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP) == 6
+
+    def test_appends_xmp_box_to_jp2(self):
+        with temporary_folder() as output_folder:
+            jp2_file = os.path.join(output_folder, 'output.jp2')
+            xmp_packet = jp2.get_xmp_packet(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            # an existing xmp box before the codestream can't be replaced without rewriting the file
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_file)
+            assert not jp2.append_xmp_box(jp2_file, xmp_packet)
+
+            with Image.open(filepaths.SMALL_TIF) as pil_image:
+                pil_image.save(jp2_file)
+            pixel_checksum = validation.generate_pixel_checksum(jp2_file)
+            assert jp2.get_xmp_packet(jp2_file) is None
+            # kakadu can leave the codestream box length as 0, meaning it extends to the end of the file
+            with open(jp2_file, 'r+b') as jp2_file_obj:
+                codestream_offset = [box[1] for box in jp2.iter_boxes(jp2_file_obj) if box[0] == jp2.CODESTREAM_BOX][0]
+                jp2_file_obj.seek(codestream_offset - 8)
+                jp2_file_obj.write(b'\0\0\0\0')
+            # the file is replaced rather than changed in place, so a hard link to it keeps the original
+            linked_file = os.path.join(output_folder, 'linked.jp2')
+            os.link(jp2_file, linked_file)
+            with open(linked_file, 'rb') as linked_file_obj:
+                linked_contents = linked_file_obj.read()
+            assert jp2.append_xmp_box(jp2_file, b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>')
+            with open(linked_file, 'rb') as linked_file_obj:
+                assert linked_file_obj.read() == linked_contents
+            # replaces the box it appended before, in place now the file isn't linked
+            inode = os.stat(jp2_file).st_ino
+            assert jp2.append_xmp_box(jp2_file, xmp_packet)
+            assert jp2.get_xmp_packet(jp2_file) == xmp_packet
+            assert os.stat(jp2_file).st_ino == inode
+            with open(jp2_file, 'rb') as jp2_file_obj:
+                assert [box[0] for box in jp2.iter_boxes(jp2_file_obj)].count(jp2.UUID_BOX) == 1
+            assert validation.validate_jp2(jp2_file).is_valid
+            assert validation.generate_pixel_checksum(jp2_file) == pixel_checksum
+
+    def test_failed_xmp_box_append_restores_jp2(self):
+        with temporary_folder() as output_folder:
+            jp2_file = os.path.join(output_folder, 'output.jp2')
+            with Image.open(filepaths.SMALL_TIF) as pil_image:
+                pil_image.save(jp2_file)
+            with open(jp2_file, 'r+b') as jp2_file_obj:
+                codestream_offset = [box[1] for box in jp2.iter_boxes(jp2_file_obj) if box[0] == jp2.CODESTREAM_BOX][0]
+                jp2_file_obj.seek(codestream_offset - 8)
+                jp2_file_obj.write(b'\0\0\0\0')
+            for existing_xmp_packet in [None, b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>']:
+                if existing_xmp_packet is not None:
+                    assert jp2.append_xmp_box(jp2_file, existing_xmp_packet)
+                with open(jp2_file, 'rb') as jp2_file_obj:
+                    original_contents = jp2_file_obj.read()
+                # fails after the box header has been written
+                with pytest.raises(TypeError):
+                    jp2.append_xmp_box(jp2_file, 'not bytes')
+                with open(jp2_file, 'rb') as jp2_file_obj:
+                    assert jp2_file_obj.read() == original_contents
+
+    def test_finds_first_pixel_difference(self):
+        with Image.open(filepaths.SMALL_TIF) as image1, Image.open(filepaths.SMALL_TIF_WITH_CHANGED_PIXELS) as image2:
+            assert validation.find_pixel_difference(image1, image2, strip_height=16, max_workers=2) == \
+                ((0, 32, 135, 48), (40, 45))
+        with Image.open(filepaths.SMALL_TIF) as image1, Image.open(filepaths.SMALL_TIF_WITH_CHANGED_METADATA) as image2:
+            assert validation.find_pixel_difference(image1, image2, strip_height=7, max_workers=2) is None
+
+    def test_check_visually_identical_reports_difference_location(self):
+        with pytest.raises(exceptions.ValidationError) as e:
+            validation.check_visually_identical(filepaths.SMALL_TIF, filepaths.SMALL_TIF_WITH_CHANGED_PIXELS)
+        assert 'pixel (40, 45)' in str(e.value)